@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Script to benchmark utils.clean_text against the original implementation on real dataset samples,
+checking at the same time that both produce identical output
+"""
+
+import argparse
+import glob
+import importlib.util
+import logging
+import os
+import time
+from typing import Callable
+
+from utils import clean_text, clean_text_reference
+
+logging.basicConfig(level=logging.INFO)
+
+
+def load_prepare_script(dataset: str):
+    """Import code/prepare-{dataset}-for-turkunlp.py as a module."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        f"prepare-{dataset}-for-turkunlp.py")
+    spec = importlib.util.spec_from_file_location(f"prepare_{dataset}_for_turkunlp", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def collect_fields(dataset: str, input_directory: str, max_fields: int) -> list[str]:
+    """Run the prepare script reader for the dataset, capturing the raw strings it passes to
+    clean_text."""
+    fields = []
+
+    def capture(txt: str) -> str:
+        fields.append(txt)
+        return txt
+
+    module = load_prepare_script(dataset)
+    if dataset == 'hs':
+        for _ in module.yield_articles(input_directory, capture):
+            if len(fields) >= max_fields:
+                break
+    elif dataset in ('il', 'stt'):
+        extension = 'html' if dataset == 'il' else 'xml'
+        for file in glob.glob(os.path.join(input_directory, "**", f"*.{extension}"), recursive=True):
+            module.yield_article(file, capture)
+            if len(fields) >= max_fields:
+                break
+    elif dataset == 'yle':
+        for file in glob.glob(os.path.join(input_directory, "**", "*.json"), recursive=True):
+            for _ in module.yield_articles(file, capture):
+                pass
+            if len(fields) >= max_fields:
+                break
+    else:
+        raise ValueError(f"Unknown dataset {dataset}")
+    return fields[:max_fields]
+
+
+def time_function(function: Callable[[str], str], fields: list[str], repeat: int) -> tuple[float, list[str]]:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [function(field) for field in fields]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def benchmark(dataset: str, input_directory: str, max_fields: int, repeat: int) -> int:
+    fields = collect_fields(dataset, input_directory, max_fields)
+    megabytes = sum(len(field.encode('utf-8')) for field in fields) / 1024 / 1024
+    if megabytes == 0:
+        logging.warning("No fields found for %s in %s.", dataset, input_directory)
+        return 0
+    reference_time, reference_results = time_function(
+        clean_text_reference.clean_text, fields, repeat)
+    optimized_time, optimized_results = time_function(clean_text.clean_text, fields, repeat)
+    mismatches = [index for index, (reference, optimized) in enumerate(
+        zip(reference_results, optimized_results)) if reference != optimized]
+    print(f"{dataset}: {len(fields)} fields, {megabytes:.2f} MB, "
+          f"reference {megabytes/reference_time:.2f} MB/s ({reference_time/megabytes:.3f} s/MB), "
+          f"optimized {megabytes/optimized_time:.2f} MB/s ({optimized_time/megabytes:.3f} s/MB), "
+          f"speedup {reference_time/optimized_time:.2f}x, {len(mismatches)} mismatches")
+    for index in mismatches[:5]:
+        logging.error("Mismatch in %s field %d:\n%r\nreference: %r\noptimized: %r", dataset, index,
+                      fields[index], reference_results[index], optimized_results[index])
+    return len(mismatches)
+
+
+# %%
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="clean_text benchmark")
+    parser.add_argument("-n", "--max-fields", type=int,
+                        help="maximum number of fields to sample per dataset", default=100000)
+    parser.add_argument("-r", "--repeat", type=int,
+                        help="number of timing runs, of which the best is reported", default=3)
+    parser.add_argument("input", nargs="+",
+                        help="dataset=input directory pairs, e.g. yle=data/input/yle")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    mismatches = 0
+    for spec in args.input:
+        dataset, input_directory = spec.split('=', 1)
+        mismatches += benchmark(dataset, input_directory, args.max_fields, args.repeat)
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Script to benchmark the article extraction of prepare-il-for-turkunlp.py against the original
+regex, json and string concatenation implementation, per stage and per year of the archive,
+checking at the same time that both produce identical articles
+"""
+
+import argparse
+import glob
+import importlib.util
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Optional
+
+import regex
+from utils.clean_text import clean_text
+
+logging.basicConfig(level=logging.INFO)
+
+STAGES = ('find', 'decode', 'body', 'clean')
+
+
+def load_prepare_script():
+    """Import code/prepare-il-for-turkunlp.py as a module."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepare-il-for-turkunlp.py")
+    spec = importlib.util.spec_from_file_location("prepare_il_for_turkunlp", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reference_parse_body(node: Any) -> str:
+    content = node['text'] if 'text' in node else ''
+    if node['type'] == 'list':
+        for entry in node['items']:
+            content += '\n * '
+            for child in entry:
+                content += reference_parse_body(child)
+        content += '\n'
+    elif node['type'] == 'list-ordered':
+        for index, entry in enumerate(node['items']):
+            content += f'\n {index+1}. '
+            for child in entry:
+                content += reference_parse_body(child)
+        content += '\n'
+    elif 'items' in node:
+        for child in node['items']:
+            content += reference_parse_body(child)
+    if node['type'] == 'paragraph':
+        content += '\n\n'
+    return content
+
+
+def reference_yield_article(file: str, clean: Callable[[str], str],
+                            timings: dict[str, float]) -> Optional[tuple[str, str, Optional[str], str]]:
+    """The original article extraction, with the same stages as yield_article."""
+    id = os.path.basename(file)[:-5]
+    try:
+        start = time.perf_counter()
+        with open(file) as ir:
+            html = ir.read()
+        match = regex.search(r'({"article_id":.*}),"lastUpdated":\d+}},"authorInfo":', html)
+        found = time.perf_counter()
+        if match is None:
+            return None
+        article = json.loads(match.group(1))
+        decoded = time.perf_counter()
+        body = ""
+        for elem in article['body']:
+            body += reference_parse_body(elem)
+        assembled = time.perf_counter()
+        headline = clean(article['title'])
+        lead = clean(article['lead']) if article['lead'] != '' else None
+        body = clean(body)
+        cleaned = time.perf_counter()
+        for stage, seconds in zip(STAGES, (found - start, decoded - found, assembled - decoded,
+                                           cleaned - assembled)):
+            timings[stage] += seconds
+        return id, headline, lead, body
+    except Exception:
+        return None
+
+
+def benchmark(module, year: str, files: list[str]) -> int:
+    megabytes = sum(os.path.getsize(file) for file in files) / 1024 / 1024
+    reference_timings = dict.fromkeys(STAGES, 0.0)
+    timings = dict.fromkeys(STAGES, 0.0)
+    mismatches = 0
+    logging.disable(logging.ERROR)
+    try:
+        for file in files:
+            reference = reference_yield_article(file, clean_text, reference_timings)
+            article = module.yield_article(file, clean_text, timings)
+            if article is not None:
+                article = article.id, article.title, article.ingress, article.body
+            if reference != article:
+                mismatches += 1
+                logging.disable(logging.NOTSET)
+                logging.error("Mismatch in %s:\nreference: %r\noptimized: %r", file, reference, article)
+                logging.disable(logging.ERROR)
+    finally:
+        logging.disable(logging.NOTSET)
+    print(f"{year}: {len(files)} files, {megabytes:.2f} MB, {mismatches} mismatches")
+    for stage in STAGES:
+        print(f"  {stage:6} reference {reference_timings[stage]:8.3f} s, "
+              f"optimized {timings[stage]:8.3f} s, "
+              f"speedup {reference_timings[stage]/max(timings[stage], 1e-9):6.2f}x")
+    reference_total = sum(reference_timings.values())
+    total = sum(timings.values())
+    print(f"  total  reference {reference_total:8.3f} s, optimized {total:8.3f} s, "
+          f"speedup {reference_total/max(total, 1e-9):6.2f}x")
+    return mismatches
+
+
+# %%
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="IL article extraction benchmark")
+    parser.add_argument("-n", "--max-files", type=int,
+                        help="maximum number of files to sample per year", default=10000)
+    parser.add_argument("-i", "--input-directory", help="IL input directory, with a subdirectory per year",
+                        required=True)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    module = load_prepare_script()
+    mismatches = 0
+    for year_directory in sorted(glob.glob(os.path.join(args.input_directory, "*"))):
+        if os.path.isdir(year_directory):
+            files = sorted(glob.glob(os.path.join(year_directory, "**", "*.html"),
+                                     recursive=True))[:args.max_files]
+            if files:
+                mismatches += benchmark(module, os.path.basename(year_directory), files)
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Script to benchmark the projecting article reader of prepare-yle-for-turkunlp.py against the
+original ijson.items implementation, in articles per second and peak memory, checking at the same
+time that both produce identical articles
+"""
+
+import argparse
+import glob
+import importlib.util
+import logging
+import os
+import time
+import tracemalloc
+from typing import Callable, Iterator
+
+import ijson
+
+logging.basicConfig(level=logging.INFO)
+
+
+def load_prepare_script():
+    """Import code/prepare-yle-for-turkunlp.py as a module."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepare-yle-for-turkunlp.py")
+    spec = importlib.util.spec_from_file_location("prepare_yle_for_turkunlp", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reference_yield_articles(module, file: str) -> Iterator:
+    """The original article reader, building every article in full."""
+    with open(file, 'rb') as articles_file:
+        for article in module.ijson.items(articles_file, 'data.item'):
+            article_id = article['id']
+            title = article['headline']['full'] if 'headline' in article else None
+            ingress = article['lead'] if 'lead' in article else None
+            body = [(index, content['text']) for index, content in enumerate(
+                article['content']) if 'text' in content and isinstance(content['text'], str)]
+            yield module.Article(article_id, title, ingress, body)
+
+
+def read_all(yield_articles: Callable[[str], Iterator], files: list[str]) -> list[tuple]:
+    return [(article.id, article.title, article.ingress, article.body)
+            for file in files for article in yield_articles(file)]
+
+
+def measure(yield_articles: Callable[[str], Iterator], files: list[str],
+            repeats: int) -> tuple[int, float, int]:
+    """Return the number of articles, the best time to read them all and the peak memory
+    allocated while reading them. Articles are not kept, as the prepare script does not."""
+    seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        articles = 0
+        for file in files:
+            for _ in yield_articles(file):
+                articles += 1
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    for file in files:
+        for _ in yield_articles(file):
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return articles, seconds, peak
+
+
+# %%
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="YLE article reading benchmark")
+    parser.add_argument("-n", "--max-files", type=int, help="maximum number of files to read",
+                        default=100)
+    parser.add_argument("-r", "--repeats", type=int, help="number of timed passes, the best counts",
+                        default=3)
+    parser.add_argument("-b", "--backend", help="ijson backend to compare on (default: the one "
+                        "prepare-yle-for-turkunlp.py uses)")
+    parser.add_argument("-i", "--input-directory", help="YLE input directory", required=True)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    module = load_prepare_script()
+    if args.backend is not None:
+        module.ijson = ijson.get_backend(args.backend)
+    files = sorted(glob.glob(os.path.join(args.input_directory, "**", "*.json"),
+                             recursive=True))[:args.max_files]
+    megabytes = sum(os.path.getsize(file) for file in files) / 1024 / 1024
+    logging.disable(logging.ERROR)
+    try:
+        def reference(file: str) -> Iterator:
+            return reference_yield_articles(module, file)
+
+        def projected(file: str) -> Iterator:
+            return module.yield_articles(file, str)
+
+        mismatches = sum(reference_article != article for reference_article, article in zip(
+            read_all(reference, files), read_all(projected, files)))
+        results = {name: measure(yield_articles, files, args.repeats)
+                   for name, yield_articles in (('reference', reference), ('projected', projected))}
+    finally:
+        logging.disable(logging.NOTSET)
+    print(f"{len(files)} files, {megabytes:.2f} MB, backend {module.ijson.backend}, "
+          f"{mismatches} mismatches")
+    for name, (articles, seconds, peak) in results.items():
+        print(f"  {name:9} {articles} articles in {seconds:8.3f} s, "
+              f"{articles/max(seconds, 1e-9):10.1f} articles/s, peak memory {peak/1024/1024:8.2f} MB")
+    reference_seconds = results['reference'][1]
+    print(f"  speedup {reference_seconds/max(results['projected'][1], 1e-9):6.2f}x")
+    if mismatches > 0 or results['reference'][0] != results['projected'][0]:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import importlib.util
+import os
+
+CODE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATASETS = ('hs', 'il', 'stt', 'yle')
+
+
+def prepare_script(dataset: str) -> str:
+    return os.path.join(CODE_DIRECTORY, f"prepare-{dataset}-for-turkunlp.py")
+
+
+def load_prepare_script(dataset: str):
+    """Import code/prepare-{dataset}-for-turkunlp.py as a module."""
+    spec = importlib.util.spec_from_file_location(f"prepare_{dataset}_for_turkunlp",
+                                                  prepare_script(dataset))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
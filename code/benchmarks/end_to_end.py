@@ -0,0 +1,212 @@
+"""End-to-end runs of the prepare scripts on generated corpora (see generators): throughput as
+recorded in their run report, and a golden check that the chunks they write are byte-identical
+to those of a known-good version of the code, recorded in golden.json.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+from typing import Any, Optional
+
+from utils.compression import open_file, strip_compression
+from utils.metrics import entry_log, read_report
+from utils.section_index import INDEX_SUFFIX
+
+from benchmarks import CODE_DIRECTORY, DATASETS, prepare_script
+from benchmarks.generators import GENERATORS
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+# the corpus the golden digests are of, a small one with several chunks per dataset
+GOLDEN_CORPUS = {'articles': 600, 'seed': 1, 'scale': 0.5}
+GOLDEN_SPLIT = 50
+
+# the prepare script arguments checked, by name, and whether the chunks they write are
+# deterministic, or only the sections in them, spread over the chunks in the order the worker
+# processes happen to get to them. {work} is replaced with a scratch directory of the run.
+CONFIGURATIONS: dict[str, tuple[list[str], bool]] = {
+    'serial': (['-p', '1'], True),
+    'cache': (['-p', '1', '-c', '{work}/clean-text-cache.db'], True),
+    'gzip': (['-p', '1', '--compression', 'gzip'], True),
+    'zstd': (['-p', '1', '--compression', 'zstd'], True),
+    'pipeline': (['-p', '1', '--pipeline', '--readers', '1'], True),
+    'parallel': (['-p', '4'], True),
+    'pipeline-parallel': (['-p', '2', '--pipeline', '--readers', '2'], True),
+    'incremental': (['-p', '2', '--incremental'], False),
+    'pack': (['-p', '2'], True),
+    'pack-zstd': (['-p', '2'], True),
+}
+
+# the configurations that read the corpus from a pack written by pack-inputs.py, with the
+# compression of its records
+PACK_CONFIGURATIONS = {'pack': None, 'pack-zstd': 'zstd'}
+
+# the scripts that take --pipeline and --readers
+PIPELINE_DATASETS = ('stt', 'yle')
+# the extension of the input files of the datasets that can be packed, as hs is a single file
+PACK_EXTENSIONS = {'il': 'html', 'stt': 'xml', 'yle': 'json'}
+
+_SECTION_START = re.compile(r'^(?=###C: )', re.MULTILINE)
+
+
+def generate(output_directory: str, datasets: list[str], articles: int, seed: int = 1,
+             scale: float = 1.0) -> dict[str, str]:
+    """Generate a corpus for each of datasets under output_directory, returning a map from
+    dataset to its input directory."""
+    corpora = {}
+    for dataset in datasets:
+        corpora[dataset] = os.path.join(output_directory, dataset)
+        if os.path.exists(corpora[dataset]):
+            shutil.rmtree(corpora[dataset])
+        logging.info("Generating %d %s articles in %s.", articles, dataset, corpora[dataset])
+        GENERATORS[dataset](corpora[dataset], articles, seed, scale)
+    return corpora
+
+
+def run_prepare(dataset: str, input_directory: str, output_directory: str, arguments: list[str],
+                report: Optional[str] = None) -> None:
+    if os.path.exists(output_directory):
+        shutil.rmtree(output_directory)
+    command = [sys.executable, prepare_script(dataset), '-i', input_directory, '-o', output_directory,
+               *arguments]
+    if report is not None:
+        command += ['--metrics', report]
+    logging.info("Running %s.", ' '.join(command))
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+def pack(dataset: str, input_directory: str, pack_path: str, compression: Optional[str]) -> None:
+    if os.path.exists(pack_path):
+        shutil.rmtree(pack_path)
+    command = [sys.executable, os.path.join(CODE_DIRECTORY, 'pack-inputs.py'), '-i', input_directory,
+               '-o', pack_path, '-e', PACK_EXTENSIONS[dataset]]
+    if compression is not None:
+        command += ['--compression', compression]
+    logging.info("Running %s.", ' '.join(command))
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+def throughput(corpora: dict[str, str], work_directory: str, arguments: list[str]) -> list[dict[str, Any]]:
+    """Run the prepare script of each corpus with arguments, printing and returning the run
+    report entry of each."""
+    report = os.path.join(work_directory, 'report.json')
+    if os.path.exists(entry_log(report)):
+        os.remove(entry_log(report))
+    entries = []
+    for dataset, input_directory in corpora.items():
+        output_directory = os.path.join(work_directory, 'output', dataset)
+        run_prepare(dataset, input_directory, output_directory, arguments, report)
+        entry = read_report(report)['entries'][f'prepare-{dataset}-for-turkunlp:{output_directory}']
+        print(f"{dataset:4} {entry['articles']:8} articles, {entry['bytes_in']/1024/1024:8.2f} MB in "
+              f"{entry['wall_seconds']:8.2f} s ({entry['cpu_seconds']:8.2f} s CPU), "
+              f"{entry['articles_per_second']:10.1f} articles/s, "
+              f"{entry['bytes_in']/1024/1024/max(entry['wall_seconds'], 1e-9):8.2f} MB/s, "
+              f"peak RSS {entry['peak_rss_bytes']/1024/1024:6.0f} MB "
+              f"(+{entry['peak_rss_growth_bytes']/1024/1024:.0f} MB in the run)", flush=True)
+        entries.append(entry)
+    return entries
+
+
+def chunk_digests(output_directory: str) -> dict[str, str]:
+    """The SHA-256 of the uncompressed content of each chunk, by its uncompressed name."""
+    digests = {}
+    for name in sorted(os.listdir(output_directory)):
+        if name.startswith('chunk-') and not name.endswith(INDEX_SUFFIX):
+            digest = hashlib.sha256()
+            with open_file(os.path.join(output_directory, name), 'rb') as chunk_file:
+                for block in iter(lambda: chunk_file.read(1024 * 1024), b''):
+                    digest.update(block)
+            digests[strip_compression(name)] = digest.hexdigest()
+    return digests
+
+
+def sections_digest(output_directory: str) -> str:
+    """The SHA-256 of the sections in all chunks, in sorted order."""
+    sections = []
+    for name in sorted(os.listdir(output_directory)):
+        if name.startswith('chunk-') and not name.endswith(INDEX_SUFFIX):
+            with open_file(os.path.join(output_directory, name), 'r') as chunk_file:
+                sections.extend(section for section in _SECTION_START.split(chunk_file.read()) if section)
+    digest = hashlib.sha256()
+    for section in sorted(sections):
+        digest.update(section.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def golden_digests(corpora: dict[str, str], work_directory: str,
+                   configurations: list[str]) -> dict[str, dict[str, Any]]:
+    """The chunk and section digests of each dataset among corpora and configuration that
+    applies to it."""
+    digests = {}
+    for dataset, input_directory in corpora.items():
+        digests[dataset] = {}
+        for configuration in configurations:
+            arguments, _ = CONFIGURATIONS[configuration]
+            if '--pipeline' in arguments and dataset not in PIPELINE_DATASETS:
+                continue
+            if configuration in PACK_CONFIGURATIONS and dataset not in PACK_EXTENSIONS:
+                continue
+            scratch = os.path.join(work_directory, 'scratch', dataset, configuration)
+            os.makedirs(scratch, exist_ok=True)
+            output_directory = os.path.join(work_directory, 'output', dataset, configuration)
+            input_path = input_directory
+            if configuration in PACK_CONFIGURATIONS:
+                input_path = os.path.join(scratch, f'{dataset}.pack')
+                pack(dataset, input_directory, input_path, PACK_CONFIGURATIONS[configuration])
+            run_prepare(dataset, input_path, output_directory,
+                        ['-s', str(GOLDEN_SPLIT), *(argument.format(work=scratch) for argument in arguments)])
+            digests[dataset][configuration] = {'chunks': chunk_digests(output_directory),
+                                               'sections': sections_digest(output_directory)}
+    return digests
+
+
+def check_golden(work_directory: str, datasets: list[str], configurations: list[str],
+                 update: bool = False) -> int:
+    """Generate the golden corpus, prepare it with each configuration and compare the chunks to
+    those recorded in golden.json, or record them there if update is set. Return the number of
+    mismatching dataset and configuration pairs."""
+    if update and 'serial' not in configurations:
+        configurations = ['serial', *configurations]
+    corpora = generate(os.path.join(work_directory, 'input'), datasets, **GOLDEN_CORPUS)
+    digests = golden_digests(corpora, work_directory, configurations)
+    if update:
+        golden = {'corpus': GOLDEN_CORPUS, 'split': GOLDEN_SPLIT, 'datasets': {}}
+        if os.path.exists(GOLDEN_FILE):
+            with open(GOLDEN_FILE) as golden_file:
+                recorded = json.load(golden_file)
+            if recorded['corpus'] == GOLDEN_CORPUS and recorded['split'] == GOLDEN_SPLIT:
+                golden['datasets'] = recorded['datasets']
+        for dataset in DATASETS:
+            if dataset in digests:
+                # the exact configurations write the same chunks, so they are only recorded once
+                golden['datasets'][dataset] = {'chunks': digests[dataset]['serial']['chunks'],
+                                               'sections': digests[dataset]['serial']['sections']}
+        with open(GOLDEN_FILE, 'w') as golden_file:
+            json.dump(golden, golden_file, indent=1, sort_keys=True)
+            golden_file.write('\n')
+        logging.info("Recorded the golden digests of %s in %s.", ', '.join(digests), GOLDEN_FILE)
+    with open(GOLDEN_FILE) as golden_file:
+        golden = json.load(golden_file)
+    if golden['corpus'] != GOLDEN_CORPUS or golden['split'] != GOLDEN_SPLIT:
+        raise ValueError(f"{GOLDEN_FILE} is of a different corpus, update it with a known-good version")
+    mismatches = 0
+    for dataset, configuration_digests in digests.items():
+        expected = golden['datasets'][dataset]
+        for configuration, digest in configuration_digests.items():
+            _, exact = CONFIGURATIONS[configuration]
+            if exact:
+                differing = sorted(name for name in expected['chunks'].keys() | digest['chunks'].keys()
+                                   if expected['chunks'].get(name) != digest['chunks'].get(name))
+                ok = not differing
+            else:
+                differing = []
+                ok = expected['sections'] == digest['sections']
+            print(f"{dataset:4} {configuration:18} {'ok' if ok else 'MISMATCH'}"
+                  f"{' in ' + ', '.join(differing[:5]) if differing else ''}", flush=True)
+            mismatches += not ok
+    return mismatches
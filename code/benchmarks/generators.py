@@ -0,0 +1,164 @@
+"""Deterministic synthetic corpora in the input formats of the prepare scripts. The same seed,
+number of articles and scale always give byte-identical files, so that chunks prepared from them
+can be compared across code versions. The text mixes Finnish words with the markup, entities,
+Markdown and odd characters clean_text handles, and the articles include the optional and
+malformed parts the readers have to cope with (missing headlines and leads, galleries, images,
+non-string text).
+"""
+
+import csv
+import json
+import os
+import random
+from typing import Callable, Optional
+
+WORDS = ("Helsingin Sanomat kertoi että pääministeri joka oli hyvällä tuulella sanoi näin eduskunnassa "
+         "tiistaina Suomen hallitus päätti asiasta Yle uutisoi Iltalehti STT:n mukaan noin 12,5 "
+         "prosenttia vuonna 2019 Åland äänesti").split()
+
+FRAGMENTS = (
+    '<p>', '</p>', '<br />', '<li>', '</li>', '<ul>', '</ul>', '<span class="ndash">&ndash;</span>',
+    '<div class="quotes">&nbsp;</div>', '<div class="x"><div class="y"></div></div>', '<div id="a"></div>',
+    '<p class="imgplaceholder left">&nbsp;</p>', '<span class="pi_BlackSquare">&nbsp;</span>',
+    '<p class="videoplaceholder" data-id="1">&nbsp;</p>', '<iframe src="x"></iframe>',
+    '<blockquote>Lainaus\ntässä</blockquote>', '&nbsp;', '&#160;', '&nbps;', '&39;', '&amp;', '&bull; ',
+    '\xad', '\x95', '\x96', '\x94', ' ', '–', '—', '\\-', '•', '…', '“', '”', '’', '\xa0', ' ', '_',
+    '__', '*', '**', '# ', '\n# ', '[linkki](http://x.fi)', '\n-', '\n- ', '\n-  ', '\n- - ', '\n\n\n',
+    '\n', '<strong>', '</strong>', '<a href="x">', '</a>', '<h2>', '</h2>', '<', '>', '&', '\n&bull; ')
+
+# the share of tokens of text that are fragments rather than words
+FRAGMENT_RATE = 0.25
+
+
+class TextGenerator:
+    """Random text from a seeded generator, with lengths multiplied by scale."""
+
+    def __init__(self, seed: int, scale: float = 1.0):
+        self.random = random.Random(seed)
+        self.scale = scale
+
+    def length(self, low: int, high: int) -> int:
+        return max(1, round(self.random.randint(low, high) * self.scale))
+
+    def text(self, low: int, high: Optional[int] = None) -> str:
+        parts = []
+        for _ in range(self.length(low, high if high is not None else low)):
+            if self.random.random() < FRAGMENT_RATE:
+                parts.append(self.random.choice(FRAGMENTS))
+            else:
+                parts.append(self.random.choice(WORDS) + ' ')
+        return ''.join(parts)
+
+    def line(self, low: int, high: Optional[int] = None) -> str:
+        return self.text(low, high).replace('\n', ' ')
+
+
+def generate_hs(output_directory: str, articles: int, seed: int = 1, scale: float = 1.0) -> None:
+    """assets_output.csv with one asset per article, every tenth of them a gallery, which the
+    prepare script skips."""
+    text = TextGenerator(seed, scale)
+    os.makedirs(output_directory, exist_ok=True)
+    with open(os.path.join(output_directory, 'assets_output.csv'), 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['id', 'resourcetype', 'startdate', 'modifieddate', 'title', 'data', 'custom',
+                         'timestamp', 'nodeid', 'body', 'splitbody'])
+        for i in range(articles):
+            writer.writerow([f'hs{i}', 'article' if i % 10 else 'gallery', '2019-01-01 10:00:00',
+                             '2019-01-02 10:00:00', text.text(4, 12),
+                             json.dumps({'ingress': text.text(10, 40), 'tags': [i % 7]}), '', '',
+                             str(i), text.text(50, 1500), ''])
+
+
+def _il_body(text: TextGenerator) -> list:
+    nodes = [{'type': 'paragraph', 'items': [{'type': 'text', 'text': text.text(20, 100)}]}
+             for _ in range(text.length(1, 10))]
+    if text.random.random() < 0.5:
+        nodes.append({'type': 'list', 'items': [[{'type': 'text', 'text': text.text(3, 8)}]
+                                                for _ in range(text.length(1, 4))]})
+    if text.random.random() < 0.3:
+        nodes.append({'type': 'list-ordered', 'items': [[{'type': 'text', 'text': text.text(3, 8)}]
+                                                        for _ in range(text.length(1, 4))]})
+    if text.random.random() < 0.3:
+        nodes.insert(1, {'type': 'image', 'properties': {'caption': text.line(5)}})
+    return nodes
+
+
+def generate_il(output_directory: str, articles: int, seed: int = 1, scale: float = 1.0) -> None:
+    """Pages in a directory per year, with the article JSON embedded in the window.__STATE__
+    script and padding markup around it. Every third article has an empty lead."""
+    text = TextGenerator(seed, scale)
+    for i in range(articles):
+        year_directory = os.path.join(output_directory, str(2010 + i % 3))
+        os.makedirs(year_directory, exist_ok=True)
+        article = {'article_id': f'il{i}', 'title': text.text(4, 12),
+                   'lead': text.text(10, 30) if i % 3 else '', 'body': _il_body(text)}
+        with open(os.path.join(year_directory, f'il{i}.html'), 'w') as output_file:
+            output_file.write(
+                '<!DOCTYPE html>\n<html><head><title>Iltalehti</title><script>window.__STATE__='
+                '{"articles":{"' + article['article_id'] + '":' + json.dumps(article) +
+                f',"lastUpdated":{1500000000 + i}' + '}},"authorInfo":{}}</script></head>\n<body>' +
+                '<div class="page">' * text.length(50, 200) + '</div>' * 10 + '</body></html>\n')
+
+
+def generate_stt(output_directory: str, articles: int, seed: int = 1, scale: float = 1.0) -> None:
+    """Line-based NewsML files in a directory per year. Some have no headline, and some a
+    headline spanning lines."""
+    text = TextGenerator(seed, scale)
+    for i in range(articles):
+        year_directory = os.path.join(output_directory, str(2001 + i % 3))
+        os.makedirs(year_directory, exist_ok=True)
+        if i % 11 == 0:
+            headline = ''
+        elif i % 7 == 0:
+            headline = f'<headline>{text.line(3)}\n{text.line(3)}</headline>\n'
+        else:
+            headline = f'<headline>{text.line(3, 8)}</headline>\n'
+        body = ''.join(f'<p>{text.line(10, 60)}</p>\n' for _ in range(text.length(1, 8)))
+        with open(os.path.join(year_directory, f'stt{i}.xml'), 'w') as output_file:
+            output_file.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n<newsItem>\n<itemMeta>\n'
+                f'<versionCreated>{2001 + i % 3}-01-01T00:00:00</versionCreated>\n</itemMeta>\n'
+                f'<contentMeta>\n<urgency>{i % 5}</urgency>\n{headline}</contentMeta>\n'
+                f'<contentSet>\n<inlineXML>\n<html>\n{body}</html>\n</inlineXML>\n</contentSet>\n'
+                '</newsItem>\n')
+
+
+# the number of articles in each YLE file
+YLE_ARTICLES_PER_FILE = 400
+
+
+def _yle_article(text: TextGenerator, i: int) -> dict:
+    article = {'id': f'yle-{i}', 'language': 'fi' if i % 13 else 'sv',
+               'datePublished': f'{2011 + i % 8}-01-01T00:00:00+0200', 'url': {'full': f'https://yle.fi/{i}'}}
+    if i % 17:
+        article['headline'] = {'full': text.text(4, 10)}
+    if i % 5:
+        article['lead'] = text.text(10, 30)
+    article['subjects'] = [{'id': f'18-{j}', 'title': {'fi': text.line(1, 2)}} for j in range(i % 6)]
+    content = [{'type': 'text', 'text': text.text(20, 80)} for _ in range(text.length(1, 10))]
+    if i % 9 == 0:
+        content.insert(1, {'type': 'image', 'id': str(i), 'alt': text.line(3)})
+    if i % 23 == 0:
+        content.append({'type': 'feed', 'text': {'value': text.line(3)}})
+    article['content'] = content
+    return article
+
+
+def generate_yle(output_directory: str, articles: int, seed: int = 1, scale: float = 1.0) -> None:
+    """JSON files of the {"meta": ..., "data": [article, ...]} shape of the YLE API, with articles
+    missing their headline or lead, image content and content with non-string text."""
+    text = TextGenerator(seed, scale)
+    os.makedirs(output_directory, exist_ok=True)
+    for start in range(0, articles, YLE_ARTICLES_PER_FILE):
+        data = [_yle_article(text, i) for i in range(start, min(start + YLE_ARTICLES_PER_FILE, articles))]
+        with open(os.path.join(output_directory, f'yle-{start // YLE_ARTICLES_PER_FILE}.json'), 'w') as output_file:
+            json.dump({'meta': {'offset': start, 'limit': YLE_ARTICLES_PER_FILE, 'count': len(data)},
+                       'data': data}, output_file)
+
+
+GENERATORS: dict[str, Callable[..., None]] = {
+    'hs': generate_hs,
+    'il': generate_il,
+    'stt': generate_stt,
+    'yle': generate_yle,
+}
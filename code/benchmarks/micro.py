@@ -0,0 +1,159 @@
+"""Micro-benchmarks of the hot functions of the prepare scripts on a generated corpus (see
+generators), each timed as the best of a number of repeats over the same inputs.
+"""
+
+import glob
+import logging
+import os
+import time
+from typing import Any, Callable, Iterable
+
+from utils import fast_json
+from utils.clean_text import clean_text
+from utils.csv_ranges import read_range, record_ranges
+
+from benchmarks import load_prepare_script
+
+
+class Result:
+    name: str
+    items: int
+    bytes: int
+    seconds: float
+
+    def __init__(self, name: str, items: int, bytes: int, seconds: float):
+        self.name = name
+        self.items = items
+        self.bytes = bytes
+        self.seconds = seconds
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        return (f"{self.name:28} {self.items:8} items, {self.bytes/1024/1024:8.2f} MB in {self.seconds:8.3f} s, "
+                f"{self.items/seconds:10.1f} items/s, {self.bytes/1024/1024/seconds:8.2f} MB/s")
+
+
+def best_time(function: Callable[[Any], Any], inputs: Iterable[Any], repeat: int) -> float:
+    inputs = list(inputs)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in inputs:
+            function(value)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def files(input_directory: str, extension: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(input_directory, "**", f"*.{extension}"), recursive=True))
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as input_file:
+        return input_file.read()
+
+
+def clean_text_fields(corpora: dict[str, str]) -> list[str]:
+    """The raw strings the prepare scripts pass to clean_text for the given corpora, as a map
+    from dataset to input directory."""
+    fields = []
+
+    def capture(txt: str) -> str:
+        fields.append(txt)
+        return txt
+
+    for dataset, input_directory in corpora.items():
+        module = load_prepare_script(dataset)
+        if dataset == 'hs':
+            for _ in module.yield_articles(input_directory, capture):
+                pass
+        elif dataset == 'il':
+            for file in files(input_directory, 'html'):
+                module.yield_article(file, capture)
+        elif dataset == 'stt':
+            for file in files(input_directory, 'xml'):
+                module.yield_article(file, capture)
+        elif dataset == 'yle':
+            for file in files(input_directory, 'json'):
+                for article in module.yield_articles(file, capture):
+                    # the reader leaves the title and ingress to clean_article
+                    if article.title is not None:
+                        capture(article.title)
+                    if article.ingress is not None:
+                        capture(article.ingress)
+    return fields
+
+
+def benchmark_clean_text(corpora: dict[str, str], repeat: int) -> Result:
+    fields = clean_text_fields(corpora)
+    return Result('clean_text', len(fields), sum(len(field.encode('utf-8')) for field in fields),
+                  best_time(clean_text, fields, repeat))
+
+
+def benchmark_il(input_directory: str, repeat: int) -> list[Result]:
+    module = load_prepare_script('il')
+    pages = [read_bytes(file) for file in files(input_directory, 'html')]
+    article_jsons = [module.find_article_json(page) for page in pages]
+    article_jsons = [article_json for article_json in article_jsons if article_json is not None]
+    articles = [fast_json.loads(article_json) for article_json in article_jsons]
+
+    def parse_article_body(article: Any) -> str:
+        return ''.join(module.parse_body(node) for node in article['body'])
+
+    body_bytes = sum(len(parse_article_body(article).encode('utf-8')) for article in articles)
+    return [
+        Result('il find_article_json', len(pages), sum(len(page) for page in pages),
+               best_time(module.find_article_json, pages, repeat)),
+        Result('il fast_json.loads', len(article_jsons), sum(len(article_json) for article_json in article_jsons),
+               best_time(fast_json.loads, article_jsons, repeat)),
+        Result('il parse_body', len(articles), body_bytes, best_time(parse_article_body, articles, repeat)),
+    ]
+
+
+def benchmark_stt(input_directory: str, repeat: int) -> Result:
+    module = load_prepare_script('stt')
+    paths = files(input_directory, 'xml')
+    return Result('stt yield_article', len(paths), sum(os.path.getsize(path) for path in paths),
+                  best_time(lambda path: module.yield_article(path, str), paths, repeat))
+
+
+def benchmark_yle(input_directory: str, repeat: int) -> Result:
+    module = load_prepare_script('yle')
+    paths = files(input_directory, 'json')
+    articles = sum(1 for path in paths for _ in module.yield_articles(path, str))
+    return Result(f'yle yield_articles ({module.ijson.backend})', articles,
+                  sum(os.path.getsize(path) for path in paths),
+                  best_time(lambda path: sum(1 for _ in module.yield_articles(path, str)), paths, repeat))
+
+
+def benchmark_hs(input_directory: str, repeat: int) -> Result:
+    module = load_prepare_script('hs')
+    path = os.path.join(input_directory, 'assets_output.csv')
+    byte_ranges = record_ranges(path, module.RANGE_SIZE)
+    rows = sum(1 for start, end in byte_ranges for _ in read_range(path, start, end))
+    return Result('hs read_range', rows, os.path.getsize(path),
+                  best_time(lambda byte_range: sum(1 for _ in read_range(path, *byte_range)), byte_ranges, repeat))
+
+
+def run(corpora: dict[str, str], repeat: int) -> list[Result]:
+    """Run the micro-benchmarks of the datasets among corpora, a map from dataset to the input
+    directory of its generated corpus, printing and returning the results."""
+    results = []
+    logging.disable(logging.ERROR)
+    try:
+        benchmarks = [(lambda: [benchmark_clean_text(corpora, repeat)])]
+        if 'hs' in corpora:
+            benchmarks.append(lambda: [benchmark_hs(corpora['hs'], repeat)])
+        if 'il' in corpora:
+            benchmarks.append(lambda: benchmark_il(corpora['il'], repeat))
+        if 'stt' in corpora:
+            benchmarks.append(lambda: [benchmark_stt(corpora['stt'], repeat)])
+        if 'yle' in corpora:
+            benchmarks.append(lambda: [benchmark_yle(corpora['yle'], repeat)])
+        for benchmark in benchmarks:
+            for result in benchmark():
+                print(result, flush=True)
+                results.append(result)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
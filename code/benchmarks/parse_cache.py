@@ -0,0 +1,103 @@
+"""A check that the parses the parse cache (see utils.parse_cache) assembles are byte-identical to
+those of the parser run on the whole chunks, with fake-turkunlp-parser.py standing in for the
+parser: the chunks of the golden corpus are parsed through an empty cache, then again through the
+filled one, and each is also parsed on its own as the reference.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+from utils.compression import open_file
+from utils.parse_cache import ParseCache
+from utils.section_index import INDEX_SUFFIX
+
+from benchmarks import CODE_DIRECTORY
+from benchmarks.end_to_end import GOLDEN_CORPUS, GOLDEN_SPLIT, generate, run_prepare
+
+FAKE_PARSER = os.path.join(CODE_DIRECTORY, 'fake-turkunlp-parser.py')
+
+
+def parse(input_path: str, output_path: str) -> None:
+    with open_file(input_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
+        subprocess.run([sys.executable, FAKE_PARSER], stdin=input_file, stdout=output_file, check=True)
+
+
+def parse_through_cache(cache: ParseCache, chunk: str, scratch: str, output_path: str) -> bool:
+    """Parse chunk through cache as the workflow does, returning whether the parser was run."""
+    misses_path = os.path.join(scratch, 'misses.txt')
+    misses_parse_path = os.path.join(scratch, 'misses.conll')
+    run = cache.write_misses(chunk, misses_path)
+    if run:
+        parse(misses_path, misses_parse_path)
+        cache.store(misses_path, misses_parse_path)
+    cache.assemble(chunk, output_path)
+    return run
+
+
+def same_content(path: str, other_path: str) -> bool:
+    with open(path, 'rb') as file, open(other_path, 'rb') as other_file:
+        return file.read() == other_file.read()
+
+
+def _concatenate(paths: list[str], output_path: str) -> str:
+    with open(output_path, 'wb') as output_file:
+        for path in paths:
+            with open_file(path, 'rb') as input_file:
+                shutil.copyfileobj(input_file, output_file)
+    return output_path
+
+
+def passes(chunks: list[str], scratch: str) -> dict[str, list[str]]:
+    """The inputs parsed through the cache in turn, by pass: the even chunks through the empty
+    cache, each even chunk followed by the next one, so that the parses start with cached
+    paragraphs and go on with ones not cached yet, and all chunks and pairs of them the other way
+    round, which are all cached, but in other places."""
+    pairs = list(zip(chunks[::2], chunks[1::2]))
+    return {'cold': chunks[::2],
+            'partly cached': [_concatenate(pair, os.path.join(scratch, f'pair-{i}'))
+                              for i, pair in enumerate(pairs)],
+            'warm': chunks + [_concatenate(pair[::-1], os.path.join(scratch, f'reversed-{i}'))
+                              for i, pair in enumerate(pairs)]}
+
+
+def check(work_directory: str, datasets: list[str]) -> int:
+    """Prepare the golden corpus, parse its chunks through the parse cache in the passes above
+    and compare them to the chunks parsed on their own. Return the number of mismatching dataset
+    and pass pairs."""
+    corpora = generate(os.path.join(work_directory, 'input'), datasets, **GOLDEN_CORPUS)
+    scratch = os.path.join(work_directory, 'scratch')
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    mismatches = 0
+    for dataset, input_directory in corpora.items():
+        output_directory = os.path.join(work_directory, 'output', dataset)
+        run_prepare(dataset, input_directory, output_directory, ['-s', str(GOLDEN_SPLIT)])
+        dataset_scratch = os.path.join(scratch, dataset)
+        os.makedirs(dataset_scratch)
+        chunks = sorted(os.path.join(output_directory, name) for name in os.listdir(output_directory)
+                        if name.startswith('chunk-') and not name.endswith(INDEX_SUFFIX))
+        cache = ParseCache(os.path.join(dataset_scratch, 'parse-cache.db'), 'fake')
+        try:
+            for cache_pass, inputs in passes(chunks, dataset_scratch).items():
+                differing = []
+                parser_runs = 0
+                for input_path in inputs:
+                    full_path = os.path.join(dataset_scratch, 'full.conll')
+                    cached_path = os.path.join(dataset_scratch, 'cached.conll')
+                    parse(input_path, full_path)
+                    parser_runs += parse_through_cache(cache, input_path, dataset_scratch, cached_path)
+                    if not same_content(full_path, cached_path):
+                        differing.append(os.path.basename(input_path))
+                ok = not differing and (cache_pass != 'warm' or parser_runs == 0)
+                print(f"{dataset:4} {cache_pass:18} {'ok' if ok else 'MISMATCH'}"
+                      f"{' in ' + ', '.join(differing[:5]) if differing else ''}"
+                      f"{f', parser run {parser_runs} times' if cache_pass == 'warm' and parser_runs else ''}",
+                      flush=True)
+                mismatches += not ok
+        finally:
+            cache.close()
+    logging.info("Checked the parse cache on %s.", ', '.join(corpora))
+    return mismatches
@@ -0,0 +1,54 @@
+"""A check that the parses ParserPool (see utils.parser_pool) writes are byte-identical to those of
+the parser run on each chunk on its own, with fake-turkunlp-parser.py standing in for the parser:
+the chunks of the golden corpus are parsed by a pool of long-lived parsers, and by one that is
+restarted midway after a crash.
+"""
+
+import logging
+import os
+import shutil
+import sys
+
+from utils.parser_pool import ParserPool
+from utils.section_index import INDEX_SUFFIX
+
+from benchmarks.end_to_end import GOLDEN_CORPUS, GOLDEN_SPLIT, generate, run_prepare
+from benchmarks.parse_cache import FAKE_PARSER, parse, same_content
+
+# the pools checked, by name: the arguments of the fake parser, given a scratch directory
+POOLS = {
+    'pool': lambda scratch: [],
+    'pool-restart': lambda scratch: ['--fail-after', '500', '--fail-once', os.path.join(scratch, 'failed')],
+}
+
+
+def check(work_directory: str, datasets: list[str], workers: int = 2) -> int:
+    """Prepare the golden corpus, parse its chunks with each of POOLS and compare them to the
+    chunks parsed on their own. Return the number of mismatching dataset and pool pairs."""
+    corpora = generate(os.path.join(work_directory, 'input'), datasets, **GOLDEN_CORPUS)
+    scratch = os.path.join(work_directory, 'scratch')
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    mismatches = 0
+    for dataset, input_directory in corpora.items():
+        output_directory = os.path.join(work_directory, 'output', dataset)
+        run_prepare(dataset, input_directory, output_directory, ['-s', str(GOLDEN_SPLIT)])
+        chunks = sorted(name for name in os.listdir(output_directory)
+                        if name.startswith('chunk-') and not name.endswith(INDEX_SUFFIX))
+        full_directory = os.path.join(scratch, dataset, 'full')
+        os.makedirs(full_directory)
+        for chunk in chunks:
+            parse(os.path.join(output_directory, chunk), os.path.join(full_directory, f'{chunk}.conll'))
+        for pool_name, parser_arguments in POOLS.items():
+            pool_directory = os.path.join(scratch, dataset, pool_name)
+            os.makedirs(pool_directory)
+            pool = ParserPool([sys.executable, FAKE_PARSER, *parser_arguments(pool_directory)], workers)
+            pool.parse((os.path.join(output_directory, chunk), os.path.join(pool_directory, f'{chunk}.conll'))
+                       for chunk in chunks)
+            differing = [chunk for chunk in chunks if not same_content(
+                os.path.join(full_directory, f'{chunk}.conll'), os.path.join(pool_directory, f'{chunk}.conll'))]
+            print(f"{dataset:4} {pool_name:18} {'ok' if not differing else 'MISMATCH'}"
+                  f"{' in ' + ', '.join(differing[:5]) if differing else ''}", flush=True)
+            mismatches += bool(differing)
+    logging.info("Checked the parser pool on %s.", ', '.join(corpora))
+    return mismatches
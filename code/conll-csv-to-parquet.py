@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Script to convert CONLL-CSV files (as written by flopo-convert, optionally gzip or zstd
+compressed) into a single Parquet file for analytics, streaming with bounded memory. The integer
+columns are stored as integers and the low-cardinality columns dictionary-encoded. Each row group
+holds a range of whole documents, so that readers can skip to the documents they need by the row
+group statistics of the document id column.
+"""
+
+import argparse
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.parquet
+
+logging.basicConfig(level=logging.INFO)
+
+# the columns of CONLL-CSV by position, as the CONLL-CSV indexer reads them:
+# documentId,paragraphId,sentenceId,wordId,word,lemma,upos,xpos,feats,head,deprel,misc
+INTEGER_COLUMNS = (1, 2, 3, 9)
+DICTIONARY_COLUMNS = (6, 7, 8, 10)
+
+# read size of the CSV reader, the size of the batches rows are read in
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# a row group is written as soon as this many rows of whole documents have been read
+ROW_GROUP_ROWS = 1024 * 1024
+
+
+def read_header(path: str) -> list[str]:
+    with pa.input_stream(path) as input_file:
+        return pa.csv.open_csv(input_file, read_options=pa.csv.ReadOptions(
+            block_size=64 * 1024)).schema.names
+
+
+def parquet_schema(names: list[str]) -> pa.Schema:
+    return pa.schema([pa.field(name, pa.int32() if i in INTEGER_COLUMNS else
+                               pa.dictionary(pa.int32(), pa.string()) if i in DICTIONARY_COLUMNS else
+                               pa.string()) for i, name in enumerate(names)])
+
+
+def document_ids(ids: pa.ChunkedArray) -> pa.ChunkedArray:
+    """The documents of rows by their ids, which are of the form documentid_part, where the part
+    may itself contain underscores, so the ids are split at their first underscore, as the CONLL-CSV
+    indexer does.
+
+    >>> document_ids(pa.chunked_array([['3-123_body_0', '3-123_body_1', '3-124_headline_0']])).to_pylist()
+    ['3-123', '3-123', '3-124']
+    """
+    return pc.list_element(pc.split_pattern(ids, '_', max_splits=1), 0)
+
+
+def last_document_start(ids: pa.ChunkedArray) -> int:
+    """The index of the first row of the last document in ids.
+
+    >>> last_document_start(pa.chunked_array([['3-123_body_0', '3-124_body_0', '3-124_body_1']]))
+    1
+    """
+    documents = document_ids(ids)
+    others = pc.indices_nonzero(pc.not_equal(documents, documents[-1]))
+    return others[-1].as_py() + 1 if len(others) > 0 else 0
+
+
+def write_row_group(writer: pa.parquet.ParquetWriter, table: pa.Table) -> None:
+    for i in DICTIONARY_COLUMNS:
+        table = table.set_column(i, writer.schema.field(i), pc.dictionary_encode(table[i]))
+    writer.write_table(table, row_group_size=table.num_rows)
+
+
+def convert(inputs: list[str], output: str, row_group_rows: int = ROW_GROUP_ROWS) -> None:
+    """Convert CSV files with the same header into a Parquet file at output, keeping at most
+    about row_group_rows rows plus a read block in memory, unless a single document is larger."""
+    names = read_header(inputs[0])
+    schema = parquet_schema(names)
+    read_types = {name: pa.int32() if i in INTEGER_COLUMNS else pa.string()
+                  for i, name in enumerate(names)}
+    pending = []
+    pending_rows = 0
+    with pa.parquet.ParquetWriter(output + '.tmp', schema,
+                                  use_dictionary=[names[i] for i in DICTIONARY_COLUMNS]) as writer:
+        for input_path in inputs:
+            logging.info("Converting %s.", input_path)
+            reader = pa.csv.open_csv(pa.input_stream(input_path),
+                                     read_options=pa.csv.ReadOptions(block_size=BLOCK_SIZE),
+                                     convert_options=pa.csv.ConvertOptions(column_types=read_types))
+            if reader.schema.names != names:
+                raise ValueError(f"The header of {input_path} differs from that of {inputs[0]}")
+            for batch in reader:
+                pending.append(batch)
+                pending_rows += batch.num_rows
+                if pending_rows < row_group_rows:
+                    continue
+                # the last document may continue in the next batch
+                table = pa.Table.from_batches(pending)
+                start = last_document_start(table[0])
+                if start > 0:
+                    write_row_group(writer, table.slice(0, start))
+                    pending = table.slice(start).to_batches()
+                    pending_rows = table.num_rows - start
+        if pending_rows > 0:
+            write_row_group(writer, pa.Table.from_batches(pending))
+    os.replace(output + '.tmp', output)
+
+
+# %%
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert CONLL-CSV to Parquet")
+    parser.add_argument("-i", "--inputs", nargs='+', help="CONLL-CSV files, optionally .gz or .zst",
+                        required=True)
+    parser.add_argument("-o", "--output", help="output Parquet file", required=True)
+    parser.add_argument("--row-group-rows", type=int, help="minimum number of rows in a row group, "
+                        "except the last", default=ROW_GROUP_ROWS)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    convert(args.inputs, args.output, args.row_group_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,13 +8,15 @@ import logging
 import os
 import re
 
+from utils.input_files import InputFile, discover_input_files
+
 logging.basicConfig(level=logging.INFO)
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="STT XML to HTML converter")
     parser.add_argument("-o", "--output", help="Output directory", required=True)
-    parser.add_argument("input", help="Input STT XML files or directories", nargs="+")
+    parser.add_argument("input", help="Input STT XML files, directories or packs", nargs="+")
     return parser.parse_args()
 
 # %%
@@ -25,12 +27,13 @@ def main():
     os.makedirs(args.output, exist_ok=True)
     for input_spec in args.input:
         if os.path.isdir(input_spec):
-            input_glob = os.path.join(input_spec, "**", "*.xml")
+            # converted as the walk finds them, or in the order of the records of a pack
+            input_files = discover_input_files([input_spec], "xml")
         else:
-            input_glob = input_spec
-        for input_file_name in glob.glob(input_glob, recursive=True):
-            logging.info("Processing %s", input_file_name)
-            with open(input_file_name) as input_file, open(os.path.join(args.output, os.path.basename(input_file_name).replace(".xml", ".html")), 'w') as output_file:
+            input_files = (InputFile.from_path(path) for path in glob.glob(input_spec))
+        for source in input_files:
+            logging.info("Processing %s", source.name)
+            with source.open_text() as input_file, open(os.path.join(args.output, source.basename.replace(".xml", ".html")), 'w') as output_file:
                 output_file.write('<html><head><meta charset="UTF-8"></head>\n')
                 item_meta = []
                 content_meta = []
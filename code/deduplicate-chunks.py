@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Script to find the sections of the for-turkunlp chunks of one or more datasets that duplicate
+an earlier section, exactly or nearly, so that only one representative of each group of
+duplicates needs to be parsed. Writes, under the output directory, the chunks without their
+duplicates into for-turkunlp/{dataset} and the duplicates of each chunk, with their
+representatives, into duplicates/{dataset}/chunk-*.tsv, from which utils.dedup.fan_out gives
+each duplicate the parse of its representative.
+
+Exact duplicates are found by a hash of the text of the sections, near duplicates by MinHash
+signatures of their word shingles, bucketed by LSH bands. Sections are numbered in the order of
+the datasets given and of their chunks, and the representative of a group is its first section,
+so that datasets given first are preferred. The buckets are sharded to disk and processed in
+parallel, so that memory stays bounded by a few numbers per section.
+"""
+
+import argparse
+import array
+import bisect
+import glob
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+from typing import Iterator, Optional
+
+from utils.chunk_manifest import ChunkFile, estimate_tokens, save_chunk_sizes
+from utils.compression import compressed_name, compression_of, strip_compression
+from utils.dedup import (SUMMARY_FILE, Duplicate, band_keys, exact_digest, minhash, read_sections,
+                         section_text, similarity, write_duplicates)
+from utils.metrics import Metrics, finish_stage, path_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logging.basicConfig(level=logging.INFO)
+
+# a bucket record: the band (bands for the exact hash), the bucket key and the section number
+_BUCKET = struct.Struct('<BQQ')
+# a link between two sections: the first section of their bucket, the other one and whether
+# they are in an exact hash bucket
+_EDGE = struct.Struct('<QQB')
+# the number of records of a shard whose links are found at a time
+_BLOCK_RECORDS = 1024 * 1024
+_DIGEST_SIZE = 16
+
+_settings: dict = {}
+_chunks: list[tuple[str, str, str]] = []
+_offsets: list[int] = []
+
+
+def _init_worker(settings: dict, chunks: list[tuple[str, str, str]], offsets: list[int]) -> None:
+    global _settings, _chunks, _offsets
+    _settings = settings
+    _chunks = chunks
+    _offsets = offsets
+
+
+def chunk_name(path: str) -> str:
+    return re.fullmatch(r'chunk-(.+)\.txt', strip_compression(os.path.basename(path))).group(1)
+
+
+def ids_path(index: int) -> str:
+    return os.path.join(_settings['work'], 'ids', f'{index}.txt')
+
+
+def hash_chunk(index: int) -> tuple[int, bytes, bytes]:
+    """Hash the sections of a chunk, writing their ids to a file of their own. Returns the
+    number of sections, their exact digests and their signatures, empty for sections too short
+    for near duplicate detection."""
+    _, _, path = _chunks[index]
+    logging.info("Hashing %s...", path)
+    _, sections = read_sections(path)
+    num_perm = _settings['num_perm']
+    digests = bytearray()
+    signatures = bytearray()
+    with open(ids_path(index), 'w') as ids_file:
+        for id, section in sections:
+            ids_file.write(f'{id}\n')
+            text = section_text(section)
+            digests += exact_digest(text)
+            if not _settings['exact_only'] and len(text.split()) >= _settings['min_words']:
+                signatures += struct.pack(f'<{num_perm}I', *minhash(text, num_perm, _settings['shingle_words']))
+            else:
+                signatures += bytes(4 * num_perm)
+    return len(sections), bytes(digests), bytes(signatures)
+
+
+def _signature(signatures: mmap.mmap, number: int) -> tuple[int, ...]:
+    num_perm = _settings['num_perm']
+    return struct.unpack_from(f'<{num_perm}I', signatures, number * 4 * num_perm)
+
+
+def bucket_members(data: bytes) -> Iterator[tuple[int, int, int]]:
+    """The band, the first section and the section of each of the records of a shard that is
+    not the first of its bucket, by bucket. The records are sorted as a fixed-width array if
+    numpy is installed, and as one integer each otherwise."""
+    if numpy is not None:
+        records = numpy.frombuffer(data, dtype=[('band', 'u1'), ('key', '<u8'), ('number', '<u8')])
+        order = numpy.lexsort((records['number'], records['key'], records['band']))
+        bands, keys, numbers = records['band'][order], records['key'][order], records['number'][order]
+        del order
+        starts = numpy.ones(len(records), dtype=bool)
+        starts[1:] = (bands[1:] != bands[:-1]) | (keys[1:] != keys[:-1])
+        firsts = numbers[numpy.maximum.accumulate(numpy.where(starts, numpy.arange(len(records)), 0))]
+        del keys
+        members = numpy.flatnonzero(~starts)
+        for start in range(0, len(members), _BLOCK_RECORDS):
+            block = members[start:start + _BLOCK_RECORDS]
+            yield from zip(bands[block].tolist(), firsts[block].tolist(), numbers[block].tolist())
+        return
+    records = sorted(band << 128 | key << 64 | number for band, key, number in _BUCKET.iter_unpack(data))
+    bucket = None
+    for record in records:
+        if record >> 64 != bucket:
+            bucket, first = record >> 64, record & 0xFFFFFFFFFFFFFFFF
+            continue
+        yield record >> 128, first, record & 0xFFFFFFFFFFFFFFFF
+
+
+def find_edges(shard: str) -> tuple[str, int]:
+    """Link each section of each bucket of a shard to the first section of the bucket, if they
+    are exact duplicates or their signatures are similar enough. Writes the links as _EDGE
+    records into a file next to the shard, returning it and the number of links."""
+    with open(shard, 'rb') as shard_file:
+        data = shard_file.read()
+    os.remove(shard)
+    edges_path = shard + '.edges'
+    edges = 0
+    with open(os.path.join(_settings['work'], 'signatures.bin'), 'rb') as signatures_file, \
+            open(edges_path, 'wb') as edges_file:
+        signatures = None
+        first_signature = (None, None)
+        for band, first, number in bucket_members(data):
+            exact = band == _settings['bands']
+            if not exact:
+                if signatures is None:
+                    signatures = mmap.mmap(signatures_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if first_signature[0] != first:
+                    first_signature = (first, _signature(signatures, first))
+                if similarity(first_signature[1], _signature(signatures, number)) < _settings['threshold']:
+                    continue
+            edges_file.write(_EDGE.pack(first, number, exact))
+            edges += 1
+        if signatures is not None:
+            signatures.close()
+    return edges_path, edges
+
+
+def _find(parents: array.array, number: int) -> int:
+    root = number
+    while parents[root] != root:
+        root = parents[root]
+    while parents[number] != root:
+        parents[number], number = root, parents[number]
+    return root
+
+
+def chunk_ids(index: int, cache: dict[int, list[str]]) -> list[str]:
+    if index not in cache:
+        with open(ids_path(index)) as ids_file:
+            cache[index] = ids_file.read().split('\n')[:-1]
+    return cache[index]
+
+
+def write_chunk(task: tuple[int, list[tuple[int, int, float]]]) -> tuple[tuple[int, int, int, int, int],
+                                                                         Optional[dict[str, int]]]:
+    """Write a chunk without its duplicates, given by their position in the chunk, their
+    representative and their similarity to it, and its duplicate map. Returns the number of
+    sections, exact and near duplicates, and bytes of text read and written, and the size of
+    the chunk written, if any."""
+    index, duplicates = task
+    dataset, name, path = _chunks[index]
+    _, sections = read_sections(path)
+    positions = {position: (representative, score) for position, representative, score in duplicates}
+    output_path = os.path.join(_settings['output'], 'for-turkunlp', dataset, os.path.basename(path))
+    map_path = os.path.join(_settings['output'], 'duplicates', dataset, f'chunk-{name}.tsv')
+    kept = [section for position, (_, section) in enumerate(sections) if position not in positions]
+    size = None
+    if kept:
+        output = ChunkFile(output_path, incremental=True)
+        for section in kept:
+            output.write(section)
+        output.close()
+        size = {'bytes': os.path.getsize(output_path), 'tokens': sum(estimate_tokens(section) for section in kept)}
+    elif os.path.exists(output_path):
+        # a chunk of duplicates only is not parsed
+        os.remove(output_path)
+    ids = {}
+    mapped = []
+    for position, (representative, score) in sorted(positions.items()):
+        representative_index = bisect.bisect_right(_offsets, representative) - 1
+        representative_dataset, representative_chunk, _ = _chunks[representative_index]
+        mapped.append(Duplicate(sections[position][0], representative_dataset, representative_chunk,
+                                chunk_ids(representative_index, ids)[representative - _offsets[representative_index]],
+                                score))
+    write_duplicates(map_path, mapped)
+    exact = sum(1 for _, score in positions.values() if score == 1.0)
+    return (len(sections), exact, len(positions) - exact, sum(len(section.encode('utf-8')) for _, section in sections),
+            sum(len(section.encode('utf-8')) for section in kept)), size
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", nargs="+", required=True, metavar="DATASET=DIRECTORY",
+                        help="for-turkunlp directories of the datasets, in order of preference for the "
+                             "representatives")
+    parser.add_argument("-o", "--output-directory", help="output directory", required=True)
+    parser.add_argument("--threshold", type=float, default=0.9,
+                        help="estimated Jaccard similarity of word shingles over which sections are near "
+                             "duplicates")
+    parser.add_argument("--exact-only", action="store_true", help="only find exact duplicates")
+    parser.add_argument("--num-perm", type=int, default=64, help="size of the MinHash signatures")
+    parser.add_argument("--bands", type=int, default=8, help="number of LSH bands the signatures are split into")
+    parser.add_argument("--shingle-words", type=int, default=5, help="number of words in a shingle")
+    parser.add_argument("--min-words", type=int, default=20,
+                        help="minimum number of words in a section for near duplicate detection")
+    parser.add_argument("--shards", type=int, default=64, help="number of shards the LSH buckets are split into")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], help="compression of the chunks")
+    parser.add_argument("-p", "--processes", help="number of processes to use", type=int,
+                        default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    parser.add_argument("--metrics", help="JSON run report to record the metrics of the run in, "
+                        "with a Prometheus textfile next to it")
+    args = parser.parse_args()
+    if args.num_perm % args.bands != 0:
+        parser.error("--num-perm must be a multiple of --bands")
+    return args
+
+
+def settings_of(args: argparse.Namespace) -> dict:
+    """The settings the duplicates found depend on, recorded in the summary."""
+    return {'datasets': [input.split('=', 1)[0] for input in args.input], 'threshold': args.threshold,
+            'exact_only': args.exact_only, 'num_perm': args.num_perm, 'bands': args.bands,
+            'shingle_words': args.shingle_words, 'min_words': args.min_words, 'compression': args.compression}
+
+
+def main() -> None:
+    args = parse_arguments()
+    metrics = Metrics('deduplicate-chunks')
+    chunks = []
+    for input in args.input:
+        dataset, directory = input.split('=', 1)
+        # the chunks of a dataset in the order of the articles in them
+        paths = glob.glob(compressed_name(os.path.join(directory, 'chunk-*.txt'), args.compression))
+        paths.sort(key=lambda path: [int(part) if part.isdigit() else part
+                                     for part in re.split(r'(\d+)', chunk_name(path))])
+        chunks.extend((dataset, chunk_name(path), path) for path in paths)
+        metrics.bytes_in += sum(os.path.getsize(path) for path in paths)
+    work = os.path.join(args.output_directory, 'work')
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(os.path.join(work, 'ids'))
+    settings = dict(settings_of(args), work=work, output=args.output_directory)
+    # the number of the first section of each chunk, and after the last one
+    offsets = [0]
+    shards = [open(os.path.join(work, f'shard-{shard}.bin'), 'wb') for shard in range(args.shards)]
+    _init_worker(settings, chunks, offsets)
+    with open(os.path.join(work, 'digests.bin'), 'wb') as digests_file, \
+            open(os.path.join(work, 'signatures.bin'), 'wb') as signatures_file, \
+            multiprocessing.Pool(args.processes, _init_worker, (settings, chunks, offsets)) as pool:
+        for sections, digests, signatures in pool.imap(hash_chunk, range(len(chunks))):
+            digests_file.write(digests)
+            signatures_file.write(signatures)
+            for position in range(sections):
+                number = offsets[-1] + position
+                digest = digests[position * _DIGEST_SIZE:(position + 1) * _DIGEST_SIZE]
+                keys = [(args.bands, digest[:8])]
+                signature = struct.unpack_from(f'<{args.num_perm}I', signatures, position * 4 * args.num_perm)
+                if any(signature):
+                    keys.extend(enumerate(band_keys(signature, args.bands)))
+                for band, key in keys:
+                    key = int.from_bytes(key, 'little')
+                    shards[key % args.shards].write(_BUCKET.pack(band, key, number))
+            offsets.append(offsets[-1] + sections)
+    for shard in shards:
+        shard.close()
+    total = offsets[-1]
+    logging.info("Hashed %d sections of %d chunks, linking duplicates...", total, len(chunks))
+
+    # each section is linked to the earliest section it is (transitively) a duplicate of, and
+    # to the earliest section in its exact hash bucket
+    parents = array.array('q', range(total))
+    exact_firsts = array.array('q', range(total))
+    with multiprocessing.Pool(args.processes, _init_worker, (settings, chunks, offsets)) as pool:
+        for edges_path, _ in pool.imap_unordered(find_edges, [shard.name for shard in shards]):
+            with open(edges_path, 'rb') as edges_file:
+                for first, second, exact in _EDGE.iter_unpack(edges_file.read()):
+                    if exact:
+                        exact_firsts[second] = first
+                    first, second = _find(parents, first), _find(parents, second)
+                    if first != second:
+                        parents[max(first, second)] = min(first, second)
+            os.remove(edges_path)
+
+    def chunk_tasks():
+        # a section further from its representative than the threshold, by a chain of near
+        # duplicates, is parsed itself, unless it is an exact duplicate of an earlier section,
+        # which is then as far from the representative and parsed itself
+        with open(os.path.join(work, 'digests.bin'), 'rb') as digests_file, \
+                open(os.path.join(work, 'signatures.bin'), 'rb') as signatures_file:
+            digests = mmap.mmap(digests_file.fileno(), 0, access=mmap.ACCESS_READ) if total > 0 else b''
+            signatures = mmap.mmap(signatures_file.fileno(), 0, access=mmap.ACCESS_READ) if total > 0 else b''
+            for index in range(len(chunks)):
+                duplicates = []
+                for number in range(offsets[index], offsets[index + 1]):
+                    representative = _find(parents, number)
+                    if representative == number:
+                        continue
+                    digest = digests[number * _DIGEST_SIZE:(number + 1) * _DIGEST_SIZE]
+                    exact_first = exact_firsts[number]
+                    if digest == digests[representative * _DIGEST_SIZE:(representative + 1) * _DIGEST_SIZE]:
+                        score = 1.0
+                    else:
+                        score = similarity(_signature(signatures, number), _signature(signatures, representative))
+                        if score >= args.threshold:
+                            # not quite 1, which marks exact duplicates
+                            score = min(score, 0.999)
+                        elif exact_first != number and \
+                                digest == digests[exact_first * _DIGEST_SIZE:(exact_first + 1) * _DIGEST_SIZE]:
+                            representative, score = exact_first, 1.0
+                        else:
+                            continue
+                    duplicates.append((number - offsets[index], representative, score))
+                yield index, duplicates
+
+    for dataset in settings['datasets']:
+        os.makedirs(os.path.join(args.output_directory, 'for-turkunlp', dataset), exist_ok=True)
+        os.makedirs(os.path.join(args.output_directory, 'duplicates', dataset), exist_ok=True)
+    counts = [0, 0, 0, 0, 0]
+    sizes = {dataset: {} for dataset in settings['datasets']}
+    with multiprocessing.Pool(args.processes, _init_worker, (settings, chunks, offsets)) as pool:
+        for (dataset, _, path), (chunk_counts, size) in zip(chunks, pool.imap(write_chunk, chunk_tasks())):
+            counts = [count + chunk_count for count, chunk_count in zip(counts, chunk_counts)]
+            if size is not None:
+                sizes[dataset][os.path.basename(path)] = size
+    remove_stale_outputs(args.output_directory, chunks)
+    for dataset, dataset_sizes in sizes.items():
+        save_chunk_sizes(os.path.join(args.output_directory, 'for-turkunlp', dataset), dataset_sizes)
+    shutil.rmtree(work)
+
+    sections, exact, near, bytes_in, bytes_out = counts
+    with open(os.path.join(args.output_directory, SUMMARY_FILE + '.tmp'), 'w') as summary_file:
+        json.dump({'settings': settings_of(args), 'chunks': len(chunks), 'sections': sections,
+                   'exact_duplicates': exact, 'near_duplicates': near, 'bytes': bytes_in,
+                   'bytes_to_parse': bytes_out}, summary_file, indent=1)
+    os.replace(os.path.join(args.output_directory, SUMMARY_FILE + '.tmp'),
+               os.path.join(args.output_directory, SUMMARY_FILE))
+    logging.info("%d of %d sections are exact and %d near duplicates, leaving %.1f of %.1f MB to parse.",
+                 exact, sections, near, bytes_out / 1024 / 1024, bytes_in / 1024 / 1024)
+    metrics.bytes_out = path_size(os.path.join(args.output_directory, 'for-turkunlp'))
+    finish_stage(metrics, args.metrics, f'deduplicate-chunks:{args.output_directory}')
+
+
+def remove_stale_outputs(output_directory: str, chunks: list[tuple[str, str, str]]) -> None:
+    """Remove the chunks and duplicate maps of chunks that no longer exist or are compressed
+    otherwise, and the parses of chunks no longer to be parsed."""
+    current = {(dataset, os.path.basename(path)) for dataset, _, path in chunks}
+    names = {(dataset, name) for dataset, name, _ in chunks}
+    for output in glob.glob(os.path.join(output_directory, 'for-turkunlp', '*', 'chunk-*')):
+        if (os.path.basename(os.path.dirname(output)), os.path.basename(output)) not in current:
+            logging.info("Removing stale %s.", output)
+            os.remove(output)
+    for output in glob.glob(os.path.join(output_directory, 'duplicates', '*', 'chunk-*.tsv')):
+        if (os.path.basename(os.path.dirname(output)), os.path.basename(output)[6:-4]) not in names:
+            logging.info("Removing stale %s.", output)
+            os.remove(output)
+    for output in glob.glob(os.path.join(output_directory, 'conll', '*', 'chunk-*.conll*')):
+        chunk = re.sub(r'\.conll$', '.txt', strip_compression(os.path.basename(output)))
+        if not os.path.exists(compressed_name(os.path.join(
+                output_directory, 'for-turkunlp', os.path.basename(os.path.dirname(output)), chunk),
+                compression_of(output))):
+            logging.info("Removing stale %s.", output)
+            os.remove(output)
+
+
+if __name__ == '__main__':
+    main()
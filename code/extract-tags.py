@@ -1,44 +1,57 @@
 #!/usr/bin/env python3
 import argparse
-import csv
-import ctypes
+import functools
 import json
+import multiprocessing
 import os
 
 import regex
-
-
-def extract_tags(input_directory: str):
-    with open(os.path.join(input_directory, "assets_output.csv")) as assets_file:
-        csv.field_size_limit(int(ctypes.c_ulong(-1).value // 2))
-        csv_input = csv.reader(assets_file)
-        next(csv_input)
-        for row in csv_input:
-            # id,resourcetype,startdate,modifieddate,title,data,custom,timestamp,nodeid,body,splitbody
-            if row[1] == 'article':
-                title = row[4]
-                ingress = json.loads(row[5])['ingress']
-                body = row[9]
-                for match in regex.findall(r'</?[^>]*/?>|&\w+;', body):
-                    print(regex.sub(
-                        r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
-                for match in regex.findall(r'</?[^>]*/?>|&\w+;', ingress):
-                    print(regex.sub(
-                        r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
-                for match in regex.findall(r'</?[^>]*/?>|&\w+;', title):
-                    print(regex.sub(
-                        r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
+from utils.csv_ranges import read_range, record_ranges
+
+# assets_output.csv is split into byte ranges of about this size, processed in parallel
+RANGE_SIZE = 64 * 1024 * 1024
+
+
+def extract_tags(path: str, byte_range: tuple[int, int]) -> list[str]:
+    tags = []
+    start, end = byte_range
+    rows = read_range(path, start, end)
+    if start == 0:
+        next(rows)
+    for row in rows:
+        # id,resourcetype,startdate,modifieddate,title,data,custom,timestamp,nodeid,body,splitbody
+        if row[1] == 'article':
+            title = row[4]
+            ingress = json.loads(row[5])['ingress']
+            body = row[9]
+            for match in regex.findall(r'</?[^>]*/?>|&\w+;', body):
+                tags.append(regex.sub(
+                    r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
+            for match in regex.findall(r'</?[^>]*/?>|&\w+;', ingress):
+                tags.append(regex.sub(
+                    r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
+            for match in regex.findall(r'</?[^>]*/?>|&\w+;', title):
+                tags.append(regex.sub(
+                    r'id=\'autoresize[^\']*\'|["\']http[^"\']*["\']|["\']/[^"\']*["\']|data-id=["\'][^"\']*["\']', '', match))
+    return tags
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input-directory", help="input directory", required=True)
+    parser.add_argument("-p", "--processes", help="number of processes to use", type=int,
+                        default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
     return parser.parse_args()
 
 
 def main() -> None:
     args = parse_arguments()
-    extract_tags(args.input_directory)
+    path = os.path.join(args.input_directory, "assets_output.csv")
+    with multiprocessing.Pool(args.processes) as pool:
+        # imap keeps the tags in file order
+        for tags in pool.imap(functools.partial(extract_tags, path), record_ranges(path, RANGE_SIZE)):
+            for tag in tags:
+                print(tag)
 
 
 if __name__ == '__main__':
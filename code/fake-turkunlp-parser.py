@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Stand-in for the TurkuNLP parser container, for trying out the workflow and ParserPool without
+it: reads text from the standard input and writes one CONLL-U token per whitespace-separated word,
+in sentences ending at words ending in . ! or ?, with the # newdoc, # newpar, # sent_id and # text
+comments of the parser and passing ###C: lines through as it does
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+# the number of the last sentence written, which goes on through the input, and whether the
+# document has been started, with the first paragraph
+_sentences = 0
+_newdoc = False
+
+
+def sentence_conll(words: list[str]) -> str:
+    global _sentences
+    _sentences += 1
+    tokens = ''.join(f'{index}\t{word}\t{word.lower()}\tX\t_\t_\t0\troot\t_\t_\n'
+                     for index, word in enumerate(words, start=1))
+    return f'# sent_id = {_sentences}\n# text = {" ".join(words)}\n{tokens}\n'
+
+
+def conll(paragraph: list[str]) -> str:
+    global _newdoc
+    parts = ['# newpar\n'] if _newdoc else ['# newdoc\n', '# newpar\n']
+    _newdoc = True
+    sentence = []
+    for word in ' '.join(paragraph).split():
+        sentence.append(word)
+        if word.endswith(('.', '!', '?')):
+            parts.append(sentence_conll(sentence))
+            sentence = []
+    if sentence:
+        parts.append(sentence_conll(sentence))
+    return ''.join(parts)
+
+
+# %%
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Fake TurkuNLP parser")
+    parser.add_argument("--startup-delay", type=float, default=0,
+                        help="seconds to wait before reading, like the parser loading its models")
+    parser.add_argument("--buffer", action="store_true",
+                        help="write all output only at the end of the input")
+    parser.add_argument("--fail-after", type=int,
+                        help="exit with an error after reading this many lines, like a crashing parser")
+    parser.add_argument("--fail-once", metavar="FLAG_FILE",
+                        help="with --fail-after, only fail if FLAG_FILE does not exist, creating it, so "
+                        "that a restarted parser succeeds")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    time.sleep(args.startup_delay)
+    if args.fail_once is not None:
+        if os.path.exists(args.fail_once):
+            args.fail_after = None
+        else:
+            open(args.fail_once, 'w').close()
+    output = []
+    paragraph = []
+    for number, line in enumerate(sys.stdin, start=1):
+        if args.fail_after is not None and number > args.fail_after:
+            sys.exit(1)
+        line = line.rstrip('\n')
+        if line.startswith('###C:') or line == '':
+            if paragraph:
+                output.append(conll(paragraph))
+                paragraph = []
+            if line != '':
+                output.append(f'{line}\n')
+        else:
+            paragraph.append(line)
+        if not args.buffer:
+            sys.stdout.write(''.join(output))
+            sys.stdout.flush()
+            output = []
+    if paragraph:
+        output.append(conll(paragraph))
+    sys.stdout.write(''.join(output))
+
+
+if __name__ == '__main__':
+    main()
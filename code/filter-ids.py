@@ -4,45 +4,161 @@ import csv
 import glob
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import resource
+import shutil
+import tempfile
+import time
+from typing import BinaryIO, Container, Union
 
 import ijson.backends.yajl2_cffi as ijson
+from utils.id_index import IdIndex, is_id_index
+from utils.json_spans import items_with_spans
 
 logging.basicConfig(level=logging.INFO)
 
+_filter: Container[str] = frozenset()
+# the number of identifiers looked up in the filter by this process, and the time it took
+_lookups = [0, 0.0]
+
+
+def _init_worker(filter: Container[str]) -> None:
+    global _filter
+    _filter = filter
+
+
+def load_filter(path: str) -> Union[set[str], IdIndex]:
+    """The identifiers to filter out, from an ID index written by get-ids.py --index, which is
+    mapped and shared by the worker processes, or from a CSV, which is read into a set."""
+    if is_id_index(path):
+        return IdIndex(path)
+    filter = set()
+    with open(path) as input_file:
+        csv_input = csv.reader(input_file)
+        for row in csv_input:
+            filter.add(row[0])
+    return filter
+
+
+def keep(article: dict) -> bool:
+    year_published = int(article['datePublished'][:4])
+    start = time.perf_counter()
+    filtered = article['id'] in _filter
+    _lookups[0] += 1
+    _lookups[1] += time.perf_counter() - start
+    return not filtered and article['language'] == 'fi' and year_published < 2011
+
+
+def filter_articles(file: str, output_file: BinaryIO, separate: bool) -> tuple[int, int]:
+    """Write the kept articles of file re-serialized, separated by commas and preceded by one
+    if separate is set. Returns the number of articles kept and read."""
+    kept = 0
+    articles = 0
+    with open(file) as input_file:
+        for article in ijson.items(input_file, 'data.item', use_float=True):
+            articles += 1
+            if keep(article):
+                if separate or kept > 0:
+                    output_file.write(b",\n")
+                output_file.write(json.dumps(article).encode('utf-8'))
+                kept += 1
+    return kept, articles
+
+
+def filter_raw_articles(file: str, output_file: BinaryIO, separate: bool) -> tuple[int, int]:
+    """As filter_articles, but copying the kept articles byte for byte as they are written in
+    file, instead of re-serializing them. The file is memory mapped, and only a window of it is
+    decoded at a time."""
+    kept = 0
+    articles = 0
+    with open(file, 'rb') as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            raise ValueError(f"{file} is empty")
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for start, end, article in items_with_spans(buffer, 'data'):
+                articles += 1
+                if keep(article):
+                    if separate or kept > 0:
+                        output_file.write(b",\n")
+                    output_file.write(buffer[start:end])
+                    kept += 1
+    return kept, articles
+
+
+def filter_file(task: tuple[str, str, bool]) -> tuple[str, int, int, int, float]:
+    """Filter a file into a part file of its own, for a worker process. Returns the part file,
+    the number of articles kept and read, and the number of lookups in the filter and the time
+    they took."""
+    file, part, raw = task
+    logging.info("Processing %s...", file)
+    _lookups[:] = [0, 0.0]
+    with open(part, 'wb') as output_file:
+        kept, articles = (filter_raw_articles if raw else filter_articles)(file, output_file, False)
+    return part, kept, articles, _lookups[0], _lookups[1]
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input-directory", help="input directory", required=True)
-    parser.add_argument("-f", "--filter-csv", help="filter CSV", required=True)
+    parser.add_argument("-f", "--filter-csv", help="filter CSV, or ID index written by get-ids.py --index",
+                        required=True)
     parser.add_argument("-o", "--output", help="output json file", required=True)
+    parser.add_argument("--raw", action="store_true",
+                        help="copy the kept articles byte for byte from the input instead of decoding "
+                             "and re-serializing them")
+    parser.add_argument("-p", "--processes", help="number of input files to filter in parallel", type=int,
+                        default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
     return parser.parse_args()
 
 
 def main() -> None:
     args = parse_arguments()
-    filter = set()
-    with open(args.filter_csv) as input_file:
-        csv_input = csv.reader(input_file)
-        for row in csv_input:
-            filter.add(row[0])
-    logging.info("Filter has %d identifiers", len(filter))
-    with open(args.output, 'w') as output_file:
-        output_file.write('{ "data": [\n')
-        first = True
-        for file in glob.glob(os.path.join(args.input_directory, "**", "*.json"), recursive=True):
-            logging.info("Processing %s...", file)
-            with open(file) as input_file:
-                for article in ijson.items(input_file, 'data.item', use_float=True):
-                    year_published = int(article['datePublished'][:4])
-                    if article['id'] not in filter and article['language'] == 'fi' and year_published < 2011:
-                        if first is True:
-                            first = False
-                        else:
-                            output_file.write(",\n")
-                        output_file.write(json.dumps(article))
-
-        output_file.write(']}')
+    filter = load_filter(args.filter_csv)
+    logging.info("Filter has %d identifiers, %s, peak RSS %.0f MB", len(filter),
+                 f"an ID index of {filter.size / 1024 / 1024:.1f} MB" if isinstance(filter, IdIndex) else "a set",
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    files = glob.glob(os.path.join(args.input_directory, "**", "*.json"), recursive=True)
+    kept = 0
+    articles = 0
+    with open(args.output, 'wb') as output_file:
+        output_file.write(b'{ "data": [\n')
+        if args.processes <= 1:
+            _init_worker(filter)
+            for file in files:
+                logging.info("Processing %s...", file)
+                file_kept, file_articles = (filter_raw_articles if args.raw else filter_articles)(
+                    file, output_file, kept > 0)
+                kept += file_kept
+                articles += file_articles
+            lookups, lookup_seconds = _lookups
+        else:
+            # each file is filtered into a part file, and the parts are appended in order
+            parts = tempfile.mkdtemp(prefix='.filter-ids-', dir=os.path.dirname(os.path.abspath(args.output)))
+            try:
+                tasks = [(file, os.path.join(parts, f'{i}.json'), args.raw) for i, file in enumerate(files)]
+                with multiprocessing.Pool(args.processes, _init_worker, (filter,)) as pool:
+                    lookups, lookup_seconds = 0, 0.0
+                    for part, file_kept, file_articles, file_lookups, file_seconds in pool.imap(filter_file, tasks):
+                        if file_kept > 0:
+                            if kept > 0:
+                                output_file.write(b",\n")
+                            with open(part, 'rb') as part_file:
+                                shutil.copyfileobj(part_file, output_file)
+                        os.remove(part)
+                        kept += file_kept
+                        articles += file_articles
+                        lookups += file_lookups
+                        lookup_seconds += file_seconds
+            finally:
+                shutil.rmtree(parts)
+        output_file.write(b']}')
+    logging.info("Kept %d of %d articles, with %d lookups in the filter at %.0f lookups/s per process. "
+                 "Peak RSS %.0f MB%s.", kept, articles, lookups, lookups / max(lookup_seconds, 1e-9),
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 f", {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB in the largest worker"
+                 if args.processes > 1 else "")
 
 
 if __name__ == '__main__':
@@ -4,28 +4,84 @@ import csv
 import glob
 import logging
 import os
+import resource
+import time
+from typing import Iterator
 
 import ijson.backends.yajl2_cffi as ijson
+from utils.id_index import DEFAULT_BLOOM_BITS_PER_ID, DEFAULT_RUN_IDS, IdIndex, write_id_index
 
 logging.basicConfig(level=logging.INFO)
 
+# the number of IDs, and as many absent ones, looked up to measure the lookup rate of an index
+SAMPLE_LOOKUPS = 100000
+
+
+def read_ids(input_directory: str, csv_output, sample: list[str]) -> Iterator[str]:
+    """Yield the article IDs of the JSON files under input_directory, writing each to csv_output
+    and keeping the first SAMPLE_LOOKUPS of them in sample."""
+    for input_file_name in glob.glob(os.path.join(input_directory, "**", "*.json"), recursive=True):
+        logging.info("Processing %s...", input_file_name)
+        with open(input_file_name) as input_file:
+            for article_id in ijson.items(input_file, 'data.item.id'):
+                csv_output.writerow([article_id])
+                if len(sample) < SAMPLE_LOOKUPS:
+                    sample.append(str(article_id))
+                yield str(article_id)
+
+
+def report_index(path: str, sample: list[str], peak_rss: int) -> None:
+    """Log the size of the ID index at path and the peak RSS of writing it, and the rate of
+    lookups of the sample of IDs in it and of as many IDs not in it."""
+    index = IdIndex(path)
+    try:
+        rates = []
+        for lookups in (sample, [f'{id}\x01' for id in sample]):
+            start = time.perf_counter()
+            found = sum(1 for id in lookups if id in index)
+            rates.append(len(lookups) / max(time.perf_counter() - start, 1e-9))
+        logging.info("ID index of %d identifiers: %.1f MB, written with a peak RSS of %.1f MB, Bloom filter "
+                     "of %d bits, %.0f lookups/s of present and %.0f lookups/s of absent identifiers.",
+                     len(index), index.size / 1024 / 1024, peak_rss / 1024 / 1024, index.bloom_bits,
+                     rates[0], rates[1])
+        if found != 0:
+            logging.warning("%d absent identifiers were found in the index.", found)
+    finally:
+        index.close()
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input-directory", help="input directory", required=True)
-    parser.add_argument("-o", "--output", help="output CSV", required=True)
-    return parser.parse_args()
+    parser.add_argument("-o", "--output", help="output CSV")
+    parser.add_argument("--index", help="output ID index, a compact sorted table of the identifiers that "
+                                        "filter-ids.py can map in place of the CSV")
+    parser.add_argument("--bloom-bits-per-id", type=int, default=DEFAULT_BLOOM_BITS_PER_ID,
+                        help="size of the Bloom filter in front of the ID index, 0 for none")
+    parser.add_argument("--run-ids", type=int, default=DEFAULT_RUN_IDS,
+                        help="number of identifiers sorted in memory at a time while writing the ID index")
+    args = parser.parse_args()
+    if args.output is None and args.index is None:
+        parser.error("one of -o/--output and --index is required")
+    return args
 
 
 def main() -> None:
     args = parse_arguments()
-    with open(args.output, 'w') as output_file:
-        csv_output = csv.writer(output_file)
-        for input_file_name in glob.glob(os.path.join(args.input_directory, "**", "*.json"), recursive=True):
-            logging.info("Processing %s...", input_file_name)
-            with open(input_file_name) as input_file:
-                for article_id in ijson.items(input_file, 'data.item.id'):
-                    csv_output.writerow([article_id])
+    sample = []
+    with open(args.output if args.output is not None else os.devnull, 'w') as output_file:
+        ids = read_ids(args.input_directory, csv.writer(output_file), sample)
+        if args.index is None:
+            for _ in ids:
+                pass
+        else:
+            count = write_id_index(args.index, ids, args.bloom_bits_per_id, args.run_ids)
+    if args.index is not None:
+        # ru_maxrss is in kilobytes on Linux, the peak of this process, which is that of reading
+        # the IDs and writing the index, as the lookups come after it
+        peak_rss = 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logging.info("Wrote %d distinct identifiers to %s.", count, args.index)
+        report_index(args.index, sample, peak_rss)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ import shutil
 from abc import ABCMeta, abstractmethod
 
 import luigi
+from utils.metrics import REPORT_VARIABLE, Metrics, finish_stage, path_size
 
 
 class ForceableTask(luigi.Task):
@@ -18,13 +19,21 @@ class ForceableTask(luigi.Task):
             self.remove_outputs()
 
     def remove_outputs(self):
-        for out in self.output():
+        for out in luigi.task.flatten(self.output()):
             if out.exists():
                 if out.isdir():
                     shutil.rmtree(out.path)
                 else:
                     os.remove(out.path)
 
+    def metrics_inputs(self) -> list[str]:
+        """Paths whose size counts as the bytes the task reads."""
+        return [target.path for target in luigi.task.flatten(self.input()) if hasattr(target, 'path')]
+
+    def metrics_articles(self) -> int:
+        """The number of articles the task processed, where known."""
+        return 0
+
     @abstractmethod
     def run_internal(self):
         raise NotImplementedError()
@@ -40,3 +49,33 @@ class ForceableTask(luigi.Task):
             logging.exception("Encountered an exception while running task.")
             self.remove_outputs()
             raise
+
+
+@ForceableTask.event_handler(luigi.Event.START)
+def start_metrics(task: ForceableTask) -> None:
+    # a task with dynamic dependencies starts again once they are done
+    task.metrics = Metrics(task.get_task_family())
+
+
+def finish_metrics(task: ForceableTask, status: str) -> None:
+    """Attach the metrics of the task to it as metrics_entry, and record them in the run report
+    of the workflow, if any."""
+    metrics = getattr(task, 'metrics', None)
+    if metrics is None:
+        return
+    metrics.articles = task.metrics_articles()
+    metrics.bytes_in = sum(path_size(path) for path in task.metrics_inputs())
+    metrics.bytes_out = sum(path_size(target.path) for target in luigi.task.flatten(task.output())
+                            if hasattr(target, 'path'))
+    task.metrics_entry = finish_stage(metrics, os.environ.get(REPORT_VARIABLE), task.task_id,
+                                      status=status)
+
+
+@ForceableTask.event_handler(luigi.Event.SUCCESS)
+def record_success_metrics(task: ForceableTask) -> None:
+    finish_metrics(task, 'success')
+
+
+@ForceableTask.event_handler(luigi.Event.FAILURE)
+def record_failure_metrics(task: ForceableTask, exception: BaseException) -> None:
+    finish_metrics(task, 'failure')
@@ -0,0 +1,34 @@
+from typing import Optional
+
+import luigi.format
+from luigi.format import Format, InputPipeProcessWrapper, OutputPipeProcessWrapper
+
+
+class ZstdFormat(Format):
+    """zstd counterpart of luigi.format.GzipFormat."""
+    input = 'bytes'
+    output = 'bytes'
+
+    def __init__(self, compression_level: Optional[int] = None):
+        self.compression_level = compression_level
+
+    def pipe_reader(self, input_pipe):
+        return InputPipeProcessWrapper(['zstd', '-dcq'], input_pipe)
+
+    def pipe_writer(self, output_pipe):
+        args = ['zstd', '-cq']
+        if self.compression_level is not None:
+            args.append('-' + str(int(self.compression_level)))
+        return OutputPipeProcessWrapper(args, output_pipe)
+
+
+Zstd = ZstdFormat()
+
+
+def compression_format(compression: Optional[str]) -> Format:
+    """The binary Luigi target format of files compressed with compression (gzip, zstd or None)."""
+    if compression == 'gzip':
+        return luigi.format.Gzip
+    if compression == 'zstd':
+        return Zstd
+    return luigi.format.Nop
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Script to pack the small input files of a dataset, such as the NewsML files of STT or the pages
+of IL, into a pack: a few large data files with an index, which the prepare scripts read as
+input in place of the directory, without opening a file for each article. Packing into an
+existing pack only appends the files that are new or changed since it was last packed.
+"""
+
+import argparse
+import logging
+import multiprocessing.pool
+import os
+import zlib
+
+from utils.compression import compress
+from utils.input_files import InputFile, discover_input_files, read_tar_members, tar_inputs
+from utils.pack import DEFAULT_MAX_BYTES, INDEX_FILE, PACK_SUFFIX, PackWriter, read_pack
+from utils.work_queue import sort_largest_first
+
+logging.basicConfig(level=logging.INFO)
+
+
+def member_name(input_path: str, input_file: InputFile) -> str:
+    """The name of a file in the pack: its path in the input directory, or its name in the archive."""
+    return input_file.member if input_file.member is not None else os.path.relpath(input_file.name, input_path)
+
+
+def read_file(item: tuple[str, InputFile, str]) -> tuple[str, InputFile, bytes, int, bytes]:
+    member, input_file, compression = item
+    data = input_file.read()
+    return member, input_file, data, zlib.crc32(data), compress(data, compression)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input-directory", help="input directories or tar/zip archives", nargs="+",
+                        required=True)
+    parser.add_argument("-o", "--output", help=f"pack to create or append to (ending in {PACK_SUFFIX})",
+                        required=True)
+    parser.add_argument("-e", "--extension", help="extension of the files to pack, such as xml or html",
+                        required=True)
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress each file in the pack with gzip or zstd")
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="maximum size of each data file of the pack in bytes")
+    parser.add_argument("--keep-missing", action="store_true",
+                        help="keep the files packed before that are no longer in the inputs")
+    parser.add_argument("-t", "--threads", type=int, default=16,
+                        help="number of threads reading input files, which on network storage mostly wait")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    if not args.output.rstrip(os.sep).endswith(PACK_SUFFIX):
+        raise ValueError(f"The name of the pack {args.output} does not end in {PACK_SUFFIX}")
+    packed = {record.member: record for record in read_pack(args.output)} \
+        if os.path.exists(os.path.join(args.output, INDEX_FILE)) else {}
+    tar_archives = tar_inputs(args.input_directory)
+    writer = PackWriter(args.output, args.compression, args.max_bytes)
+    seen = set()
+    added = 0
+    removed = 0
+
+    def changed(member: str, input_file: InputFile) -> bool:
+        seen.add(member)
+        record = packed.get(member)
+        return record is None or record.size != input_file.size or record.mtime_ns != input_file.mtime_ns
+
+    def files():
+        for input_path in args.input_directory:
+            if input_path not in tar_archives:
+                for input_file in discover_input_files([input_path], args.extension):
+                    member = member_name(input_path, input_file)
+                    if changed(member, input_file):
+                        yield member, input_file, args.compression
+
+    try:
+        # files are read ahead on threads, but packed largest first within each window of them,
+        # the order the prepare scripts hand out the files of a directory in, so that they can
+        # hand out the records of the pack in its order, as ranges of it
+        with multiprocessing.pool.ThreadPool(args.threads) as pool:
+            for member, input_file, data, crc, compressed in pool.imap(read_file, sort_largest_first(
+                    files(), key=lambda item: (item[1].size, item[1].name)), chunksize=16):
+                writer.add(member, data, input_file.mtime_ns, crc, compressed)
+                added += 1
+        # the content of tar members is read as they stream past
+        for archive in tar_archives:
+            for input_file in read_tar_members(archive, args.extension):
+                if changed(input_file.member, input_file):
+                    writer.add(input_file.member, input_file.data, input_file.mtime_ns, zlib.crc32(input_file.data))
+                    added += 1
+        if not args.keep_missing:
+            for member in packed.keys() - seen:
+                writer.remove(member)
+                removed += 1
+    finally:
+        writer.close()
+    logging.info("Packed %d new or changed files into %s, %d unchanged, %d removed.", added, args.output,
+                 len(seen) - added, removed)
+
+
+if __name__ == '__main__':
+    main()
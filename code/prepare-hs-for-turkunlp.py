@@ -3,16 +3,26 @@
 """
 
 import argparse
-import csv
-import ctypes
+import functools
 import json
 import logging
+import multiprocessing
 import os
+from typing import Any, Callable, Optional
 
+from utils.chunk_manifest import ChunkManifest, ChunkWriter, save_chunk_sizes
 from utils.clean_text import clean_text
+from utils.clean_text_cache import DEFAULT_MAX_SIZE, CleanTextCache, finish_run
+from utils.csv_ranges import read_range, record_ranges
+from utils.metrics import Metrics, finish_stage, worker_name
 
 logging.basicConfig(level=logging.INFO)
 
+# assets_output.csv is split into byte ranges of about this size, processed in parallel
+RANGE_SIZE = 64 * 1024 * 1024
+
+STAGE = os.path.splitext(os.path.basename(__file__))[0]
+
 # %%
 
 
@@ -29,48 +39,65 @@ class Article:
         self.body = body
 
 
-def yield_articles(input_directory: str):
-    with open(os.path.join(input_directory, "assets_output.csv")) as input_file:
-        csv.field_size_limit(int(ctypes.c_ulong(-1).value // 2))
-        csv_input = csv.reader(input_file)
-        next(csv_input)
-        for row in csv_input:
+def yield_articles(input_directory: str, clean: Callable[[str], str] = clean_text,
+                   byte_ranges: Optional[list[tuple[int, int]]] = None):
+    path = os.path.join(input_directory, "assets_output.csv")
+    if byte_ranges is None:
+        byte_ranges = record_ranges(path, RANGE_SIZE)
+    for start, end in byte_ranges:
+        rows = read_range(path, start, end)
+        if start == 0:
+            next(rows)
+        for row in rows:
             # id,resourcetype,startdate,modifieddate,title,data,custom,timestamp,nodeid,body,splitbody
             if row[1] == 'article':
                 id = row[0]
-                title = clean_text(row[4])
-                ingress = clean_text(json.loads(row[5])['ingress'])
-                body = clean_text(row[9])
+                title = clean(row[4])
+                ingress = clean(json.loads(row[5])['ingress'])
+                body = clean(row[9])
                 yield Article(id, title, ingress, body)
 
 
-def process(input_directory: str, output_directory: str, split: int):
-    os.makedirs(output_directory, exist_ok=True)
-    i = 0
-    current_output = None
+def process(input_directory: str, new_chunk_writer: Callable[..., ChunkWriter], cache: Optional[str],
+            incremental: bool, byte_range: tuple[int, tuple[int, int]]) -> tuple[int, int, dict[str, dict[str, int]], dict[str, Any]]:
+    prefix, (start, end) = byte_range
+    metrics = Metrics(STAGE, f'{worker_name()}/{prefix}')
+    metrics.bytes_in = end - start
+    output = new_chunk_writer(prefix, incremental=incremental)
+    clean_text_cache = CleanTextCache(cache)
     try:
-        for article in yield_articles(input_directory):
-            if i % split == 0:
-                if current_output is not None:
-                    current_output.close()
-                logging.info("Creating chunk %d.", i)
-                current_output = open(os.path.join(output_directory, f"chunk-{i}.txt"), "w")
+        for article in yield_articles(input_directory, clean_text_cache.clean_text, [(start, end)]):
+            sections = []
             if article.title != '':
-                current_output.write(f'###C: {article.id}_title\n')
-                current_output.write(article.title)
-                current_output.write('\n\n')
+                sections.append((f'{article.id}_title', article.title))
             if article.ingress != '':
-                current_output.write(f'###C: {article.id}_ingress\n')
-                current_output.write(article.ingress)
-                current_output.write('\n\n')
+                sections.append((f'{article.id}_ingress', article.ingress))
             if article.body != '':
-                current_output.write(f'###C: {article.id}_body\n')
-                current_output.write(article.body)
-                current_output.write('\n\n')
-            i += 1
+                sections.append((f'{article.id}_body', article.body))
+            output.write_article(sections)
     finally:
-        if current_output is not None:
-            current_output.close()
+        output.close()
+        clean_text_cache.close()
+    metrics.count_chunks(output.chunks)
+    return clean_text_cache.hits, clean_text_cache.misses, output.chunks, metrics.finish()
+
+
+def process_ranges(args: argparse.Namespace, incremental: bool) -> tuple[dict[str, dict[str, int]], list[dict[str, Any]]]:
+    """Process the byte ranges of assets_output.csv in parallel, each into its own chunks
+    prefixed with the range number, returning the sizes of the chunks and the metrics of each
+    range."""
+    new_chunk_writer = functools.partial(ChunkWriter, args.output_directory, split=args.split,
+                                         max_bytes=args.max_bytes, max_tokens=args.max_tokens,
+                                         compression=args.compression)
+    byte_ranges = record_ranges(os.path.join(args.input_directory, "assets_output.csv"), RANGE_SIZE)
+    with multiprocessing.Pool(args.processes) as pool:
+        results = list(pool.imap_unordered(functools.partial(
+            process, args.input_directory, new_chunk_writer, args.cache, incremental), enumerate(byte_ranges)))
+    finish_run(args.cache, args.cache_size, [(hits, misses) for hits, misses, _, _ in results])
+    chunks = {}
+    for _, _, range_chunks, _ in results:
+        chunks.update(range_chunks)
+    return chunks, [range_metrics for _, _, _, range_metrics in results]
 
 
 # process("/Users/jiemakel/tyo/flopo-data-pipeline/data/input/hs_sample","/Users/jiemakel/tyo/flopo-data-pipeline/data/processed/hs_sample", 500)
@@ -80,15 +107,51 @@ def process(input_directory: str, output_directory: str, split: int):
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--split", type=int,
-                        help="number of articles to put in each file", default=5000)
+                        help="maximum number of articles to put in each file", default=5000)
+    parser.add_argument("--max-bytes", type=int,
+                        help="maximum size of each file in bytes, unless a single article is larger")
+    parser.add_argument("--max-tokens", type=int,
+                        help="maximum estimated number of tokens in each file, unless a single article has more")
     parser.add_argument("-i", "--input-directory", help="input directory", required=True)
     parser.add_argument("-o", "--output-directory", help="output directory", required=True)
+    parser.add_argument("-p", "--processes", help="number of processes to use", type=int,
+                        default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    parser.add_argument("-c", "--cache", help="clean text cache file (on a local disk)")
+    parser.add_argument("--cache-size", type=int, help="maximum size of the clean text cache in bytes",
+                        default=DEFAULT_MAX_SIZE)
+    parser.add_argument("--incremental", action="store_true",
+                        help="only rebuild the chunks if the input file changed since the last run")
+    parser.add_argument("--hash", action="store_true",
+                        help="in incremental mode, compare content hashes of files whose mtime changed")
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress the chunks with gzip or zstd")
+    parser.add_argument("--metrics", help="JSON run report to record the metrics of the run in, "
+                        "with a Prometheus textfile next to it")
     return parser.parse_args()
 
 
 def main() -> None:
     args = parse_arguments()
-    process(args.input_directory, args.output_directory, args.split)
+    metrics = Metrics(STAGE)
+    os.makedirs(args.output_directory, exist_ok=True)
+    if not args.incremental:
+        chunks, workers = process_ranges(args, False)
+        save_chunk_sizes(args.output_directory, chunks)
+        finish_stage(metrics, args.metrics, f'{STAGE}:{args.output_directory}', workers)
+        return
+    # all articles are in a single file, so it is either rebuilt as a whole or not at all. Chunks
+    # with the same content as before are still left untouched.
+    manifest = ChunkManifest(args.output_directory, __file__, args.split, 1, args.hash,
+                             args.max_bytes, args.max_tokens, args.compression)
+    chunks = {}
+    workers = []
+    for group, _ in manifest.plan([os.path.join(args.input_directory, "assets_output.csv")]):
+        chunks, workers = process_ranges(args, True)
+        manifest.record(group, list(chunks))
+    manifest.remove_stale_chunks()
+    manifest.save()
+    save_chunk_sizes(args.output_directory, chunks, update=True)
+    finish_stage(metrics, args.metrics, f'{STAGE}:{args.output_directory}', workers)
 
 
 if __name__ == '__main__':
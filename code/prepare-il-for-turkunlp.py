@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 """Script to parse IL into the TurkuNLP input format
 """
-import glob
-import functools
-import multiprocessing
-import itertools
 import argparse
 import os
 import logging
-import json
-from typing import Optional,Any
+import mmap
+import time
+from typing import Optional,Any,Callable,Union
 import regex
+from utils import fast_json
+from utils.chunk_manifest import ChunkWriter
 from utils.clean_text import clean_text
+from utils.clean_text_cache import DEFAULT_MAX_SIZE
+from utils.input_files import InputFile, as_input_file
+from utils.work_queue import prepare
 
 logging.basicConfig(level=logging.INFO)
 
@@ -29,72 +31,110 @@ class Article:
         self.ingress = ingress
         self.body = body
 
-def parse_body(node: Any) -> str:
-    content = node['text'] if 'text' in node else ''
+def _append_body(node: Any, parts: list[str]) -> None:
+    if 'text' in node:
+        parts.append(node['text'])
     if node['type']=='list':
         for entry in node['items']:
-            content += '\n * '
+            parts.append('\n * ')
             for child in entry:
-                content += parse_body(child)
-        content += '\n'
+                _append_body(child, parts)
+        parts.append('\n')
     elif node['type']=='list-ordered':
         for index,entry in enumerate(node['items']):
-            content += f'\n {index+1}. '
+            parts.append(f'\n {index+1}. ')
             for child in entry:
-                content += parse_body(child)
-        content += '\n'        
+                _append_body(child, parts)
+        parts.append('\n')
     elif 'items' in node:
         for child in node['items']:
-            content += parse_body(child)
+            _append_body(child, parts)
     #if node['type']=='image' and 'caption' in node['properties']:
     #    str += node['properties']['caption']+'\n\n'
     if node['type'] == 'paragraph':
-        content += '\n\n'
-    return content
+        parts.append('\n\n')
+
+def parse_body(node: Any) -> str:
+    parts = []
+    _append_body(node, parts)
+    return ''.join(parts)
+
+_ARTICLE_JSON_START = b'{"article_id":'
+_ARTICLE_JSON_END_MARKER = b',"lastUpdated":'
+_ARTICLE_JSON_END = regex.compile(rb'\},"lastUpdated":\d+\}\},"authorInfo":')
 
-def yield_article(file: str):
-    id = os.path.basename(file)[:-5]
+def find_article_json(html: Union[bytes,mmap.mmap], page_start: int = 0, page_end: Optional[int] = None) -> Optional[bytes]:
+    """Find the article JSON in the state embedded in an IL page. This is the span
+    regex.search(r'({"article_id":.*}),"lastUpdated":\\d+}},"authorInfo":',html) would match on
+    the text of the page, but found by searching for its start and end anchors instead of
+    backtracking over the whole page. The page can be a range of html, such as a record in the
+    memory map of a pack."""
+    if page_end is None:
+        page_end = len(html)
+    start = html.find(_ARTICLE_JSON_START,page_start,page_end)
+    while start != -1:
+        # .* does not cross lines, and the page was read with universal newlines
+        line_end = page_end
+        for line_break in (b'\n',b'\r'):
+            position = html.find(line_break,start,line_end)
+            if position != -1:
+                line_end = position
+        # the last end anchor on the line, as .* is greedy
+        end = html.rfind(_ARTICLE_JSON_END_MARKER,start+len(_ARTICLE_JSON_START)+1,line_end)
+        while end != -1:
+            if _ARTICLE_JSON_END.match(html,end-1,line_end):
+                return html[start:end]
+            end = html.rfind(_ARTICLE_JSON_END_MARKER,start+len(_ARTICLE_JSON_START)+1,end)
+        start = html.find(_ARTICLE_JSON_START,line_end,page_end)
+    return None
+
+def yield_article(file: Union[str,InputFile], clean: Callable[[str], str] = clean_text, timings: Optional[dict[str,float]] = None):
+    """Read the article in an IL page, adding the time spent in each stage to timings if given."""
+    file = as_input_file(file)
+    id = file.basename[:-5]
     try:
-        with open(file) as ir:
-            html = ir.read()
-            match = regex.search(r'({"article_id":.*}),"lastUpdated":\d+}},"authorInfo":',html)
-            if match is None:
-                logging.error("Couldn't find article json in %s.",file)
-                return None
-            article = json.loads(match.group(1))
-            headline = clean_text(article['title'])
-            lead = clean_text(article['lead']) if article['lead']!='' else None
-            body = ""
-            for elem in article['body']:
-                body += parse_body(elem)
-            body = clean_text(body)
-            return Article(id,headline,lead,body)
+        start = time.perf_counter()
+        article_json = None
+        mapped = file.mapped()
+        if mapped is not None:
+            article_json = find_article_json(*mapped)
+        elif file.path is None:
+            article_json = find_article_json(file.read())
+        else:
+            with open(file.path,'rb') as ir:
+                if os.fstat(ir.fileno()).st_size>0:
+                    with mmap.mmap(ir.fileno(),0,access=mmap.ACCESS_READ) as html:
+                        article_json = find_article_json(html)
+        found = time.perf_counter()
+        if article_json is None:
+            logging.error("Couldn't find article json in %s.",file.name)
+            return None
+        article = fast_json.loads(article_json)
+        decoded = time.perf_counter()
+        parts = []
+        for elem in article['body']:
+            _append_body(elem, parts)
+        body = ''.join(parts)
+        assembled = time.perf_counter()
+        headline = clean(article['title'])
+        lead = clean(article['lead']) if article['lead']!='' else None
+        body = clean(body)
+        cleaned = time.perf_counter()
+        if timings is not None:
+            for stage, seconds in (('find',found-start),('decode',decoded-found),('body',assembled-decoded),('clean',cleaned-assembled)):
+                timings[stage] = timings.get(stage,0.0)+seconds
+        return Article(id,headline,lead,body)
     except:
         logging.exception("Error processing %s",id)
 
-def process(prefix: int,input_files: list[str], output_directory: str, split: int):
-    current_output = None
-    i = 0
-    try:
-        for input_file in input_files:
-            article = yield_article(input_file)
-            if article is not None:
-                if i % split == 0:
-                    if current_output is not None:
-                        current_output.close()
-                    logging.info("Creating chunk %s-%d.",prefix,i)
-                    current_output = open(os.path.join(output_directory,f"chunk-{prefix}-{i}.txt"),"w")
-                if article.title is not None:
-                    current_output.write(f'###C: {article.id}_title\n')
-                    current_output.write(article.title)
-                    current_output.write('\n\n')
-                current_output.write(f'###C: {article.id}_body\n')
-                current_output.write(article.body)
-                current_output.write('\n\n')
-                i += 1
-    finally:
-        if current_output is not None:
-            current_output.close()
+def process_file(input_file: InputFile, output: ChunkWriter, clean: Callable[[str], str]) -> None:
+    article = yield_article(input_file, clean)
+    if article is not None:
+        sections = []
+        if article.title is not None:
+            sections.append((f'{article.id}_title', article.title))
+        sections.append((f'{article.id}_body', article.body))
+        output.write_article(sections)
 
 
 # process("/Users/jiemakel/tyo/flopo-data-pipeline/data/input/yle_sample","/Users/jiemakel/tyo/flopo-data-pipeline/data/processed/for-turkunlp/yle_sample", 500)
@@ -103,24 +143,25 @@ def process(prefix: int,input_files: list[str], output_directory: str, split: in
 # %%
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-s","--split",type=int,help="number of articles to put in each file",default=5000)
-    parser.add_argument("-i","--input-directory",help="input directory",nargs="+")
+    parser.add_argument("-s","--split",type=int,help="maximum number of articles to put in each file",default=5000)
+    parser.add_argument("--max-bytes",type=int,help="maximum size of each file in bytes, unless a single article is larger")
+    parser.add_argument("--max-tokens",type=int,help="maximum estimated number of tokens in each file, unless a single article has more")
+    parser.add_argument("-i","--input-directory",help="input directories, packs or tar/zip archives",nargs="+")
     parser.add_argument("-o","--output-directory",help="output directory",required=True)
     parser.add_argument("-p","--processes",help="number of processes to use",type=int,default=len(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else os.cpu_count())
+    parser.add_argument("-c","--cache",help="clean text cache file (on a local disk)")
+    parser.add_argument("--cache-size",type=int,help="maximum size of the clean text cache in bytes",default=DEFAULT_MAX_SIZE)
+    parser.add_argument("--incremental",action="store_true",help="only rebuild the chunks whose input files changed since the last run")
+    parser.add_argument("--hash",action="store_true",help="in incremental mode, compare content hashes of files whose mtime changed")
+    parser.add_argument("--rescan",action="store_true",help="list all input directories again, rather than only those whose mtime changed since the last run")
+    parser.add_argument("--compression",choices=["gzip","zstd"],help="compress the chunks with gzip or zstd")
+    parser.add_argument("--metrics",help="JSON run report to record the metrics of the run in, with a Prometheus textfile next to it")
     return parser.parse_args()
 
-def chunks(lst, chunk_size):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i:i + chunk_size]
-
 def main() -> None:
     args = parse_arguments()
     os.makedirs(args.output_directory,exist_ok=True)
-    files = list(itertools.chain.from_iterable([ glob.glob(os.path.join(input_directory,"**","*.html"),recursive=True) for input_directory in args.input_directory]))
-    cores = args.processes
-    with multiprocessing.Pool(cores) as p:
-        p.starmap(functools.partial(process,output_directory=args.output_directory,split=args.split),enumerate(chunks(files,max(1,len(files)//cores))))
+    prepare(process_file,args.input_directory,"html",args,__file__,args.split)
 
 if __name__ == '__main__':
     main()
@@ -3,19 +3,23 @@
 """
 
 import argparse
-import functools
-import glob
-import itertools
 import logging
-import multiprocessing
 import os
-from typing import Iterator, Optional
+from typing import Callable, Iterator, Optional, Union
 
 import ijson.backends.yajl2_cffi as ijson
+from utils.chunk_manifest import ChunkWriter
 from utils.clean_text import clean_text
+from utils.clean_text_cache import DEFAULT_MAX_SIZE
+from utils.input_files import InputFile, as_input_file
+from utils.json_projection import project_items
+from utils.work_queue import prepare
 
 logging.basicConfig(level=logging.INFO)
 
+# the parts of an article yield_articles reads, the rest is skipped unbuilt
+ARTICLE_PROJECTION = {'id': None, 'headline': {'full': None}, 'lead': None, 'content': [{'text': None}]}
+
 
 class Article:
     id: str
@@ -30,50 +34,47 @@ class Article:
         self.body = body
 
 
-def yield_articles(filename: str) -> Iterator[Article]:
-    logging.info("Processing %s", filename)
-    with open(filename, 'rb') as articles_file:
+def yield_articles(file: Union[str, InputFile], clean: Callable[[str], str] = clean_text) -> Iterator[Article]:
+    file = as_input_file(file)
+    logging.info("Processing %s", file.name)
+    with file.open() as articles_file:
         try:
-            for article in ijson.items(articles_file, 'data.item'):
+            for article in project_items(ijson.basic_parse(articles_file), ['data', 'item'],
+                                         ARTICLE_PROJECTION):
                 article_id = article['id']
                 title = article['headline']['full'] if 'headline' in article else None
                 ingress = article['lead'] if 'lead' in article else None
-                body = [(index, clean_text(content['text'])) for index, content in enumerate(
+                body = [(index, clean(content['text'])) for index, content in enumerate(
                     article['content']) if 'text' in content and isinstance(content['text'], str)]
                 yield Article(article_id, title, ingress, body)
         except Exception:
-            logging.error("Exception parsing %s.", filename)
+            logging.error("Exception parsing %s.", file.name)
             raise
 
 
-def process(prefix: int, input_files: list[str], output_directory: str, split: int):
-    current_output = None
-    i = 0
-    try:
-        for input_file in input_files:
-            for article in yield_articles(input_file):
-                if i % split == 0:
-                    if current_output is not None:
-                        current_output.close()
-                    logging.info("Creating chunk %s-%d.", prefix, i)
-                    current_output = open(os.path.join(
-                        output_directory, f"chunk-{prefix}-{i}.txt"), "w")
-                if article.title is not None:
-                    current_output.write(f'###C: {article.id}_title\n')
-                    current_output.write(article.title)
-                    current_output.write('\n\n')
-                if article.ingress is not None:
-                    current_output.write(f'###C: {article.id}_ingress\n')
-                    current_output.write(article.ingress)
-                    current_output.write('\n\n')
-                for (index, text) in article.body:
-                    current_output.write(f'###C: {article.id}_body_{index}\n')
-                    current_output.write(text)
-                    current_output.write('\n\n')
-                i += 1
-    finally:
-        if current_output is not None:
-            current_output.close()
+def article_sections(article: Article) -> list[tuple[str, str]]:
+    sections = []
+    if article.title is not None:
+        sections.append((f'{article.id}_title', article.title))
+    if article.ingress is not None:
+        sections.append((f'{article.id}_ingress', article.ingress))
+    for (index, text) in article.body:
+        sections.append((f'{article.id}_body_{index}', text))
+    return sections
+
+
+def process_file(input_file: InputFile, output: ChunkWriter, clean: Callable[[str], str]) -> None:
+    for article in yield_articles(input_file, clean):
+        output.write_article(article_sections(article))
+
+
+def read_articles(input_file: InputFile) -> Iterator[Article]:
+    return yield_articles(input_file, str)
+
+
+def clean_article(article: Article, clean: Callable[[str], str]) -> list[tuple[str, str]]:
+    return article_sections(Article(article.id, article.title, article.ingress,
+                                    [(index, clean(text)) for index, text in article.body]))
 
 
 # process("/Users/jiemakel/tyo/flopo-data-pipeline/data/input/yle_sample","/Users/jiemakel/tyo/flopo-data-pipeline/data/processed/for-turkunlp/yle_sample", 500)
@@ -83,29 +84,41 @@ def process(prefix: int, input_files: list[str], output_directory: str, split: i
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--split", type=int,
-                        help="number of articles to put in each file", default=5000)
-    parser.add_argument("-i", "--input-directory", help="input directory", nargs="+")
+                        help="maximum number of articles to put in each file", default=5000)
+    parser.add_argument("--max-bytes", type=int,
+                        help="maximum size of each file in bytes, unless a single article is larger")
+    parser.add_argument("--max-tokens", type=int,
+                        help="maximum estimated number of tokens in each file, unless a single article has more")
+    parser.add_argument("-i", "--input-directory", help="input directories, packs or tar/zip archives", nargs="+")
     parser.add_argument("-o", "--output-directory", help="output directory", required=True)
     parser.add_argument("-p", "--processes", help="number of processes to use", type=int,
                         default=len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    parser.add_argument("-c", "--cache", help="clean text cache file (on a local disk)")
+    parser.add_argument("--cache-size", type=int, help="maximum size of the clean text cache in bytes",
+                        default=DEFAULT_MAX_SIZE)
+    parser.add_argument("--incremental", action="store_true",
+                        help="only rebuild the chunks whose input files changed since the last run")
+    parser.add_argument("--hash", action="store_true",
+                        help="in incremental mode, compare content hashes of files whose mtime changed")
+    parser.add_argument("--rescan", action="store_true",
+                        help="list all input directories again, rather than only those whose mtime changed "
+                        "since the last run")
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress the chunks with gzip or zstd")
+    parser.add_argument("--metrics", help="JSON run report to record the metrics of the run in, "
+                        "with a Prometheus textfile next to it")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="read and clean articles in separate processes, so that the articles of a "
+                        "large file are cleaned in parallel")
+    parser.add_argument("--readers", type=int, help="number of reader processes with --pipeline", default=1)
     return parser.parse_args()
 
 
-def chunks(lst, chunk_size):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), chunk_size):
-        yield lst[i:i + chunk_size]
-
-
 def main() -> None:
     args = parse_arguments()
     os.makedirs(args.output_directory, exist_ok=True)
-    files = list(itertools.chain.from_iterable([glob.glob(os.path.join(
-        input_directory, "**", "*.json"), recursive=True) for input_directory in args.input_directory]))
-    cores = args.processes
-    with multiprocessing.Pool(cores) as pool:
-        pool.starmap(functools.partial(process, output_directory=args.output_directory,
-                                       split=args.split), enumerate(chunks(files, max(1, len(files)//cores))))
+    prepare(process_file, args.input_directory, "json", args, __file__, 1,
+            read_articles, clean_article)
 
 
 if __name__ == '__main__':
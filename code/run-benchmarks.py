@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Script to benchmark the prepare scripts on deterministic synthetic corpora: generate the
+corpora, run micro-benchmarks of the hot functions on them, measure the end-to-end throughput of
+the prepare scripts, check that the chunks the prepare scripts write are byte-identical to the
+golden ones recorded from a known-good version of the code, and check that the parse cache and
+the parser pool write the same parses as the parser run on each chunk
+"""
+
+import argparse
+import logging
+import os
+
+from benchmarks import DATASETS, end_to_end, micro, parse_cache, parser_pool
+
+logging.basicConfig(level=logging.INFO)
+
+
+# %%
+def parse_arguments():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-d", "--datasets", nargs="+", choices=DATASETS, default=list(DATASETS),
+                        help="datasets to benchmark")
+    common.add_argument("-w", "--work-directory", help="directory for the corpora and outputs",
+                        default="data/benchmarks")
+    parser = argparse.ArgumentParser(description="Prepare script benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate = subparsers.add_parser("generate", parents=[common], help="generate the synthetic corpora")
+    micro_parser = subparsers.add_parser("micro", parents=[common], help="micro-benchmark the hot functions")
+    prepare = subparsers.add_parser("prepare", parents=[common],
+                                    help="measure the throughput of the prepare scripts")
+    for subparser in (generate, micro_parser, prepare):
+        subparser.add_argument("-n", "--articles", type=int, help="number of articles per dataset",
+                               default=10000)
+        subparser.add_argument("--seed", type=int, help="seed of the generators", default=1)
+        subparser.add_argument("--scale", type=float, help="multiplier of the lengths of texts",
+                               default=1.0)
+        subparser.add_argument("--no-generate", action="store_true",
+                               help="use the corpora already generated in the work directory")
+    micro_parser.add_argument("-r", "--repeat", type=int,
+                              help="number of timing runs, of which the best is reported", default=3)
+    prepare.add_argument("arguments", nargs=argparse.REMAINDER,
+                         help="arguments to the prepare scripts, e.g. -- -p 4 --compression zstd")
+    golden = subparsers.add_parser("golden", parents=[common],
+                                   help="check the chunks against the golden digests")
+    golden.add_argument("-c", "--configurations", nargs="+", choices=end_to_end.CONFIGURATIONS,
+                        default=list(end_to_end.CONFIGURATIONS), help="prepare script configurations to check")
+    golden.add_argument("--update", action="store_true",
+                        help="record the digests of this version of the code as the golden ones")
+    subparsers.add_parser("parse-cache", parents=[common],
+                          help="check the parses assembled by the parse cache against whole parses")
+    subparsers.add_parser("parser-pool", parents=[common],
+                          help="check the parses written by the parser pool against whole parses")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    if args.command == "golden":
+        if end_to_end.check_golden(os.path.join(args.work_directory, "golden"), args.datasets,
+                                   args.configurations, args.update) > 0:
+            raise SystemExit(1)
+        return
+    if args.command == "parse-cache":
+        if parse_cache.check(os.path.join(args.work_directory, "parse-cache"), args.datasets) > 0:
+            raise SystemExit(1)
+        return
+    if args.command == "parser-pool":
+        if parser_pool.check(os.path.join(args.work_directory, "parser-pool"), args.datasets) > 0:
+            raise SystemExit(1)
+        return
+    input_directory = os.path.join(args.work_directory, "input")
+    if args.no_generate:
+        corpora = {dataset: os.path.join(input_directory, dataset) for dataset in args.datasets}
+    else:
+        corpora = end_to_end.generate(input_directory, args.datasets, args.articles, args.seed, args.scale)
+    if args.command == "micro":
+        micro.run(corpora, args.repeat)
+    elif args.command == "prepare":
+        arguments = args.arguments[1:] if args.arguments[:1] == ["--"] else args.arguments
+        end_to_end.throughput(corpora, args.work_directory, arguments)
+
+
+if __name__ == '__main__':
+    main()
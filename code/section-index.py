@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Script to find articles and sections by id in the chunks and parses of a dataset through their
+section indexes, to extract them, and to parse selected ones again, patching their new parse into
+the parse files
+"""
+
+import argparse
+import logging
+import shlex
+import subprocess
+import sys
+
+from utils.dedup import split_sections
+from utils.section_index import dataset_files, extract, index_file, locate, read_index, replace_sections
+
+logging.basicConfig(level=logging.INFO)
+
+PARSER_COMMAND = 'docker run -i hsci/turku-neural-parser-openshift:latest'
+
+
+def files(directories: list[str]) -> list[str]:
+    return [path for directory in directories for extension in ('txt', 'conll')
+            for path in dataset_files(directory, extension)]
+
+
+def reparse(text_directory: str, conll_directory: str, ids: list[str], parser: list[str]) -> None:
+    """Parse the sections or articles with the given ids in the chunks in text_directory again,
+    replacing their parses in the parse files in conll_directory."""
+    locations = locate(dataset_files(text_directory, 'txt'), ids)
+    if not locations:
+        logging.warning("None of the ids were found in %s.", text_directory)
+        return
+    text = b''.join(extract(location) for location in locations)
+    logging.info("Parsing %d sections again...", len(split_sections(text.decode('utf-8'))[1]))
+    parse = subprocess.run(parser, input=text, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+    sections = {section_id: section.encode('utf-8') for section_id, section in split_sections(parse)[1]}
+    replaced = 0
+    for path in dataset_files(conll_directory, 'conll'):
+        if any(section_id in sections for section_id, _, _ in read_index(path)):
+            count = replace_sections(path, sections)
+            logging.info("Replaced %d sections in %s.", count, path)
+            replaced += count
+    if replaced < len(sections):
+        logging.warning("Only %d of the %d sections parsed were found in %s.", replaced, len(sections),
+                        conll_directory)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help="(re)build the section indexes of the chunk or parse files")
+    index_parser.add_argument("-d", "--directory", nargs="+", required=True,
+                              help="for-turkunlp or conll directories of datasets")
+    for command, help in (('locate', "print the file, offset and length of each article or section"),
+                          ('extract', "write out each article or section")):
+        command_parser = subparsers.add_parser(command, help=help)
+        command_parser.add_argument("-d", "--directory", action="append", required=True,
+                                    help="for-turkunlp or conll directory of a dataset (repeatable)")
+        command_parser.add_argument("ids", nargs="+", help="article or section ids")
+    reparse_parser = subparsers.add_parser('reparse', help="parse articles or sections again, patching their "
+                                                           "parses in place")
+    reparse_parser.add_argument("-t", "--text-directory", required=True, help="for-turkunlp directory of the dataset")
+    reparse_parser.add_argument("-c", "--conll-directory", required=True, help="conll directory of the dataset")
+    reparse_parser.add_argument("--parser", default=PARSER_COMMAND, help="command running the parser")
+    reparse_parser.add_argument("ids", nargs="+", help="article or section ids")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_arguments()
+    if args.command == 'index':
+        for path in files(args.directory):
+            index_file(path)
+    elif args.command == 'locate':
+        for location in locate(files(args.directory), args.ids):
+            print(f'{location.id}\t{location.path}\t{location.offset}\t{location.length}')
+    elif args.command == 'extract':
+        for location in locate(files(args.directory), args.ids):
+            sys.stdout.buffer.write(extract(location))
+    else:
+        reparse(args.text_directory, args.conll_directory, args.ids, shlex.split(args.parser))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import filecmp
+import glob
+import hashlib
+import json
+import logging
+import os
+from typing import Iterable, Optional, Union
+
+from utils import clean_text as clean_text_module
+from utils.compression import compressed_name, compression_of, open_file
+from utils.input_files import InputFile, as_input_file
+from utils.section_index import INDEX_SUFFIX, write_index
+
+# sidecar listing the size of each chunk in a for-turkunlp output directory
+CHUNK_SIZES_FILE = 'chunks.json'
+
+# the modules besides this one and clean_text that decide which articles end up in which chunks and
+# how they are written, named by path, as work_queue imports this module
+VERSION_MODULES = ('work_queue.py', 'input_files.py', 'json_projection.py', 'fast_json.py',
+                   'csv_ranges.py', 'pack.py')
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as input_file:
+        digest = hashlib.sha256()
+        for block in iter(lambda: input_file.read(1024 * 1024), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+
+class ChunkFile:
+    """A chunk file opened for writing, compressed by the suffix of its path. In incremental mode,
+    the chunk is written next to its final path and only moved over an existing chunk if the
+    content differs, so that unchanged chunks keep their modification time and thus their parse.
+    """
+
+    def __init__(self, path: str, incremental: bool = False):
+        self.path = path
+        self.incremental = incremental
+        self.temporary_path = path + '.tmp' if incremental else path
+        self.file = open_file(self.temporary_path, 'w', compression_of(path))
+
+    def write(self, data: str) -> int:
+        return self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+        if self.incremental:
+            if os.path.exists(self.path) and filecmp.cmp(self.temporary_path, self.path, shallow=False):
+                os.remove(self.temporary_path)
+            else:
+                os.replace(self.temporary_path, self.path)
+
+
+class ChunkWriter:
+    """Stream of articles into chunk files named chunk-{prefix}-{i}.txt (chunk-{i}.txt without a
+    prefix), i being the number of articles written before the chunk, with the suffix of their
+    compression if any.
+
+    A new chunk is started once the current one has split articles, or when the next article would
+    take it over max_bytes bytes or max_tokens estimated tokens, so that chunks take roughly equal
+    time to parse. Chunks are only cut between articles, so an article larger than the budget gets
+    a chunk of its own. The size of each chunk is kept in chunks, for save_chunk_sizes, and the
+    offset and length of each section in a section index next to it (see utils.section_index).
+    """
+
+    def __init__(self, output_directory: str, prefix: Optional[Union[int, str]], split: int,
+                 max_bytes: Optional[int] = None, max_tokens: Optional[int] = None,
+                 incremental: bool = False, compression: Optional[str] = None):
+        self.output_directory = output_directory
+        self.prefix = prefix
+        self.split = split
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.incremental = incremental
+        self.compression = compression
+        self.articles = 0
+        self.chunks = {}
+        self.chunk_name = None
+        self.output = None
+        self.index = []
+
+    def write_article(self, sections: Iterable[tuple[str, str]]) -> None:
+        """Write an article given as (section id, text) pairs."""
+        sections = [(section_id, f'###C: {section_id}\n{text}\n\n') for section_id, text in sections]
+        article = ''.join(section for _, section in sections)
+        lengths = [len(section.encode('utf-8')) for _, section in sections]
+        size = sum(lengths)
+        tokens = estimate_tokens(article)
+        chunk = self.chunks.get(self.chunk_name)
+        if chunk is None or chunk['articles'] >= self.split or \
+                (self.max_bytes is not None and chunk['bytes'] + size > self.max_bytes) or \
+                (self.max_tokens is not None and chunk['tokens'] + tokens > self.max_tokens):
+            self.close()
+            if self.prefix is None:
+                logging.info("Creating chunk %d.", self.articles)
+                self.chunk_name = compressed_name(f"chunk-{self.articles}.txt", self.compression)
+            else:
+                logging.info("Creating chunk %s-%d.", self.prefix, self.articles)
+                self.chunk_name = compressed_name(f"chunk-{self.prefix}-{self.articles}.txt",
+                                                  self.compression)
+            chunk = self.chunks[self.chunk_name] = {'bytes': 0, 'articles': 0, 'tokens': 0}
+            self.output = ChunkFile(os.path.join(
+                self.output_directory, self.chunk_name), self.incremental)
+        offset = chunk['bytes']
+        for (section_id, _), length in zip(sections, lengths):
+            self.index.append((section_id, offset, length))
+            offset += length
+        self.output.write(article)
+        chunk['bytes'] += size
+        chunk['articles'] += 1
+        chunk['tokens'] += tokens
+        self.articles += 1
+
+    def close(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            write_index(self.output.path, self.index)
+            self.output = None
+            self.index = []
+
+
+def estimate_tokens(txt: str) -> int:
+    """Rough estimate of the number of tokens the parser will find in txt: whitespace-separated
+    words, plus one for the punctuation most of them are followed by."""
+    return len(txt.split()) * 5 // 4
+
+
+def save_chunk_sizes(output_directory: str, chunks: dict[str, dict[str, int]],
+                     update: bool = False) -> None:
+    """Write the sizes (bytes, articles and estimated tokens) of the chunks in output_directory
+    to its CHUNK_SIZES_FILE. With update, the sizes of other chunks that still exist are kept."""
+    path = os.path.join(output_directory, CHUNK_SIZES_FILE)
+    sizes = {}
+    if update and os.path.exists(path):
+        sizes = {chunk: size for chunk, size in load_chunk_sizes(output_directory).items()
+                 if os.path.exists(os.path.join(output_directory, chunk))}
+    sizes.update(chunks)
+    with open(path + '.tmp', 'w') as sizes_file:
+        json.dump(dict(sorted(sizes.items())), sizes_file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_chunk_sizes(output_directory: str) -> dict[str, dict[str, int]]:
+    with open(os.path.join(output_directory, CHUNK_SIZES_FILE)) as sizes_file:
+        return json.load(sizes_file)
+
+
+class ChunkManifest:
+    """Manifest of the input files behind the chunks of a for-turkunlp output directory, used to
+    rebuild only the chunks whose inputs changed.
+
+    Input files are assigned to numbered groups of at most group_size files, and each group is
+    processed into its own chunk files. Files keep their group across runs and new files go to
+    new groups, so adding, changing or removing a file only affects the chunks of its group. A
+    file counts as changed if its size or mtime differs, unless use_hashes is set and its
+    content hash is still the same.
+
+    If the prepare script, the chunk writer, clean_text, the modules reading and handing out the
+    inputs (VERSION_MODULES), the chunk size limits or the compression differ from the previous
+    run, everything is rebuilt, but chunks whose content stays the same are still left untouched
+    by ChunkFile.
+    """
+
+    FILE_NAME = 'manifest.json'
+
+    def __init__(self, output_directory: str, script: str, split: int, group_size: int,
+                 use_hashes: bool = False, max_bytes: Optional[int] = None,
+                 max_tokens: Optional[int] = None, compression: Optional[str] = None):
+        self.output_directory = output_directory
+        self.version = (f'{split}:{max_bytes}:{max_tokens}:{compression}:{file_digest(script)}:'
+                        f'{file_digest(__file__)}:{file_digest(clean_text_module.__file__)}:' +
+                        ':'.join(file_digest(os.path.join(os.path.dirname(__file__), module))
+                                 for module in VERSION_MODULES))
+        self.group_size = group_size
+        self.use_hashes = use_hashes
+        self.files = {}
+        self.groups = {}
+        path = os.path.join(output_directory, self.FILE_NAME)
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['version'] == self.version and manifest['group_size'] == group_size:
+                self.files = manifest['files']
+                self.groups = {int(group): chunks for group, chunks in manifest['groups'].items()}
+            else:
+                logging.info("Code or settings changed since the last run, rebuilding all chunks.")
+
+    def plan(self, input_files: list[Union[str, InputFile]]) -> list[tuple[int, list[InputFile]]]:
+        """Update the manifest to the current input files, returning the groups that need to be
+        rebuilt along with their input files. New files are grouped in the order given."""
+        dirty = set()
+        files = {}
+        inputs = {}
+        new_files = []
+        for input_file in map(as_input_file, input_files):
+            if input_file.name in files:
+                continue
+            inputs[input_file.name] = input_file
+            entry = self.files.get(input_file.name)
+            if entry is None:
+                new_files.append(input_file.name)
+                entry = {'size': input_file.size, 'mtime': input_file.mtime_ns,
+                         'hash': input_file.content_hash() if self.use_hashes else None}
+            elif entry['size'] != input_file.size or entry['mtime'] != input_file.mtime_ns:
+                digest = input_file.content_hash() if self.use_hashes else None
+                if digest is None or digest != entry['hash']:
+                    dirty.add(entry['group'])
+                entry = dict(entry, size=input_file.size, mtime=input_file.mtime_ns, hash=digest)
+            files[input_file.name] = entry
+        for removed_file in self.files.keys() - files.keys():
+            dirty.add(self.files[removed_file]['group'])
+        next_group = max((entry['group'] for entry in self.files.values() if 'group' in entry),
+                         default=-1) + 1
+        for i in range(0, len(new_files), self.group_size):
+            for new_file in new_files[i:i + self.group_size]:
+                files[new_file]['group'] = next_group
+            dirty.add(next_group)
+            next_group += 1
+        self.files = files
+        members = {}
+        for input_file, entry in files.items():
+            members.setdefault(entry['group'], []).append(inputs[input_file])
+        for group in dirty - members.keys():
+            self.groups.pop(group, None)
+        logging.info("%d of %d input file groups need to be rebuilt.",
+                     len(dirty & members.keys()), len(members))
+        return [(group, members[group]) for group in sorted(dirty & members.keys())]
+
+    def record(self, group: int, chunks: list[str]) -> None:
+        """Record the names of the chunk files a group was rebuilt into."""
+        self.groups[group] = chunks
+
+    def remove_stale_chunks(self) -> None:
+        """Remove chunk files that no group was built into."""
+        current_chunks = set()
+        for chunks in self.groups.values():
+            current_chunks.update(chunks)
+        for chunk in glob.glob(os.path.join(self.output_directory, "chunk-*.txt*")):
+            # section indexes go with their chunks
+            if os.path.basename(chunk).removesuffix(INDEX_SUFFIX) not in current_chunks:
+                logging.info("Removing stale chunk %s.", chunk)
+                os.remove(chunk)
+
+    def save(self) -> None:
+        path = os.path.join(self.output_directory, self.FILE_NAME)
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump({'version': self.version, 'group_size': self.group_size, 'files': self.files,
+                       'groups': self.groups}, manifest_file)
+        os.replace(path + '.tmp', path)
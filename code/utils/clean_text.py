@@ -1,81 +1,246 @@
 import html
 import logging
-import warnings
+from typing import Iterable, Optional
 
 import regex
-from bs4 import BeautifulSoup, NavigableString
+from lxml import etree
 
-warnings.filterwarnings("ignore", message='.*looks like a.*', category=UserWarning, module='bs4')
+
+class RewriteRules:
+    """A list of (pattern, replacement) rules compiled into a single alternation, so that all
+    of them are applied in one scan over the text. Where several rules match at the same
+    position, the one listed first wins, which mirrors applying them one after another.
+    """
+
+    def __init__(self, rules: Iterable[tuple[str, str]], flags: int = 0):
+        self.replacements = {}
+        alternatives = []
+        for index, (pattern, replacement) in enumerate(rules):
+            self.replacements[f'r{index}'] = replacement
+            alternatives.append(f'(?P<r{index}>{pattern})')
+        self.pattern = regex.compile('|'.join(alternatives), flags)
+
+    def _replace(self, match: regex.Match) -> str:
+        return self.replacements[match.lastgroup]
+
+    def sub(self, txt: str) -> str:
+        return self.pattern.sub(self._replace, txt)
+
+
+# html formatting
+_HTML_FORMATTING = RewriteRules([
+    (regex.escape('<span class="ndash">&ndash;</span>'), '-'),
+    (r'<div[^>]*><div[^>]*></div></div>', '\n'),
+    (r'<div[^>]*></div>', '\n'),
+    (regex.escape('<div class="quotes">&nbsp;</div>'), ''),
+    (regex.escape('<p class="imgplaceholder left">&nbsp;</p>'), ''),
+    (regex.escape('<p class="imgplaceholder left">&nbps;</p>'), ''),  # sic
+    (regex.escape('<p class="imgplaceholder center">&nbsp;</p>'), ''),
+    (regex.escape('<p class="imgplaceholder right">&nbsp;</p>'), ''),
+    (regex.escape('<span class="pi_BlackSquare">&nbsp;</span>'), ' * '),
+    (r'<p class="videoplaceholder"[^>]*>&nbsp;?</p>', ''),
+    (regex.escape('<li>'), ' * '),
+    (regex.escape('</li>'), ''),
+    # these two were always matched literally, not as patterns
+    (regex.escape('<h[0-9][^>]*>'), '\n'),
+    (regex.escape('</h[0-9]>'), '\n\n'),
+    (regex.escape('</p>'), '\n\n'),
+    (regex.escape('<p[^>]*>'), ''),
+    (regex.escape('<br />'), '\n'),
+    (r'<iframe[^>]*></iframe ?>', ''),
+])
+
+# markdown
+_MARKDOWN_HEADING = regex.compile(r"^#+ ", regex.MULTILINE)
+# emphases never span lines, so only lines containing _ or * need to be rescanned
+_MARKDOWN_EMPHASIS_LINE = regex.compile(r"^[^\n_*]*[_*][^\n]*", regex.MULTILINE)
+_MARKDOWN_UNDERSCORE_EMPHASIS = regex.compile(r"_+(.+?)_+")
+_MARKDOWN_ASTERISK_EMPHASIS = regex.compile(r"\*+(.+?)\*+")
+_MARKDOWN_LINK = regex.compile(r"\[([^\]]+?)\]\([^\)]+?\)")
+
+# normalization
+_ENTITIES = RewriteRules([
+    (r'^&bull; ', ' * '),
+    (regex.escape('&nbsp;'), ' '),
+    (regex.escape('&#160;'), ' '),
+    (regex.escape('&nbps;'), ''),
+], regex.MULTILINE)
+# str.replace is much faster than str.translate or a regex on non-ASCII text, so the
+# character normalizations stay a chain of replaces, in their original order
+_CHARACTERS = (
+    ("\xad", ""),
+    ("\x95", "-"),
+    ("\x96", "-"),
+    ("\x94", '"'),
+    ("\u2028", "\n"),  # weird unicode line break
+    ("–", "-"),  # ndash
+    ("—", "-"),  # mdash
+    ("\\-", "-"),
+    ("•", "*"),  # bull
+    ("…", "..."),  # hellip
+    ("“", "\""),  # ldquo
+    ("”", "\""),
+    ("’", "'"),  # rsquo
+    # weird spaces (\p{Zs}), all of which are in the BMP
+    *((space, " ") for space in regex.findall(r"[^ \P{Zs}]", "".join(map(chr, range(0x10000))))),
+)
+
+# quote separators
+_MISSING_QUOTE_SEPARATOR = regex.compile(r"^-([^ ]+)", regex.MULTILINE)
+_EXTRA_QUOTE_SEPARATORS = regex.compile(r"^-  +", regex.MULTILINE)
+_MULTIPLE_QUOTE_MARKERS = regex.compile(r"^(- *-)+", regex.MULTILINE)
+_SUPERFLUOUS_PARAGRAPH_BREAKS = regex.compile(r"\n\n\n+")
+
+# html stripping
+_HTML_WHITESPACE = ' \n\t\x0c\r'
+_PRESERVE_WHITESPACE_TAGS = frozenset(('pre', 'textarea'))
+_STRING_CONTAINER_TAGS = frozenset(('script', 'style', 'template', 'rt', 'rp'))
+
+
+class _TextExtractor:
+    """lxml parser target collecting the text BeautifulSoup(txt, 'lxml').get_text() would return,
+    without building a tree. Like BeautifulSoup, whitespace-only strings are collapsed outside
+    <pre> and <textarea>, and strings in <script>, <style>, <template>, <rt> and <rp>, comments,
+    processing instructions and doctypes are left out. Blockquotes are prefixed with '- ', and all
+    strings inside them are kept with their newlines turned into spaces.
+    """
+
+    def __init__(self):
+        self.open_tags = []
+        self.preserve_whitespace = 0
+        self.string_containers = 0
+        self.blockquotes = 0
+        self.pending = []
+        self.text = []
+
+    def _end_data(self, include: bool = True):
+        if self.pending:
+            data = ''.join(self.pending)
+            self.pending = []
+            if self.preserve_whitespace == 0 and data.strip(_HTML_WHITESPACE) == '':
+                data = '\n' if '\n' in data else ' '
+            if self.blockquotes > 0:
+                self.text.append(data.replace('\n', ' '))
+            elif include and self.string_containers == 0:
+                self.text.append(data)
+
+    def start(self, tag: str, attrib: dict, nsmap: Optional[dict] = None):
+        self._end_data()
+        self.open_tags.append(tag)
+        if tag in _PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+        if tag in _STRING_CONTAINER_TAGS:
+            self.string_containers += 1
+        if tag == 'blockquote':
+            self.blockquotes += 1
+            self.text.append('- ')
+
+    def end(self, tag: str):
+        self._end_data()
+        # close everything up to the most recent open tag of this name, if any
+        if tag in self.open_tags:
+            while True:
+                closed = self.open_tags.pop()
+                if closed in _PRESERVE_WHITESPACE_TAGS:
+                    self.preserve_whitespace -= 1
+                if closed in _STRING_CONTAINER_TAGS:
+                    self.string_containers -= 1
+                if closed == 'blockquote':
+                    self.blockquotes -= 1
+                if closed == tag:
+                    break
+
+    def data(self, data: str):
+        self.pending.append(data)
+
+    def comment(self, text: str):
+        self._end_data()
+        self.pending.append(text)
+        self._end_data(include=False)
+
+    def pi(self, target: str, data: str):
+        self._end_data()
+        self.pending.append(target + ' ' + data)
+        self._end_data(include=False)
+
+    def doctype(self, name: Optional[str], pubid: Optional[str], system: Optional[str]):
+        self._end_data()
+        doctype = name or ''
+        if pubid is not None:
+            doctype += f' PUBLIC "{pubid}"'
+            if system is not None:
+                doctype += f' "{system}"'
+        elif system is not None:
+            doctype += f' SYSTEM "{system}"'
+        self.pending.append(doctype)
+        self._end_data(include=False)
+
+    def close(self) -> str:
+        self._end_data()
+        return ''.join(self.text)
+
+
+def strip_html(txt: str) -> str:
+    """Remove all HTML from txt, giving the same result as running the blockquote handling
+    of the original clean_text on BeautifulSoup(txt, 'lxml') and calling get_text()."""
+    if txt.startswith('\ufeff'):
+        txt = txt[1:]
+    try:
+        parser = etree.HTMLParser(target=_TextExtractor(), recover=True)
+        parser.feed(txt)
+        return parser.close()
+    except (UnicodeDecodeError, LookupError, etree.ParserError):
+        # the same fallback BeautifulSoup uses when lxml rejects a Unicode string
+        parser = etree.HTMLParser(target=_TextExtractor(), recover=True, encoding='utf8')
+        parser.feed(txt.encode('utf8'))
+        return parser.close()
+
+
+def _strip_emphases(match: regex.Match) -> str:
+    line = match.group()
+    while True:
+        stripped = _MARKDOWN_UNDERSCORE_EMPHASIS.sub(r"\1", line)
+        stripped = _MARKDOWN_ASTERISK_EMPHASIS.sub(r"\1", stripped)
+        if stripped == line:
+            return line
+        line = stripped
 
 
 def clean_text(txt: str) -> str:
     # html formatting
-    txt = txt.replace('<span class="ndash">&ndash;</span>', '-')
-    txt = regex.sub(r'<div[^>]*><div[^>]*></div></div>', '\n', txt)
-    txt = regex.sub(r'<div[^>]*></div>', '\n', txt)
-    txt = txt.replace('<div class="quotes">&nbsp;</div>', '')
-    txt = txt.replace('<p class="imgplaceholder left">&nbsp;</p>', '')
-    txt = txt.replace('<p class="imgplaceholder left">&nbps;</p>', '')  # sic
-    txt = txt.replace('<p class="imgplaceholder center">&nbsp;</p>', '')
-    txt = txt.replace('<p class="imgplaceholder right">&nbsp;</p>', '')
-    txt = txt.replace('<span class="pi_BlackSquare">&nbsp;</span>', ' * ')
-    txt = regex.sub(r'<p class="videoplaceholder"[^>]*>&nbsp;?</p>', '', txt)
-    txt = txt.replace('<li>', ' * ').replace('</li>', '')
-    txt = txt.replace('<h[0-9][^>]*>', '\n').replace('</h[0-9]>', '\n\n')
-    txt = txt.replace('</p>', '\n\n').replace('<p[^>]*>', '')
-    txt = txt.replace('<br />', '\n')
-    txt = regex.sub(r'<iframe[^>]*></iframe ?>', '', txt)
+    if '<' in txt:
+        txt = _HTML_FORMATTING.sub(txt)
 
     # markdown
-    # markdown headings
-    txt = regex.sub(r"^#+ ", "", txt, flags=regex.MULTILINE)
-    while True:
-        txt2 = regex.sub(r"_+(.+?)_+", r"\1", txt)  # markdown emphases
-        txt2 = regex.sub(r"\*+(.+?)\*+", r"\1", txt2)  # markdown emphasess
-        if txt == txt2:
-            break
-        txt = txt2
-    txt = regex.sub(r"\[([^\]]+?)\]\([^\)]+?\)", r"\1", txt)  # markdown links
+    if '#' in txt:
+        txt = _MARKDOWN_HEADING.sub("", txt)
+    txt = _MARKDOWN_EMPHASIS_LINE.sub(_strip_emphases, txt)
+    if '](' in txt:
+        txt = _MARKDOWN_LINK.sub(r"\1", txt)
 
     # normalization
-    txt = regex.sub(r"^&bull; ", " * ", txt, flags=regex.MULTILINE)
-    txt = txt.replace("&nbsp;", " ") \
-        .replace("&#160;", " ") \
-        .replace("&nbps;", "") \
-        .replace("&39;", "'")
-    txt = txt.replace("\xad", "")
-    txt = txt.replace("\x95", "-")
-    txt = txt.replace("\x96", "-")
-    txt = txt.replace("\x94", '"')
-    txt = txt.replace("\u2028", "\n")  # weird unicode line break
-    txt = txt.replace("–", "-")  # ndash
-    txt = txt.replace("—", "-")  # mdash
-    txt = txt.replace("\-", "-")
-    txt = txt.replace("•", "*")  # bull
-    txt = txt.replace("…", "...")  # hellip
-    txt = txt.replace("“", "\"")  # ldquo
-    txt = txt.replace("”", "\"")
-    txt = txt.replace("’", "'")  # rsquo
-    txt = regex.sub(r"\p{Zs}", " ", txt)  # weird spaces
-    try:
-        soup = BeautifulSoup(txt, 'lxml')
-        for block_quote in soup.find_all('blockquote'):
-            block_quote.insert_before(NavigableString('- '))
-            for text in block_quote.find_all(string=True):
-                text.replace_with(text.replace('\n', ' '))
-            block_quote.unwrap()
-        txt = soup.get_text()  # remove all other HTML
-    except:
-        logging.warning("BeautifulSoup parsing failed.")
+    if '&' in txt:
+        txt = _ENTITIES.sub(txt).replace("&39;", "'")
+    for character, replacement in _CHARACTERS:
+        txt = txt.replace(character, replacement)
+    if '<' in txt or '&' in txt or '\r' in txt or '\x00' in txt or txt.startswith('\ufeff'):
+        try:
+            txt = strip_html(txt)  # remove all other HTML
+        except:
+            logging.warning("HTML parsing failed.")
+    else:
+        # no markup, so the HTML parser would only drop leading whitespace
+        txt = txt.lstrip(_HTML_WHITESPACE)
     txt = html.unescape(txt)
 
-    # missing quote separators
-    txt = regex.sub(r"^-([^ ]+)", r"- \1", txt, flags=regex.MULTILINE)
-    # too many quote separators
-    txt = regex.sub(r"^-  +", "- ", txt, flags=regex.MULTILINE)
-    # multiple quote markers
-    txt = regex.sub(r"^(- *-)+", "- ", txt, flags=regex.MULTILINE)
+    if txt.startswith('-') or '\n-' in txt:
+        # missing quote separators
+        txt = _MISSING_QUOTE_SEPARATOR.sub(r"- \1", txt)
+        # too many quote separators
+        txt = _EXTRA_QUOTE_SEPARATORS.sub("- ", txt)
+        # multiple quote markers
+        txt = _MULTIPLE_QUOTE_MARKERS.sub("- ", txt)
     # remove superfluous paragraph breaks
-    txt = regex.sub(r"\n\n\n+", "\n\n", txt)
-    txt = regex.sub(r"\n*$", "", txt)
-    return txt
+    if '\n\n\n' in txt:
+        txt = _SUPERFLUOUS_PARAGRAPH_BREAKS.sub("\n\n", txt)
+    return txt.rstrip('\n')
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from utils import clean_text as clean_text_module
+from utils.clean_text import clean_text
+
+# any change to the clean_text rules invalidates the cached results
+with open(clean_text_module.__file__, 'rb') as _source:
+    CLEAN_TEXT_VERSION = hashlib.sha256(_source.read()).digest()
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024 * 1024
+
+
+class CleanTextCache:
+    """On-disk cache of clean_text results, stored in SQLite and keyed by a hash of the raw text
+    and of the clean_text implementation.
+
+    Each process (e.g. each multiprocessing.Pool worker) should open its own CleanTextCache on
+    the same path. New results and hits are written in batches, and the least recently used
+    results are evicted by evict(), which is meant to be called once at the end of a run. As
+    SQLite locking is unreliable on network file systems, the cache should be on a local disk.
+
+    With path None, the cache is disabled and clean_text is simply called.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path: Optional[str], max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.now = int(time.time())
+        self.new_entries = []
+        self.used_keys = []
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cleaned_text (key BLOB PRIMARY KEY, '
+                                    'text TEXT NOT NULL, size INTEGER NOT NULL, last_used INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS cleaned_text_last_used ON cleaned_text (last_used)')
+
+    def clean_text(self, txt: str) -> str:
+        if self.connection is None:
+            return clean_text(txt)
+        key = hashlib.blake2b(txt.encode('utf-8', 'surrogatepass'),
+                              digest_size=20, key=CLEAN_TEXT_VERSION).digest()
+        row = self.connection.execute(
+            'SELECT text FROM cleaned_text WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.hits += 1
+            self.used_keys.append((self.now, key))
+            if len(self.used_keys) >= self.BATCH_SIZE:
+                self.flush()
+            return row[0]
+        self.misses += 1
+        cleaned = clean_text(txt)
+        self.new_entries.append((key, cleaned, len(key) + len(cleaned.encode(
+            'utf-8', 'surrogatepass')), self.now))
+        if len(self.new_entries) >= self.BATCH_SIZE:
+            self.flush()
+        return cleaned
+
+    def flush(self) -> None:
+        if self.connection is None or (not self.new_entries and not self.used_keys):
+            return
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO cleaned_text (key, text, size, last_used) VALUES (?, ?, ?, ?)',
+                self.new_entries)
+            self.connection.executemany(
+                'UPDATE cleaned_text SET last_used = ? WHERE key = ?', self.used_keys)
+        self.new_entries = []
+        self.used_keys = []
+
+    def evict(self) -> None:
+        """Remove the least recently used results until the cache fits in max_size bytes."""
+        if self.connection is None:
+            return
+        self.flush()
+        total_size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM cleaned_text').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        cursor = self.connection.execute('SELECT key, size FROM cleaned_text ORDER BY last_used')
+        for key, size in cursor:
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        cursor.close()
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('DELETE FROM cleaned_text WHERE key = ?', evicted)
+        logging.info("Evicted %d entries from the clean text cache %s.", len(evicted), self.path)
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+def finish_run(path: Optional[str], max_size: int, counts: Iterable[tuple[int, int]]) -> None:
+    """Log the summed (hits, misses) counts of the CleanTextCaches used in a run, and evict old
+    results from the cache."""
+    if path is None:
+        return
+    hits = 0
+    misses = 0
+    for (process_hits, process_misses) in counts:
+        hits += process_hits
+        misses += process_misses
+    logging.info("Clean text cache %s: %d hits, %d misses (%.1f%% hit rate).", path, hits, misses,
+                 100 * hits / (hits + misses) if hits + misses > 0 else 0)
+    cache = CleanTextCache(path, max_size)
+    try:
+        cache.evict()
+    finally:
+        cache.close()
@@ -0,0 +1,94 @@
+import gzip
+import io
+from typing import IO, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compressions of intermediate files, and the suffix each adds to their names
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def compressed_name(path: str, compression: Optional[str]) -> str:
+    return path if compression is None else path + SUFFIXES[compression]
+
+
+def compression_of(path: str) -> Optional[str]:
+    """The compression of a file, by the suffix of its name."""
+    for compression, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def strip_compression(path: str) -> str:
+    compression = compression_of(path)
+    return path if compression is None else path[:-len(SUFFIXES[compression])]
+
+
+class _GzipFile(gzip.GzipFile):
+    """GzipFile that closes the file it wraps."""
+
+    def close(self) -> None:
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def open_file(path: str, mode: str = 'r', compression: Optional[str] = None) -> IO:
+    """open(path, mode), compressing or decompressing with the compression given, or else the
+    compression of path by its suffix. Compressed files are written without timestamps or names,
+    so that the same content always compresses to the same bytes."""
+    if compression is None:
+        compression = compression_of(path)
+    if compression is None:
+        return open(path, mode)
+    binary_mode = mode.replace('t', '').replace('b', '')
+    raw = open(path, binary_mode + 'b')
+    if compression == 'gzip':
+        stream = _GzipFile(filename='', mode=binary_mode + 'b', fileobj=raw, mtime=0)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raw.close()
+            raise ValueError("zstd compression needs the zstandard package")
+        if binary_mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    else:
+        raw.close()
+        raise ValueError(f"Unknown compression {compression}")
+    if 'b' in mode:
+        return stream
+    # the same encoding and newline translation as open(path, mode)
+    return io.TextIOWrapper(stream)
+
+
+def compress(data: bytes, compression: Optional[str]) -> bytes:
+    """Compress a record on its own, as open_file would compress a file of it."""
+    if compression is None:
+        return data
+    if compression == 'gzip':
+        return gzip.compress(data, mtime=0)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return bytes(data)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown compression {compression}")
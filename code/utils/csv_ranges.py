@@ -0,0 +1,59 @@
+import csv
+import ctypes
+import io
+import mmap
+import os
+from typing import Iterator
+
+# how much of the file to count quotes in at a time
+_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def record_ranges(path: str, range_size: int) -> list[tuple[int, int]]:
+    """Split a CSV file into consecutive byte ranges of about range_size bytes, each starting
+    and ending at a record boundary, so that they can be parsed independently.
+
+    Quoted fields may contain newlines, so a newline only ends a record if it is preceded by an
+    even number of quote characters. This holds for CSV written with the default dialect, where
+    quotes only appear around fields and doubled inside them. The ranges depend only on the file
+    and range_size.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    boundaries = [0]
+    with open(path, 'rb') as csv_file, mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = 0
+        quotes = 0
+        for cut in range(range_size, size, range_size):
+            if cut <= position:
+                continue
+            for block in range(position, cut, _BLOCK_SIZE):
+                quotes += data[block:min(block + _BLOCK_SIZE, cut)].count(b'"')
+            position = cut
+            # move on to the first newline outside quotes
+            while position < size:
+                newline = data.find(b'\n', position)
+                if newline == -1:
+                    quotes += data[position:size].count(b'"')
+                    position = size
+                    break
+                quotes += data[position:newline].count(b'"')
+                position = newline + 1
+                if quotes % 2 == 0:
+                    break
+            if position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def read_range(path: str, start: int, end: int) -> Iterator[list[str]]:
+    """Yield the rows of a CSV file between the byte offsets start and end given by
+    record_ranges, read as if by csv.reader(open(path)) with no field size limit."""
+    csv.field_size_limit(int(ctypes.c_ulong(-1).value // 2))
+    with open(path, 'rb') as csv_file:
+        csv_file.seek(start)
+        data = csv_file.read(end - start)
+    # the same newline translation and encoding as open(path)
+    yield from csv.reader(io.TextIOWrapper(io.BytesIO(data)))
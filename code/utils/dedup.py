@@ -0,0 +1,151 @@
+import hashlib
+import re
+import struct
+from typing import Iterable, Optional
+
+from utils.chunk_manifest import ChunkFile
+from utils.compression import open_file
+
+# the summary of the duplicates found in a deduplication group, with the settings they were found with
+SUMMARY_FILE = 'summary.json'
+
+# the start of a section, in a chunk and, passed through by the parser, in its parse
+SECTION_START = re.compile(r'^###C: ', re.MULTILINE)
+
+# the value of an empty bin of a MinHash signature, as no shingle hashes to more
+_EMPTY = 0xFFFFFFFF
+# the step between the values borrowed by successive empty bins
+_DENSIFY_STEP = 0x9E3779B1
+
+
+def split_sections(text: str) -> tuple[str, list[tuple[str, str]]]:
+    """The text before the first section of a chunk or a parse, and the id and the text,
+    starting with its ###C: line, of each section."""
+    starts = [match.start() for match in SECTION_START.finditer(text)]
+    if not starts:
+        return text, []
+    sections = []
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        line_end = text.find('\n', start, end)
+        sections.append((text[start + len('###C: '):line_end if line_end != -1 else end], text[start:end]))
+    return text[:starts[0]], sections
+
+
+def read_sections(path: str) -> tuple[str, list[tuple[str, str]]]:
+    with open_file(path) as input_file:
+        return split_sections(input_file.read())
+
+
+def section_text(section: str) -> str:
+    """The text of a section, without its ###C: line."""
+    line_end = section.find('\n')
+    return section[line_end + 1:] if line_end != -1 else ''
+
+
+def exact_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def minhash(text: str, num_perm: int, shingle_words: int) -> tuple[int, ...]:
+    """The MinHash signature of the word shingles of text, by one permutation hashing: each
+    shingle is hashed once into one of num_perm bins, which keep their minimum, and empty bins
+    borrow from the next non-empty one. The share of equal bins of two signatures estimates the
+    Jaccard similarity of their shingles."""
+    words = text.lower().split()
+    signature = [_EMPTY] * num_perm
+    for i in range(max(1, len(words) - shingle_words + 1)):
+        shingle = ' '.join(words[i:i + shingle_words]).encode('utf-8')
+        hash = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'little')
+        bin = (hash & 0xFFFFFFFF) % num_perm
+        if hash >> 32 < signature[bin]:
+            signature[bin] = hash >> 32
+    filled = [value != _EMPTY for value in signature]
+    if not all(filled):
+        original = list(signature)
+        for bin in range(num_perm):
+            if not filled[bin]:
+                distance = 1
+                while not filled[(bin + distance) % num_perm]:
+                    distance += 1
+                signature[bin] = (original[(bin + distance) % num_perm] + distance * _DENSIFY_STEP) & 0xFFFFFFFF
+    return tuple(signature)
+
+
+def similarity(signature: Iterable[int], other: Iterable[int]) -> float:
+    """The Jaccard similarity two MinHash signatures estimate."""
+    signature, other = list(signature), list(other)
+    return sum(1 for value, other_value in zip(signature, other) if value == other_value) / len(signature)
+
+
+def band_keys(signature: tuple[int, ...], bands: int) -> list[bytes]:
+    """The LSH key of each band of signature, which two signatures share in some band with a
+    probability that rises steeply with their similarity."""
+    rows = len(signature) // bands
+    return [hashlib.blake2b(struct.pack(f'<{rows}I', *signature[band * rows:(band + 1) * rows]),
+                            digest_size=8).digest() for band in range(bands)]
+
+
+class Duplicate:
+    """A section whose parse is that of its representative, another section."""
+    id: str
+    dataset: str
+    chunk: str
+    representative: str
+    similarity: float
+
+    def __init__(self, id: str, dataset: str, chunk: str, representative: str, similarity: float):
+        self.id = id
+        self.dataset = dataset
+        self.chunk = chunk
+        self.representative = representative
+        self.similarity = similarity
+
+
+def write_duplicates(path: str, duplicates: list[Duplicate]) -> None:
+    """Write the duplicate map of a chunk, rewriting it only if it changed."""
+    output = ChunkFile(path, incremental=True)
+    for duplicate in duplicates:
+        output.write(f'{duplicate.id}\t{duplicate.dataset}\t{duplicate.chunk}\t{duplicate.representative}\t'
+                     f'{duplicate.similarity:.3f}\n')
+    output.close()
+
+
+def read_duplicates(path: str) -> list[Duplicate]:
+    duplicates = []
+    with open(path) as input_file:
+        for line in input_file:
+            id, dataset, chunk, representative, similarity = line.rstrip('\n').split('\t')
+            duplicates.append(Duplicate(id, dataset, chunk, representative, float(similarity)))
+    return duplicates
+
+
+def fan_out(chunk_path: str, duplicates: list[Duplicate], parse_path: Optional[str],
+            representative_parses: dict[tuple[str, str], str], output_path: str,
+            compression: Optional[str] = None) -> None:
+    """Write the parse of a chunk of which the duplicate sections were left out of the parse at
+    parse_path: the sections in the order of the chunk, each with its own parse or the parse of
+    its representative, under its own ###C: line. representative_parses maps the dataset and the
+    chunk of each representative to the path of its parse. A chunk of duplicates only has no
+    parse of its own."""
+    _, chunk_sections = read_sections(chunk_path)
+    preamble, parsed_sections = read_sections(parse_path) if parse_path is not None else ('', [])
+    parses = dict(parsed_sections)
+    by_id = {duplicate.id: duplicate for duplicate in duplicates}
+    wanted = {}
+    for duplicate in duplicates:
+        wanted.setdefault((duplicate.dataset, duplicate.chunk), set()).add(duplicate.representative)
+    representatives = {}
+    for (dataset, chunk), ids in wanted.items():
+        for id, section in read_sections(representative_parses[(dataset, chunk)])[1]:
+            if id in ids:
+                representatives[(dataset, chunk, id)] = section
+    with open_file(output_path, 'w', compression) as output_file:
+        output_file.write(preamble)
+        for id, _ in chunk_sections:
+            duplicate = by_id.get(id)
+            if duplicate is None:
+                output_file.write(parses[id])
+            else:
+                output_file.write(f'###C: {id}\n')
+                output_file.write(section_text(
+                    representatives[(duplicate.dataset, duplicate.chunk, duplicate.representative)]))
@@ -0,0 +1,18 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """json.loads, using orjson when it is installed. orjson rejects some documents json accepts
+    (e.g. NaN, lone surrogates, integers over 64 bits), which are then decoded by json."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
@@ -0,0 +1,157 @@
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+from typing import Iterable, Iterator
+
+# an ID index file is a header, a Bloom filter of bloom_bits bits and the IDs encoded in UTF-8,
+# sorted and NUL-padded to the width of the longest one, so that they can be binary searched in
+# place. The file is memory-mapped, so all processes using it share a single copy in the page
+# cache, and only the pages a lookup touches are read.
+MAGIC = b'FLOPOIDS'
+_HEADER = struct.Struct('<8sIIQQ')  # magic, width, bloom_hashes, count, bloom_bits
+
+DEFAULT_BLOOM_BITS_PER_ID = 10
+
+# the number of IDs sorted in memory at a time while writing an index, before they are spilled to
+# disk as a sorted run, about a hundred bytes each
+DEFAULT_RUN_IDS = 1000000
+
+
+def _bloom_bits(key: bytes, hashes: int) -> tuple[int, ...]:
+    """The hashes of key that select its bits in a Bloom filter, once taken modulo its size."""
+    return struct.unpack(f'<{hashes}Q', hashlib.blake2b(key, digest_size=8 * hashes).digest())
+
+
+def _write_run(directory: str, keys: list[bytes]) -> str:
+    """Write the sorted distinct keys to a run file in directory, each followed by a NUL."""
+    with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as run_file:
+        for key in sorted(set(keys)):
+            run_file.write(key + b'\0')
+    return run_file.name
+
+
+def _read_run(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as run_file:
+        rest = b''
+        for block in iter(lambda: run_file.read(1024 * 1024), b''):
+            keys = (rest + block).split(b'\0')
+            rest = keys.pop()
+            yield from keys
+
+
+def write_id_index(path: str, ids: Iterable[str], bloom_bits_per_id: int = DEFAULT_BLOOM_BITS_PER_ID,
+                   run_ids: int = DEFAULT_RUN_IDS) -> int:
+    """Write the distinct ids as an ID index at path, with a Bloom filter of bloom_bits_per_id bits
+    per ID in front of the table, or none if it is 0. Returns the number of distinct IDs.
+
+    The ids are sorted in runs of run_ids, spilled to disk next to path and merged into a run of
+    all of them, so that only a run and the Bloom filter are kept in memory, however many IDs
+    there are."""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or '.', prefix='.id-index-') as directory:
+        runs = []
+        ids = iter(ids)
+        while True:
+            keys = [id.encode('utf-8') for id in itertools.islice(ids, run_ids)]
+            if not keys:
+                break
+            if any(b'\0' in key for key in keys):
+                raise ValueError("IDs must not contain NUL characters")
+            runs.append(_write_run(directory, keys))
+            del keys
+        count = 0
+        width = 0
+        with open(os.path.join(directory, 'merged'), 'wb') as merged_file:
+            for key, _ in itertools.groupby(heapq.merge(*(_read_run(run) for run in runs))):
+                merged_file.write(key + b'\0')
+                count += 1
+                width = max(width, len(key))
+        for run in runs:
+            os.remove(run)
+        bloom_bits = (bloom_bits_per_id * count + 7) // 8 * 8
+        # the number of hashes that minimises false positives, about 0.7 per bit per ID, up to the 8
+        # a BLAKE2b digest holds
+        bloom_hashes = min(8, max(1, round(0.693 * bloom_bits_per_id))) if bloom_bits > 0 else 0
+        bloom = bytearray(bloom_bits // 8)
+        with open(path + '.tmp', 'wb') as index_file:
+            # the table is written as the keys are read, and the header and the Bloom filter they
+            # fill in once they all have been
+            index_file.seek(_HEADER.size + len(bloom))
+            for key in _read_run(os.path.join(directory, 'merged')):
+                if bloom_bits > 0:
+                    for bit in _bloom_bits(key, bloom_hashes):
+                        bit %= bloom_bits
+                        bloom[bit >> 3] |= 1 << (bit & 7)
+                index_file.write(key.ljust(width, b'\0'))
+            index_file.seek(0)
+            index_file.write(_HEADER.pack(MAGIC, width, bloom_hashes, count, bloom_bits))
+            index_file.write(bloom)
+    os.replace(path + '.tmp', path)
+    return count
+
+
+def is_id_index(path: str) -> bool:
+    with open(path, 'rb') as index_file:
+        return index_file.read(len(MAGIC)) == MAGIC
+
+
+class IdIndex:
+    """A read-only set of IDs in an ID index file. It pickles as its path, so that worker
+    processes map the same file instead of getting a copy of the IDs."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.bloom_hashes, self.count, self.bloom_bits = _HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an ID index")
+        self.table = _HEADER.size + self.bloom_bits // 8
+
+    def __reduce__(self):
+        return IdIndex, (self.path,)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def size(self) -> int:
+        """The size of the index in bytes, all of which may end up in the page cache."""
+        return len(self.data)
+
+    def _in_bloom(self, key: bytes) -> bool:
+        data, bits = self.data, self.bloom_bits
+        for bit in _bloom_bits(key, self.bloom_hashes):
+            bit %= bits
+            if not data[_HEADER.size + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __contains__(self, id: object) -> bool:
+        if not isinstance(id, str):
+            return False
+        key = id.encode('utf-8')
+        if len(key) > self.width or b'\0' in key:
+            return False
+        if self.bloom_bits > 0 and not self._in_bloom(key):
+            return False
+        key = key.ljust(self.width, b'\0')
+        data, width, table = self.data, self.width, self.table
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = table + middle * width
+            entry = data[start:start + width]
+            if entry < key:
+                low = middle + 1
+            elif entry > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self) -> None:
+        self.data.close()
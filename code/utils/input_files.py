@@ -0,0 +1,258 @@
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import tarfile
+import time
+import zipfile
+from typing import Any, BinaryIO, Container, Iterable, Iterator, Optional, TextIO, Union
+
+from utils.pack import PackRecord, is_pack, mapped_record, pack_compression, read_pack, read_record
+
+ZIP_EXTENSIONS = ('.zip',)
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# the zip archives opened in this process, by (pid, path), as the file offset of a ZipFile opened
+# before a fork is shared with the child
+_zip_files: dict[tuple[int, str], zipfile.ZipFile] = {}
+
+
+class InputFile:
+    """An input file of a prepare script: a file on disk, a member of a zip archive, a member of
+    a tar archive or a record of a pack (see utils.pack). Tar archives can only be read in order,
+    so the content of their members is read in advance into data, and workers get the content
+    instead of the member name.
+    """
+
+    def __init__(self, name: str, size: int, mtime_ns: int, archive: Optional[str] = None,
+                 member: Optional[str] = None, data: Optional[bytes] = None,
+                 crc: Optional[int] = None, digest: Optional[str] = None,
+                 record: Optional[PackRecord] = None, compression: Optional[str] = None):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.archive = archive
+        self.member = member
+        self.data = data
+        self.crc = crc
+        self.digest = digest
+        self.record = record
+        self.compression = compression
+
+    @staticmethod
+    def from_path(path: str) -> 'InputFile':
+        stat = os.stat(path)
+        return InputFile(path, stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def basename(self) -> str:
+        return os.path.basename(self.member if self.member is not None else self.name)
+
+    @property
+    def path(self) -> Optional[str]:
+        """The path of the file if it is on disk."""
+        return self.name if self.archive is None else None
+
+    def mapped(self) -> Optional[tuple[mmap.mmap, int, int]]:
+        """The memory map the content is in, with its start and end there, for an uncompressed
+        record of a pack, which can then be read in place."""
+        if self.record is None or self.compression is not None:
+            return None
+        return mapped_record(self.archive, self.record)
+
+    def open(self) -> BinaryIO:
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if self.record is not None:
+            return io.BytesIO(read_record(self.archive, self.record, self.compression))
+        if self.archive is None:
+            return open(self.name, 'rb')
+        if self.archive.endswith(ZIP_EXTENSIONS):
+            key = (os.getpid(), self.archive)
+            if key not in _zip_files:
+                _zip_files[key] = zipfile.ZipFile(self.archive)
+            return _zip_files[key].open(self.member)
+        raise ValueError(f"The content of tar member {self.name} was not read in advance")
+
+    def open_text(self) -> TextIO:
+        """Open the file as open(path) would, with the locale encoding and universal newlines."""
+        return io.TextIOWrapper(self.open())
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        if self.record is not None:
+            return bytes(read_record(self.archive, self.record, self.compression))
+        with self.open() as input_file:
+            return input_file.read()
+
+    def content_hash(self) -> Optional[str]:
+        """A hash of the content, where one is available without reading a tar archive."""
+        if self.digest is not None:
+            return self.digest
+        if self.crc is not None:
+            return f'crc32:{self.crc:08x}'
+        if self.archive is not None and self.data is None:
+            return None
+        digest = hashlib.sha256()
+        with self.open() as input_file:
+            for block in iter(lambda: input_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+def as_input_file(file: Union[str, InputFile]) -> InputFile:
+    return file if isinstance(file, InputFile) else InputFile.from_path(file)
+
+
+def is_tar(path: str) -> bool:
+    return path.endswith(TAR_EXTENSIONS)
+
+
+class InputManifest:
+    """The listings of the input directories of a prepare script, kept in its output directory
+    for later runs: the mtime of each directory, with its subdirectories and the name, size and
+    mtime of its files with the extension.
+
+    A directory is only scanned again if its mtime changed, which adding, removing or renaming
+    an entry in it does, so discovering the files of a later run over mostly unchanged inputs
+    takes one stat per directory instead of one per file. Files rewritten in place, without
+    replacing them, leave the mtime of their directory alone, so with stat_files, as incremental
+    runs need to find out what changed, the files listed in an unchanged directory are still
+    stat'ed one by one for their sizes and mtimes; rescan ignores the listings altogether.
+    """
+
+    FILE_NAME = 'inputs.json'
+
+    def __init__(self, output_directory: Optional[str], extension: str, rescan: bool = False,
+                 stat_files: bool = False):
+        self.path = os.path.join(output_directory, self.FILE_NAME) if output_directory is not None else None
+        self.extension = extension
+        self.stat_files = stat_files
+        self.directories = {}
+        self.listed = {}
+        self.scanned = 0
+        if self.path is not None and not rescan and os.path.exists(self.path):
+            with open(self.path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['extension'] == extension:
+                self.directories = manifest['directories']
+
+    def _list(self, directory: str) -> dict[str, Any]:
+        mtime = os.stat(directory).st_mtime_ns
+        listing = self.directories.get(directory)
+        if listing is None or listing['mtime'] != mtime:
+            self.scanned += 1
+            listing = {'mtime': mtime, 'directories': [], 'files': []}
+            with os.scandir(directory) as entries:
+                # hidden entries are left out, as by glob
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        listing['directories'].append(entry.name)
+                    elif entry.name.endswith(f'.{self.extension}') and entry.is_file():
+                        stat = entry.stat()
+                        listing['files'].append([entry.name, stat.st_size, stat.st_mtime_ns])
+        elif self.stat_files:
+            files = []
+            for name, _, _ in listing['files']:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue  # removed since the directory was stat'ed
+                files.append([name, stat.st_size, stat.st_mtime_ns])
+            listing = {**listing, 'files': files}
+        self.listed[directory] = listing
+        return listing
+
+    def walk(self, directory: str) -> Iterator[InputFile]:
+        """Yield the files with the extension in directory and its subdirectories as they are
+        found, depth first in name order."""
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            listing = self._list(current)
+            for name, size, mtime_ns in listing['files']:
+                yield InputFile(os.path.join(current, name), size, mtime_ns)
+            stack.extend(os.path.join(current, name) for name in reversed(listing['directories']))
+
+    def save(self) -> None:
+        """Save the listings of the directories walked in this run, dropping those of other
+        directories, such as removed ones."""
+        if self.path is None:
+            return
+        logging.info("Scanned %d of %d input directories.", self.scanned, len(self.listed))
+        with open(self.path + '.tmp', 'w') as manifest_file:
+            json.dump({'extension': self.extension, 'directories': self.listed}, manifest_file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def tar_inputs(inputs: Iterable[str]) -> list[str]:
+    return [input_path for input_path in inputs if not os.path.isdir(input_path) and is_tar(input_path)]
+
+
+def discover_input_files(inputs: Iterable[str], extension: str,
+                         manifest: Optional[InputManifest] = None) -> Iterator[InputFile]:
+    """Yield the files with the given extension in input directories, packs and zip archives as
+    they are found, so that work on them can start before the whole input has been walked. Directories are
+    walked through manifest if given. Tar archives are left out, see tar_inputs."""
+    inputs = list(inputs)
+    for input_path in inputs:
+        if not os.path.isdir(input_path) and not input_path.endswith(ZIP_EXTENSIONS) and not is_tar(input_path):
+            raise ValueError(f"Input {input_path} is neither a directory nor a pack or a tar or zip archive")
+    return _discover(inputs, extension, manifest if manifest is not None else InputManifest(None, extension))
+
+
+def _discover(inputs: list[str], extension: str, manifest: InputManifest) -> Iterator[InputFile]:
+    for input_path in inputs:
+        if is_pack(input_path):
+            # in the order of the records, so that units of work are ranges of them
+            compression = pack_compression(input_path)
+            for record in read_pack(input_path):
+                if record.member.endswith(f'.{extension}'):
+                    yield InputFile(f'{input_path}/{record.member}', record.size, record.mtime_ns, input_path,
+                                    record.member, crc=record.crc, record=record, compression=compression)
+        elif os.path.isdir(input_path):
+            yield from manifest.walk(input_path)
+        elif input_path.endswith(ZIP_EXTENSIONS):
+            with zipfile.ZipFile(input_path) as zip_file:
+                for info in zip_file.infolist():
+                    if not info.is_dir() and info.filename.endswith(f'.{extension}'):
+                        mtime = time.mktime(info.date_time + (0, 0, -1))
+                        yield InputFile(f'{input_path}/{info.filename}', info.file_size,
+                                        int(mtime) * 1_000_000_000, input_path, info.filename, crc=info.CRC)
+
+
+def list_input_files(inputs: Iterable[str], extension: str,
+                     manifest: Optional[InputManifest] = None) -> tuple[list[InputFile], list[str]]:
+    """Find the files with the given extension in input directories, packs and zip archives,
+    sorted by name. Tar archives are returned separately, to be read with read_tar_members."""
+    inputs = list(inputs)
+    files = sorted(discover_input_files(inputs, extension, manifest), key=lambda file: file.name)
+    return files, tar_inputs(inputs)
+
+
+def read_tar_members(archive: str, extension: str, names: Optional[Container[str]] = None,
+                     read: bool = True, hash: bool = False) -> Iterator[InputFile]:
+    """Stream the members of a tar archive with the given extension, in archive order, optionally
+    only those whose InputFile name is in names. Unless read is False, the content of each member
+    is read into its data. With hash, its content hash is computed."""
+    with tarfile.open(archive, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(f'.{extension}'):
+                continue
+            name = f'{archive}/{member.name}'
+            if names is not None and name not in names:
+                continue
+            data = None
+            digest = None
+            if read or hash:
+                with tar.extractfile(member) as member_file:
+                    data = member_file.read()
+                if hash:
+                    digest = hashlib.sha256(data).hexdigest()
+            yield InputFile(name, member.size, int(member.mtime * 1_000_000_000), archive,
+                            member.name, data if read else None, digest=digest)
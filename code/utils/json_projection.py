@@ -0,0 +1,103 @@
+from typing import Any, Iterator, Union
+
+from ijson.common import ObjectBuilder
+
+# what to build of a JSON value: None for all of it, a dict for only the given keys of an
+# object (each projected in turn), or a one-element list for each item of an array
+Projection = Union[None, dict[str, 'Projection'], list['Projection']]
+
+Events = Iterator[tuple[str, Any]]
+
+_STARTS = ('start_map', 'start_array')
+_ENDS = ('end_map', 'end_array')
+
+
+def _skip(events: Events, event: str) -> None:
+    """Consume the rest of the value that started with event, without building anything."""
+    if event not in _STARTS:
+        return
+    depth = 1
+    for event, _ in events:
+        if event in _STARTS:
+            depth += 1
+        elif event in _ENDS:
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _build(events: Events, event: str, value: Any) -> Any:
+    """Build the value that started with (event, value), as ijson.items would."""
+    if event not in _STARTS:
+        return value
+    builder = ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    for event, value in events:
+        builder.event(event, value)
+        if event in _STARTS:
+            depth += 1
+        elif event in _ENDS:
+            depth -= 1
+            if depth == 0:
+                return builder.value
+
+
+def project(events: Events, event: str, value: Any, projection: Projection) -> Any:
+    """Build the value that started with (event, value) from basic_parse events, but only the
+    parts in projection. Values that do not have the shape the projection expects are built in
+    full, so the result behaves like the full value as long as only projected keys are read."""
+    if projection is None:
+        return _build(events, event, value)
+    if isinstance(projection, dict) and event == 'start_map':
+        result = {}
+        for event, key in events:
+            if event == 'end_map':
+                return result
+            event, value = next(events)
+            if key in projection:
+                result[key] = project(events, event, value, projection[key])
+            else:
+                _skip(events, event)
+    if isinstance(projection, list) and event == 'start_array':
+        result = []
+        for event, value in events:
+            if event == 'end_array':
+                return result
+            result.append(project(events, event, value, projection[0]))
+    return _build(events, event, value)
+
+
+def project_items(events: Events, path: list[str], projection: Projection) -> Iterator[Any]:
+    """Like ijson.items(file, '.'.join(path)), but over basic_parse events and building only the
+    projected parts of each item. Everything outside the path is skipped."""
+    yield from _project_items(events, next(events), path, projection)
+    # read to the end, for the same errors on trailing garbage as ijson.items
+    for _ in events:
+        pass
+
+
+def _project_items(events: Events, start: tuple[str, Any], path: list[str],
+                   projection: Projection) -> Iterator[Any]:
+    event, value = start
+    if not path:
+        yield project(events, event, value, projection)
+        return
+    step, rest = path[0], path[1:]
+    if event == 'start_map':
+        for event, key in events:
+            if event == 'end_map':
+                return
+            start = next(events)
+            if key == step:
+                yield from _project_items(events, start, rest, projection)
+            else:
+                _skip(events, start[0])
+    elif event == 'start_array':
+        for start in events:
+            if start[0] == 'end_array':
+                return
+            if step == 'item':
+                yield from _project_items(events, start, rest, projection)
+            else:
+                _skip(events, start[0])
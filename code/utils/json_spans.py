@@ -0,0 +1,103 @@
+import json
+import mmap
+from typing import Any, Callable, Iterator, Optional, Union
+
+_WHITESPACE = json.decoder.WHITESPACE
+
+# the size of the part of the document decoded at a time, which grows for larger items
+WINDOW_SIZE = 16 * 1024 * 1024
+
+
+def _scan(scan_once: Callable[[str, int], tuple[Any, int]], text: str, position: int) -> tuple[Any, int]:
+    try:
+        return scan_once(text, position)
+    except StopIteration as e:
+        raise json.JSONDecodeError("Expecting value", text, e.value) from None
+
+
+def _expect(text: str, position: int, characters: str) -> int:
+    """The position of the first non-whitespace character from position, which must be one of
+    characters."""
+    position = _WHITESPACE.match(text, position).end()
+    if position == len(text) or text[position] not in characters:
+        raise json.JSONDecodeError(f"Expecting one of {characters!r}", text, position)
+    return position
+
+
+def _decode(buffer: Union[bytes, mmap.mmap], start: int, size: int) -> tuple[str, bool]:
+    """Decode up to size bytes of buffer from start, cut back to the last whole character.
+    Returns the text and whether it reaches the end of buffer."""
+    end = min(len(buffer), start + size)
+    if end == len(buffer):
+        return buffer[start:end].decode('utf-8'), True
+    # the window ends before a UTF-8 continuation byte in the middle of a character
+    while end > start and buffer[end] & 0xC0 == 0x80:
+        end -= 1
+    return buffer[start:end].decode('utf-8'), False
+
+
+def _array_start(scan_once: Callable[[str, int], tuple[Any, int]], text: str, array: str) -> Optional[int]:
+    """The position of the first item, or of the closing ], of the array under the key array of the
+    top-level object of text, or None if there is no such array."""
+    position = _expect(text, _expect(text, 0, '{') + 1, '"}')
+    # up to the array, decoding the values of the other keys of the top-level object
+    while text[position] != '}':
+        key, position = _scan(scan_once, text, position)
+        position = _WHITESPACE.match(text, _expect(text, position, ':') + 1).end()
+        if key == array and text[position:position + 1] == '[':
+            return _WHITESPACE.match(text, position + 1).end()
+        _, position = _scan(scan_once, text, position)
+        position = _expect(text, position, ',}')
+        if text[position] == ',':
+            position = _expect(text, position + 1, '"')
+    return None
+
+
+def items_with_spans(buffer: Union[bytes, mmap.mmap], array: str,
+                     window_size: int = WINDOW_SIZE) -> Iterator[tuple[int, int, Any]]:
+    """Yield each item of the array under the key array of the top-level object of the UTF-8 JSON
+    document in buffer, as ijson.items(buffer, f'{array}.item') would, along with its start and
+    end offsets in buffer, so that buffer[start:end] is the item exactly as written. The items are
+    decoded by the C scanner of json, which is considerably faster than building them from ijson
+    events. Only a window of the document is decoded at a time, so buffer can be the memory map
+    of a file larger than the memory."""
+    scan_once = json.JSONDecoder().scan_once
+    size = window_size
+    while True:
+        text, at_end = _decode(buffer, 0, size)
+        try:
+            position = _array_start(scan_once, text, array)
+            break
+        except (json.JSONDecodeError, IndexError):
+            if at_end:
+                raise
+            size *= 2
+    if position is None:
+        return
+    # text[cursor] is at buffer[cursor_offset], counted along as the items are passed
+    cursor, cursor_offset = 0, 0
+    while True:
+        # a window may start in the whitespace before an item
+        position = _WHITESPACE.match(text, position).end()
+        try:
+            if text[position] == ']':
+                return
+            item, end = _scan(scan_once, text, position)
+            following = _expect(text, end, ',]')
+        except (json.JSONDecodeError, IndexError):
+            if at_end:
+                raise
+            # the item goes on past the window: decode from its start, with a larger window if it
+            # already started the window
+            start = cursor_offset + len(text[cursor:position].encode('utf-8'))
+            if position == 0:
+                size *= 2
+            text, at_end = _decode(buffer, start, size)
+            cursor, cursor_offset, position = 0, start, 0
+            continue
+        start = cursor_offset + len(text[cursor:position].encode('utf-8'))
+        cursor, cursor_offset = end, start + len(text[position:end].encode('utf-8'))
+        yield start, cursor_offset, item
+        if text[following] == ']':
+            return
+        position = following + 1
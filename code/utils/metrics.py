@@ -0,0 +1,178 @@
+import fcntl
+import json
+import logging
+import os
+import resource
+import socket
+import time
+from typing import Any, Iterable, Optional
+
+# environment variable naming the JSON run report of a workflow run, which task processes and the
+# scripts they run add their metrics to
+REPORT_VARIABLE = 'FLOPO_METRICS_REPORT'
+
+# the Prometheus textfile written next to a run report, for the node exporter textfile collector
+PROMETHEUS_TEXTFILE = 'flopo.prom'
+
+# the metrics of an entry exported to Prometheus, with their help texts
+PROMETHEUS_METRICS = {
+    'wall_seconds': 'Wall time of the stage',
+    'cpu_seconds': 'CPU time of the stage, including its child processes',
+    'articles': 'Articles processed',
+    'bytes_in': 'Bytes read',
+    'bytes_out': 'Bytes written',
+    'articles_per_second': 'Articles processed per second of wall time',
+    'peak_rss_bytes': 'Peak resident set size of a process of the stage, over the lifetime of the process',
+    'peak_rss_growth_bytes': 'Growth of the peak resident set size of a process during the stage',
+}
+
+
+def _cpu_seconds() -> float:
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux, and the largest of the waited-for children for them. It
+    # is the peak over the lifetime of the process, which cannot be reset at the start of a stage
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Metrics:
+    """Wall time and CPU time of a stage or a worker from its creation on, including child
+    processes once they have exited, along with articles and bytes in and out as counted by the
+    caller. Peak RSS is that of the process and its children over their lifetime, which may
+    have been reached before the stage, so how much it grew during the stage is given too."""
+
+    def __init__(self, stage: str, worker: Optional[str] = None):
+        self.stage = stage
+        self.worker = worker if worker is not None else worker_name()
+        self.articles = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = _cpu_seconds()
+        self.peak_rss_start = _peak_rss_bytes()
+
+    def count_chunks(self, chunks: dict[str, dict[str, int]]) -> None:
+        """Count the articles and bytes of chunks written (see ChunkWriter) as output."""
+        self.articles += sum(chunk['articles'] for chunk in chunks.values())
+        self.bytes_out += sum(chunk['bytes'] for chunk in chunks.values())
+
+    def finish(self, status: str = 'success', workers: Iterable[dict[str, Any]] = ()) -> dict[str, Any]:
+        """The metrics as a report entry, with the entries of the workers of the stage, whose
+        articles and bytes count towards the stage if it did not count its own."""
+        workers = list(workers)
+        wall_seconds = time.perf_counter() - self.wall_start
+        articles = self.articles or sum(worker['articles'] for worker in workers)
+        return {
+            'stage': self.stage,
+            'worker': self.worker,
+            'status': status,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': _cpu_seconds() - self.cpu_start,
+            'articles': articles,
+            'bytes_in': self.bytes_in or sum(worker['bytes_in'] for worker in workers),
+            'bytes_out': self.bytes_out or sum(worker['bytes_out'] for worker in workers),
+            'articles_per_second': articles / wall_seconds if wall_seconds > 0 else 0.0,
+            'peak_rss_bytes': max([_peak_rss_bytes(), *(worker['peak_rss_bytes'] for worker in workers)]),
+            'peak_rss_growth_bytes': max([_peak_rss_bytes() - self.peak_rss_start,
+                                          *(worker['peak_rss_growth_bytes'] for worker in workers)]),
+            'workers': workers,
+        }
+
+
+def path_size(path: str) -> int:
+    """The size of a file, or of the files under a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(directory, file))
+                   for directory, _, files in os.walk(path) for file in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(report: dict[str, Any]) -> str:
+    """The entries of a run report and their workers in the Prometheus text format."""
+    lines = []
+    for metric, help_text in PROMETHEUS_METRICS.items():
+        lines.append(f'# HELP flopo_stage_{metric} {help_text}.')
+        lines.append(f'# TYPE flopo_stage_{metric} gauge')
+        for key, entry in sorted(report['entries'].items()):
+            for worker in [entry, *entry['workers']]:
+                if metric not in worker:
+                    continue  # recorded by an earlier version
+                lines.append(f'flopo_stage_{metric}{{run="{_label(report["run"])}",'
+                             f'stage="{_label(entry["stage"])}",task="{_label(key)}",'
+                             f'worker="{_label(worker["worker"])}"}} {float(worker[metric])}')
+    return '\n'.join(lines) + '\n'
+
+
+def entry_log(report_path: str) -> str:
+    """The log of the entries of the run report at report_path, from which the report is
+    rendered."""
+    return os.path.splitext(report_path)[0] + '.jsonl'
+
+
+def record(report_path: str, key: str, entry: dict[str, Any]) -> None:
+    """Add an entry to the run report at report_path under key, replacing an earlier entry with
+    the same key, by appending it to the entry log of the report. Processes of a run can record
+    concurrently."""
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    line = json.dumps({'key': key, 'entry': entry}) + '\n'
+    with open(entry_log(report_path), 'a') as log_file:
+        # a line of an entry with many workers may be too long to be appended in one write
+        fcntl.flock(log_file, fcntl.LOCK_EX)
+        log_file.write(line)
+
+
+def read_report(report_path: str) -> dict[str, Any]:
+    """The run report at report_path, from its entry log."""
+    report = {'run': os.path.splitext(os.path.basename(report_path))[0], 'entries': {}}
+    if os.path.exists(entry_log(report_path)):
+        with open(entry_log(report_path)) as log_file:
+            for line in log_file:
+                logged = json.loads(line)
+                report['entries'][logged['key']] = logged['entry']
+    return report
+
+
+def render(report_path: str) -> None:
+    """Render the entry log of the run report at report_path into the JSON report and the
+    Prometheus textfile next to it, once at the end of a run."""
+    report = read_report(report_path)
+    with open(report_path + '.tmp', 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+    os.replace(report_path + '.tmp', report_path)
+    textfile = os.path.join(os.path.dirname(report_path) or '.', PROMETHEUS_TEXTFILE)
+    with open(textfile + '.tmp', 'w') as prometheus_file:
+        prometheus_file.write(prometheus_text(report))
+    os.replace(textfile + '.tmp', textfile)
+
+
+def finish_stage(metrics: Metrics, report_path: Optional[str], key: str,
+                 workers: Iterable[dict[str, Any]] = (), status: str = 'success') -> dict[str, Any]:
+    """Log a summary of the metrics of a stage, and record them in the run report at report_path,
+    if any. The report is rendered right away, unless it is the report of the workflow run this
+    stage is part of, which the workflow renders once at its end."""
+    entry = metrics.finish(status, workers)
+    logging.info("%s: %d articles, %.1f MB in, %.1f MB out in %.1f s (%.1f s CPU, %.0f articles/s), "
+                 "peak RSS %.0f MB over the process lifetime, %.0f MB of it during the stage.",
+                 entry['stage'], entry['articles'], entry['bytes_in'] / 1024 / 1024,
+                 entry['bytes_out'] / 1024 / 1024, entry['wall_seconds'], entry['cpu_seconds'],
+                 entry['articles_per_second'], entry['peak_rss_bytes'] / 1024 / 1024,
+                 entry['peak_rss_growth_bytes'] / 1024 / 1024)
+    if report_path is not None:
+        record(report_path, key, entry)
+        if report_path != os.environ.get(REPORT_VARIABLE):
+            render(report_path)
+    return entry
@@ -0,0 +1,169 @@
+import json
+import mmap
+import os
+from typing import Optional, Union
+
+from utils.compression import compress, decompress
+
+# the suffix of the name of a pack, a directory of records that replaces a directory of small input files
+PACK_SUFFIX = '.pack'
+INFO_FILE = 'pack.json'
+INDEX_FILE = 'index.tsv'
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# the memory maps of the data files of packs opened in this process, by (pid, path), as those
+# mapped before a fork would be mapped again in the child anyway
+_maps: dict[tuple[int, str], mmap.mmap] = {}
+
+
+def is_pack(path: str) -> bool:
+    return path.rstrip(os.sep).endswith(PACK_SUFFIX) and os.path.isdir(path)
+
+
+def data_path(pack: str, data_file: int) -> str:
+    return os.path.join(pack, f'data-{data_file:04d}')
+
+
+class PackRecord:
+    """A file in a pack: the name it had in the packed directory, the data file and the offset
+    and length of its record there, and the size, mtime and CRC-32 of its uncompressed content.
+    A record of length -1 marks a file removed since it was packed."""
+    member: str
+    data_file: int
+    offset: int
+    length: int
+    size: int
+    mtime_ns: int
+    crc: int
+
+    def __init__(self, member: str, data_file: int, offset: int, length: int, size: int, mtime_ns: int,
+                 crc: int):
+        self.member = member
+        self.data_file = data_file
+        self.offset = offset
+        self.length = length
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.crc = crc
+
+
+def pack_compression(pack: str) -> Optional[str]:
+    with open(os.path.join(pack, INFO_FILE)) as info_file:
+        return json.load(info_file)['compression']
+
+
+def read_pack(pack: str) -> list[PackRecord]:
+    """The current records of a pack, in the order they are in its data files. The index is only
+    ever appended to, so the last record of each file is its current one. A last line without
+    a newline was cut short by an interrupted run, and is left out like its record."""
+    records = {}
+    with open(os.path.join(pack, INDEX_FILE)) as index_file:
+        for line in index_file:
+            if not line.endswith('\n'):
+                break
+            member, data_file, offset, length, size, mtime_ns, crc = line.rstrip('\n').split('\t')
+            records[member] = PackRecord(member, int(data_file), int(offset), int(length), int(size),
+                                         int(mtime_ns), int(crc))
+    return sorted((record for record in records.values() if record.length >= 0),
+                  key=lambda record: (record.data_file, record.offset))
+
+
+def _map(pack: str, data_file: int) -> mmap.mmap:
+    key = (os.getpid(), data_path(pack, data_file))
+    if key not in _maps:
+        with open(key[1], 'rb') as input_file:
+            _maps[key] = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return _maps[key]
+
+
+def mapped_record(pack: str, record: PackRecord) -> tuple[mmap.mmap, int, int]:
+    """The memory map of the data file of a record, with the start and end of the record in it."""
+    return _map(pack, record.data_file), record.offset, record.offset + record.length
+
+
+def read_record(pack: str, record: PackRecord, compression: Optional[str]) -> Union[bytes, memoryview]:
+    """The content of a record: a view of the memory map of its data file, or its content
+    decompressed."""
+    view = memoryview(_map(pack, record.data_file))[record.offset:record.offset + record.length]
+    return view if compression is None else decompress(view, compression)
+
+
+def _cut_torn_line(path: str) -> None:
+    """Cut a last line without a newline, left by an interrupted run, off the index at path, so
+    that lines appended to it start on a line of their own."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as index_file:
+        end = index_file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 65536)
+            index_file.seek(start)
+            block = index_file.read(position - start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                if start + newline + 1 != end:
+                    index_file.truncate(start + newline + 1)
+                return
+            position = start
+        index_file.truncate(0)
+
+
+class PackWriter:
+    """Appends records to a pack, created if it does not exist, starting a new data file once
+    the current one would grow past max_bytes. Records are written to the data file before their
+    index lines, so a pack left behind by an interrupted run only has records it does not know
+    about, which are never read."""
+
+    FLUSH_RECORDS = 10000
+
+    def __init__(self, pack: str, compression: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.pack = pack
+        self.max_bytes = max_bytes
+        os.makedirs(pack, exist_ok=True)
+        info_path = os.path.join(pack, INFO_FILE)
+        if os.path.exists(info_path):
+            if pack_compression(pack) != compression:
+                raise ValueError(f"{pack} has compression {pack_compression(pack)}, not {compression}")
+        else:
+            with open(info_path, 'w') as info_file:
+                json.dump({'compression': compression}, info_file)
+        self.compression = compression
+        self.data_file = 0
+        while os.path.exists(data_path(pack, self.data_file + 1)):
+            self.data_file += 1
+        self.output = open(data_path(pack, self.data_file), 'ab')
+        _cut_torn_line(os.path.join(pack, INDEX_FILE))
+        self.index = open(os.path.join(pack, INDEX_FILE), 'a')
+        self.lines = []
+
+    def add(self, member: str, data: bytes, mtime_ns: int, crc: int, compressed: Optional[bytes] = None) -> None:
+        """Append the content of a file, compressed in advance if compressed is given."""
+        if compressed is None:
+            compressed = compress(data, self.compression)
+        offset = self.output.tell()
+        if offset > 0 and offset + len(compressed) > self.max_bytes:
+            self.flush()
+            self.output.close()
+            self.data_file += 1
+            self.output = open(data_path(self.pack, self.data_file), 'ab')
+            offset = 0
+        self.output.write(compressed)
+        self.lines.append(f'{member}\t{self.data_file}\t{offset}\t{len(compressed)}\t{len(data)}\t{mtime_ns}\t{crc}\n')
+        if len(self.lines) >= self.FLUSH_RECORDS:
+            self.flush()
+
+    def remove(self, member: str) -> None:
+        self.lines.append(f'{member}\t{self.data_file}\t0\t-1\t0\t0\t0\n')
+
+    def flush(self) -> None:
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.index.writelines(self.lines)
+        self.index.flush()
+        self.lines = []
+
+    def close(self) -> None:
+        self.flush()
+        self.output.close()
+        self.index.close()
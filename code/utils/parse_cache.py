@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+from typing import Optional
+
+from utils.compression import open_file
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024 * 1024
+
+# comment line sent before each paragraph parsed for the cache, which the parser passes through
+# like the ###C: lines of the articles, marking where the parse of the paragraph starts
+PARAGRAPH_MARKER = '###C: flopo-parse-cache-paragraph-'
+
+SENT_ID = re.compile(r'^# sent_id = \d+$', re.MULTILINE)
+# the comment the parser starts a document with at its first paragraph, which belongs before the
+# first paragraph of a chunk, not in whichever paragraph happened to be first when it was cached
+NEWDOC = re.compile(r'^# newdoc(?: id = .*)?\n', re.MULTILINE)
+
+
+def split_input(text: str) -> list[tuple[bool, str]]:
+    """The ###C: lines and the paragraphs of parser input text, in order, as (is paragraph, text)
+    pairs. Paragraphs are runs of non-empty lines other than ###C: lines, which the parser parses
+    independently of each other."""
+    items = []
+    paragraph = []
+    for line in text.split('\n'):
+        if line.startswith('###C:') or line == '':
+            if paragraph:
+                items.append((True, '\n'.join(paragraph)))
+                paragraph = []
+            if line != '':
+                items.append((False, line))
+        else:
+            paragraph.append(line)
+    if paragraph:
+        items.append((True, '\n'.join(paragraph)))
+    return items
+
+
+class ParseCache:
+    """On-disk cache of the parses of paragraphs, stored in SQLite and keyed by a hash of the
+    text of the paragraph and of the version (image digest) of the parser.
+
+    A chunk is parsed through the cache in three steps: write_misses writes the paragraphs of
+    the chunk that are not in the cache into a file for the parser, store adds the parse of that
+    file to the cache, and assemble writes the parse of the chunk from the cache, with the ###C:
+    lines of the chunk in between the paragraphs and the sentences renumbered through the chunk,
+    as the parser would have written it. What the parser writes before its first paragraph, such
+    as its # newdoc line, is cached as the preamble and written before the first paragraph of
+    each chunk, and # newpar lines are cached with the paragraph they start. Like
+    CleanTextCache, it should be on a local disk, and the least recently used parses are evicted
+    by evict().
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path: str, parser_version: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.version = hashlib.sha256(parser_version.encode('utf-8')).digest()
+        # what the parser writes before the first paragraph of its input is cached as that of an
+        # empty paragraph, which there never is
+        self.preamble = self.key('')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.now = int(time.time())
+        self.used_keys = []
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS parsed_paragraph (key BLOB PRIMARY KEY, '
+                                'conll TEXT NOT NULL, size INTEGER NOT NULL, last_used INTEGER NOT NULL)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS parsed_paragraph_last_used ON parsed_paragraph (last_used)')
+
+    def key(self, paragraph: str) -> bytes:
+        return hashlib.blake2b(paragraph.encode('utf-8', 'surrogatepass'), digest_size=20, key=self.version).digest()
+
+    def _lookup(self, keys: list[bytes]) -> dict[bytes, str]:
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            found.update(self.connection.execute(
+                f'SELECT key, conll FROM parsed_paragraph WHERE key IN ({",".join("?" * len(batch))})',
+                batch).fetchall())
+        return found
+
+    def write_misses(self, input_path: str, misses_path: str) -> bool:
+        """Write the distinct paragraphs of the chunk at input_path that are not in the cache into
+        misses_path, each after a PARAGRAPH_MARKER line. Returns whether the parser needs to be
+        run on it, which it also does to find out its preamble if it is not known yet."""
+        with open_file(input_path) as input_file:
+            paragraphs = [text for is_paragraph, text in split_input(input_file.read()) if is_paragraph]
+        keys = [self.key(paragraph) for paragraph in paragraphs]
+        found = self._lookup(list({*keys, self.preamble}))
+        missing = {key: paragraph for key, paragraph in zip(keys, paragraphs) if key not in found}
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        with open(misses_path, 'w') as misses_file:
+            for number, paragraph in enumerate(missing.values()):
+                misses_file.write(f'{PARAGRAPH_MARKER}{number}\n{paragraph}\n\n')
+        return bool(missing) or self.preamble not in found
+
+    def store(self, misses_path: str, parse_path: str) -> None:
+        """Add the parses of the paragraphs in misses_path, parsed into parse_path, to the cache."""
+        with open(misses_path) as misses_file:
+            paragraphs = [text for is_paragraph, text in split_input(misses_file.read()) if is_paragraph]
+        with open(parse_path) as parse_file:
+            blocks = re.split(rf'^{re.escape(PARAGRAPH_MARKER)}\d+\n', parse_file.read(), flags=re.MULTILINE)
+        if len(blocks) != len(paragraphs) + 1:
+            raise ValueError(f"{parse_path} has {len(blocks) - 1} paragraphs instead of {len(paragraphs)}")
+        # the # newdoc line comes after the first marker, as the parser writes it at the first
+        # paragraph, so it is moved to the preamble
+        headers = ''.join(header for block in blocks[1:] for header in NEWDOC.findall(block))
+        entries = [(self.key(paragraph), NEWDOC.sub('', block))
+                   for paragraph, block in zip(paragraphs, blocks[1:])]
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            # the preamble is only stored once, as a parser of a ParserPool only writes it for the
+            # first chunk it is sent
+            self.connection.execute(
+                'INSERT OR IGNORE INTO parsed_paragraph (key, conll, size, last_used) VALUES (?, ?, ?, ?)',
+                self._row(self.preamble, blocks[0] + headers))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO parsed_paragraph (key, conll, size, last_used) VALUES (?, ?, ?, ?)',
+                [self._row(key, conll) for key, conll in entries])
+
+    def _row(self, key: bytes, conll: str) -> tuple[bytes, str, int, int]:
+        return key, conll, len(key) + len(conll.encode('utf-8', 'surrogatepass')), self.now
+
+    def assemble(self, input_path: str, output_path: str, compression: Optional[str] = None) -> None:
+        """Write the parse of the chunk at input_path from the cache, which must have the parses
+        of all its paragraphs."""
+        with open_file(input_path) as input_file:
+            items = split_input(input_file.read())
+        keys = {self.key(text): None for is_paragraph, text in items if is_paragraph}
+        keys[self.preamble] = None
+        parses = self._lookup(list(keys))
+        if len(parses) != len(keys):
+            raise KeyError(f"The parses of {len(keys) - len(parses)} paragraphs of {input_path} are not cached")
+        self.used_keys.extend((self.now, key) for key in keys)
+        if len(self.used_keys) >= self.BATCH_SIZE:
+            self.flush()
+        sentences = 0
+
+        def renumber(match: re.Match) -> str:
+            nonlocal sentences
+            sentences += 1
+            return f'# sent_id = {sentences}'
+
+        with open_file(output_path, 'w', compression) as output_file:
+            preamble = parses[self.preamble]
+            for is_paragraph, text in items:
+                if is_paragraph:
+                    output_file.write(preamble)
+                    preamble = ''
+                    output_file.write(SENT_ID.sub(renumber, parses[self.key(text)]))
+                else:
+                    output_file.write(f'{text}\n')
+
+    def flush(self) -> None:
+        if not self.used_keys:
+            return
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany(
+                'UPDATE parsed_paragraph SET last_used = ? WHERE key = ?', self.used_keys)
+        self.used_keys = []
+
+    def evict(self) -> None:
+        """Remove the least recently used parses until the cache fits in max_size bytes."""
+        self.flush()
+        total_size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM parsed_paragraph').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        cursor = self.connection.execute('SELECT key, size FROM parsed_paragraph ORDER BY last_used')
+        for key, size in cursor:
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        cursor.close()
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('DELETE FROM parsed_paragraph WHERE key = ?', evicted)
+        logging.info("Evicted %d entries from the parse cache %s.", len(evicted), self.path)
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+def evict(path: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+    """Evict the least recently used parses of all parser versions from the parse cache at path,
+    once at the end of a run."""
+    cache = ParseCache(path, '', max_size)
+    try:
+        cache.evict()
+    finally:
+        cache.close()
@@ -0,0 +1,254 @@
+import collections
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Iterable, Optional
+
+from utils.compression import compression_of, open_file
+from utils.parse_cache import NEWDOC, SENT_ID
+
+# comment line sent after each chunk, which the parser passes through like the ###C: lines of
+# the articles, marking where the CONLL of the chunk ends in its output
+END_OF_CHUNK = '###C: flopo-parser-pool-end-of-chunk'
+
+# how long a worker waits for more chunks before closing the input of its parser, so that a
+# parser that only writes its output once it has enough input or at the end writes it out
+IDLE_FLUSH_SECONDS = 1.0
+
+
+class ParserFailure(Exception):
+    pass
+
+
+class _Job:
+
+    def __init__(self, input_path: str, output_path: str):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.attempts = 0
+
+
+class _ParserProcess:
+    """A running parser, with a thread reading its output into the output files of the chunks
+    sent to it, in order. Outputs are written next to their final path and only moved there
+    once complete. Inputs and outputs are decompressed and compressed by the suffix of their
+    paths.
+
+    The parser takes its whole input as one document, so each output is made what the parser
+    would write for the chunk alone: the # newdoc line it writes at its first paragraph is
+    written again before the first paragraph of each later chunk, and the sentences are
+    renumbered from 1 in each chunk."""
+
+    def __init__(self, command: list[str], max_in_flight: int):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        encoding='utf-8')
+        self.in_flight = collections.deque()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.completed = []
+        self.header = ''
+        self.last_output = time.monotonic()
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+
+    def read_output(self) -> None:
+        output = None
+        # whether the first paragraph of the current chunk has been written, the header lines the
+        # parser wrote for it, and the number of its sentences
+        started = False
+        header = ''
+        sentences = 0
+        for line in self.process.stdout:
+            self.last_output = time.monotonic()
+            if not self.in_flight:
+                continue  # output after the last chunk, such as start-up messages
+            if END_OF_CHUNK in line:
+                started = False
+                header = ''
+                sentences = 0
+                job = self.in_flight[0]
+                if output is None:
+                    output = open_file(job.output_path + '.tmp', 'w', compression_of(job.output_path))
+                output.close()
+                output = None
+                os.replace(job.output_path + '.tmp', job.output_path)
+                self.in_flight.popleft()
+                self.completed.append(job)
+                self.slots.release()
+                continue
+            if output is None:
+                job = self.in_flight[0]
+                output = open_file(job.output_path + '.tmp', 'w', compression_of(job.output_path))
+            if NEWDOC.match(line):
+                header += line
+                self.header = header
+                started = True
+            elif not started and line.strip() and not line.startswith('###C:'):
+                output.write(self.header)
+                started = True
+            if SENT_ID.match(line):
+                sentences += 1
+                line = f'# sent_id = {sentences}\n'
+            output.write(line)
+        if output is not None:
+            output.close()
+            os.remove(self.in_flight[0].output_path + '.tmp')
+
+    def send(self, job: _Job) -> None:
+        # the parser has until timeout after each chunk it is sent to write something
+        self.last_output = time.monotonic()
+        self.in_flight.append(job)
+        with open_file(job.input_path) as input_file:
+            for block in iter(lambda: input_file.read(1024 * 1024), ''):
+                self.process.stdin.write(block)
+        self.process.stdin.write(f'\n{END_OF_CHUNK}\n\n')
+        self.process.stdin.flush()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self, timeout: Optional[float] = None) -> Optional[int]:
+        """Close the input of the parser and wait for it to write out its output and exit,
+        killing it if it writes nothing for timeout seconds. Returns its exit code."""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        while self.reader.is_alive():
+            self.reader.join(1)
+            if timeout is not None and time.monotonic() - self.last_output > timeout:
+                logging.error("Parser wrote nothing in %d s, killing it.", timeout)
+                self.process.kill()
+                timeout = None
+        return self.process.wait()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.close()
+
+
+class ParserPool:
+    """Pool of long-lived parser processes, such as parser containers, started once and fed chunk
+    after chunk over their standard input, so that start-up and model loading are paid once per
+    worker instead of once per chunk.
+
+    The parser must pass END_OF_CHUNK comment lines through to its output in order, as the
+    TurkuNLP parser does with ###C: lines. Each worker keeps up to max_in_flight chunks sent to its
+    parser. It closes the input of the parser when it runs out of chunks, or when the parser has
+    written nothing for flush_after seconds with max_in_flight chunks sent, so that parsers that
+    buffer their output write it out, and goes on with a new parser. A parser that exits before all the chunks sent to it are
+    parsed, or writes nothing for timeout seconds while it has chunks in flight, is killed and
+    restarted, and its unfinished chunks handed out again. Only the first of them, the one it
+    was parsing, counts as a failed attempt, and a chunk fails after max_attempts of them.
+    """
+
+    def __init__(self, command: list[str], workers: int, max_in_flight: int = 2,
+                 flush_after: float = 60, max_attempts: int = 3, timeout: Optional[float] = 3600):
+        self.command = command
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.flush_after = flush_after
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.jobs = queue.Queue()
+        self.remaining = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.failures = []
+
+    def parse(self, chunks: Iterable[tuple[str, str]]) -> None:
+        """Parse (input path, output path) pairs of chunks, raising ParserFailure if a chunk
+        could not be parsed."""
+        for input_path, output_path in chunks:
+            self.jobs.put(_Job(input_path, output_path))
+            self.remaining += 1
+        if self.remaining == 0:
+            return
+        threads = [threading.Thread(target=self.run_worker, args=(number,), daemon=True)
+                   for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.failures:
+            raise self.failures[0]
+
+    def run_worker(self, number: int) -> None:
+        parser = None
+        try:
+            while not self.done.is_set():
+                try:
+                    job = self.jobs.get(timeout=IDLE_FLUSH_SECONDS)
+                except queue.Empty:
+                    if parser is not None:
+                        self.finish(number, parser, parser.close(self.timeout))
+                        parser = None
+                    continue
+                if parser is None:
+                    logging.info("Starting parser worker %d.", number)
+                    parser = _ParserProcess(self.command, self.max_in_flight)
+                while not parser.slots.acquire(timeout=1):
+                    if not self.healthy(parser):
+                        break
+                    if time.monotonic() - parser.last_output > self.flush_after:
+                        logging.info("Parser worker %d wrote nothing in %d s, closing its input for "
+                                     "it to write out its output.", number, self.flush_after)
+                        self.finish(number, parser, parser.close(self.timeout))
+                        parser = _ParserProcess(self.command, self.max_in_flight)
+                else:
+                    if self.healthy(parser):
+                        try:
+                            parser.send(job)
+                            continue
+                        except BrokenPipeError:
+                            pass
+                    else:
+                        parser.slots.release()
+                # the parser died or hangs, so it is restarted with its chunks, and the chunk not
+                # sent to it only counts it as an attempt if there were no others to blame
+                if job not in parser.in_flight:
+                    self.retry(job, not parser.in_flight)
+                parser.kill()
+                self.finish(number, parser, parser.process.returncode)
+                parser = None
+        except BaseException as exception:
+            self.failures.append(exception)
+            self.done.set()
+        finally:
+            if parser is not None:
+                parser.kill()
+
+    def healthy(self, parser: _ParserProcess) -> bool:
+        if not parser.alive():
+            return False
+        if self.timeout is not None and parser.in_flight and \
+                time.monotonic() - parser.last_output > self.timeout:
+            logging.error("Parser wrote nothing in %d s, restarting it.", self.timeout)
+            return False
+        return True
+
+    def finish(self, number: int, parser: _ParserProcess, exit_code: Optional[int]) -> None:
+        """Account for the chunks of a parser that exited, handing out the unfinished ones again."""
+        for job in parser.completed:
+            logging.info("Parsed %s.", job.input_path)
+        with self.lock:
+            self.remaining -= len(parser.completed)
+            if self.remaining == 0:
+                self.done.set()
+        if parser.in_flight:
+            logging.error("Parser worker %d exited with code %s with %d chunks unfinished, "
+                          "restarting it.", number, exit_code, len(parser.in_flight))
+            for index, job in enumerate(parser.in_flight):
+                self.retry(job, index == 0)
+            parser.in_flight.clear()
+
+    def retry(self, job: _Job, failed: bool = True) -> None:
+        """Hand out a chunk again, counting an attempt at it if it failed rather than only being
+        in flight behind the chunk that did."""
+        if failed:
+            job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            raise ParserFailure(f"Parsing {job.input_path} failed {job.attempts} times")
+        self.jobs.put(job)
@@ -0,0 +1,152 @@
+import glob
+import io
+import os
+import re
+from typing import BinaryIO, Iterable, Optional
+
+from utils.compression import compression_of, open_file
+
+# the suffix of the section index of a chunk or parse file, next to it
+INDEX_SUFFIX = '.idx'
+
+_SECTION_LINE = b'###C: '
+# the article of a section, by the suffixes the prepare scripts give the ids of its sections
+_ARTICLE_ID = re.compile(r'(.*)_(?:title|ingress|body)(?:_\d+)?')
+
+
+def article_id(section_id: str) -> str:
+    match = _ARTICLE_ID.fullmatch(section_id)
+    return match.group(1) if match is not None else section_id
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+class Location:
+    """Where a section, or the consecutive sections of an article, is in a chunk or parse file:
+    the offset and length in bytes of its ###C: line and what follows it, in the uncompressed
+    content of the file."""
+    id: str
+    path: str
+    offset: int
+    length: int
+
+    def __init__(self, id: str, path: str, offset: int, length: int):
+        self.id = id
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+
+def _open_binary(path: str) -> BinaryIO:
+    input_file = open_file(path, 'rb')
+    # decompressing streams do not all split lines or read as much as asked for
+    return input_file if compression_of(path) is None else io.BufferedReader(input_file)
+
+
+def write_index(path: str, sections: Iterable[tuple[str, int, int]]) -> None:
+    """Write the (section id, offset, length) of each section of the file at path into its index."""
+    with open(index_path(path) + '.tmp', 'w') as index_file:
+        for section_id, offset, length in sections:
+            index_file.write(f'{section_id}\t{offset}\t{length}\n')
+    os.replace(index_path(path) + '.tmp', index_path(path))
+
+
+def scan_sections(path: str) -> list[tuple[str, int, int]]:
+    """The (section id, offset, length) of each section of a chunk or parse file, by its ###C:
+    lines."""
+    sections = []
+    offset = 0
+    with _open_binary(path) as input_file:
+        for line in input_file:
+            if line.startswith(_SECTION_LINE):
+                sections.append([line[len(_SECTION_LINE):].rstrip(b'\r\n').decode('utf-8'), offset, 0])
+            if sections:
+                sections[-1][2] += len(line)
+            offset += len(line)
+    return [tuple(section) for section in sections]
+
+
+def index_file(path: str) -> None:
+    write_index(path, scan_sections(path))
+
+
+def read_index(path: str) -> list[tuple[str, int, int]]:
+    """The sections of the file at path from its index, which is rebuilt first if missing or
+    older than the file."""
+    if not os.path.exists(index_path(path)) or os.path.getmtime(index_path(path)) < os.path.getmtime(path):
+        index_file(path)
+    sections = []
+    with open(index_path(path)) as input_file:
+        for line in input_file:
+            section_id, offset, length = line.rstrip('\n').split('\t')
+            sections.append((section_id, int(offset), int(length)))
+    return sections
+
+
+def locate(paths: Iterable[str], ids: Iterable[str]) -> list[Location]:
+    """The locations of the sections with the given ids, or of the sections of the articles with
+    the given ids, in the files at paths. The sections of an article are located as one if they
+    follow each other."""
+    ids = set(ids)
+    locations = []
+    for path in paths:
+        for section_id, offset, length in read_index(path):
+            id = section_id if section_id in ids else article_id(section_id)
+            if id not in ids:
+                continue
+            previous = locations[-1] if locations else None
+            if id != section_id and previous is not None and previous.id == id and previous.path == path and \
+                    previous.offset + previous.length == offset:
+                previous.length += length
+            else:
+                locations.append(Location(id, path, offset, length))
+    return locations
+
+
+def dataset_files(directory: str, extension: str) -> list[str]:
+    """The chunk or parse files with the extension, txt or conll, in directory."""
+    return sorted(path for path in glob.glob(os.path.join(directory, f'chunk-*.{extension}*'))
+                  if not path.endswith(INDEX_SUFFIX) and re.fullmatch(
+                      rf'chunk-.+\.{extension}(\.gz|\.zst)?', os.path.basename(path)))
+
+
+def extract(location: Location) -> bytes:
+    """The bytes at a location. Compressed files are decompressed up to it."""
+    with _open_binary(location.path) as input_file:
+        if compression_of(location.path) is None:
+            input_file.seek(location.offset)
+        else:
+            remaining = location.offset
+            while remaining > 0:
+                skipped = len(input_file.read(min(remaining, 1024 * 1024)))
+                if skipped == 0:
+                    break
+                remaining -= skipped
+        return input_file.read(location.length)
+
+
+def replace_sections(path: str, sections: dict[str, bytes], compression: Optional[str] = None) -> int:
+    """Replace the sections with the given ids in the file at path by the given bytes, which start
+    with their ###C: line, and reindex it. Returns the number of sections replaced."""
+    if compression is None:
+        compression = compression_of(path)
+    replaced = 0
+    with _open_binary(path) as input_file:
+        content = input_file.read()
+    parts = []
+    position = 0
+    for section_id, offset, length in scan_sections(path):
+        if section_id in sections:
+            parts.append(content[position:offset])
+            parts.append(sections[section_id])
+            position = offset + length
+            replaced += 1
+    parts.append(content[position:])
+    with open_file(path + '.tmp', 'wb', compression) as output_file:
+        for part in parts:
+            output_file.write(part)
+    os.replace(path + '.tmp', path)
+    index_file(path)
+    return replaced
@@ -0,0 +1,453 @@
+import argparse
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from utils.chunk_manifest import ChunkManifest, ChunkWriter, save_chunk_sizes
+from utils.clean_text_cache import CleanTextCache, finish_run
+from utils.input_files import (InputFile, InputManifest, discover_input_files, is_tar, list_input_files,
+                               read_tar_members, tar_inputs)
+from utils.metrics import Metrics, finish_stage, worker_name
+from utils.pack import is_pack
+
+# writes the articles of an input file to a ChunkWriter, cleaning their text with the given function
+ProcessFile = Callable[[InputFile, ChunkWriter, Callable[[str], str]], None]
+# creates the ChunkWriter for a prefix, optionally in incremental mode
+NewChunkWriter = Callable[..., ChunkWriter]
+# reads the articles of an input file for the pipeline, without cleaning their text
+ReadArticles = Callable[[InputFile], Iterable[Any]]
+# cleans an article read by ReadArticles with the given function, into (section id, text) pairs
+CleanArticle = Callable[[Any, Callable[[str], str]], list[tuple[str, str]]]
+
+MAX_UNIT_SIZE = 16 * 1024 * 1024
+MAX_UNIT_FILES = 100
+# input files sorted largest first at a time, when they are handed out as they are found
+LARGEST_FIRST_WINDOW = 10000
+# articles sent from a pipeline reader to the cleaning workers at a time
+PIPELINE_BATCH_ARTICLES = 100
+# batches that may be in the pipeline at once, per cleaning worker
+PIPELINE_BATCHES_PER_PROCESS = 4
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def sort_largest_first(items: Iterable[T], window: Optional[int] = LARGEST_FIRST_WINDOW,
+                  key: Callable[[T], Any] = lambda file: (file.size, file.name)) -> Iterator[T]:
+    """Input files, or items with the key of one, largest first within each run of window of
+    them, so that a stream of files can be handed out before it has been read to its end. With
+    window None, all of them are sorted."""
+    if window is None:
+        yield from sorted(items, key=key, reverse=True)
+        return
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, window))
+        if not batch:
+            return
+        yield from sorted(batch, key=key, reverse=True)
+
+
+def work_units(files: Iterable[InputFile], max_unit_size: int = MAX_UNIT_SIZE,
+               max_unit_files: int = MAX_UNIT_FILES, largest_first_window: Optional[int] = None,
+               largest_first: bool = True) -> Iterator[list[InputFile]]:
+    """Split input files into small units of work of at most max_unit_files files, cut once they
+    reach max_unit_size bytes. By default the largest files come first, so that no long unit is
+    left to hold up the end of a run, within each run of largest_first_window files if given."""
+    if largest_first:
+        files = sort_largest_first(files, largest_first_window)
+    unit = []
+    unit_size = 0
+    for file in files:
+        unit.append(file)
+        unit_size += file.size
+        if unit_size >= max_unit_size or len(unit) >= max_unit_files:
+            yield unit
+            unit = []
+            unit_size = 0
+    if unit:
+        yield unit
+
+
+def _imap_bounded(pool: multiprocessing.pool.Pool, function: Callable[[T], R], iterable: Iterable[T],
+                  limit: int) -> Iterator[R]:
+    """pool.imap_unordered, but reading at most limit items of iterable ahead of their results.
+    The pool would otherwise read all of it at once, which for tar members means their content."""
+    slots = threading.Semaphore(limit)
+    stopped = threading.Event()
+
+    def items() -> Iterator[T]:
+        for item in iterable:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield item
+
+    try:
+        for result in pool.imap_unordered(function, items()):
+            slots.release()
+            yield result
+    finally:
+        # let the pool stop reading items if the results are not all in
+        stopped.set()
+        slots.release()
+
+
+class _Worker:
+    """State of a pool worker: its clean text cache and its metrics."""
+
+    def __init__(self, process_file: ProcessFile, new_chunk_writer: NewChunkWriter, cache: Optional[str],
+                 stage: str, closing):
+        self.process_file = process_file
+        self.new_chunk_writer = new_chunk_writer
+        self.clean_text_cache = CleanTextCache(cache)
+        self.metrics = Metrics(stage)
+        self.closing = closing
+
+    def process_unit(self, unit: tuple[int, list[InputFile]]) -> dict[str, dict[str, int]]:
+        number, input_files = unit
+        output = self.new_chunk_writer(number)
+        try:
+            for input_file in input_files:
+                self.process_file(input_file, output, self.clean_text_cache.clean_text)
+                self.metrics.bytes_in += input_file.size
+        finally:
+            output.close()
+        self.metrics.count_chunks(output.chunks)
+        return output.chunks
+
+    def close(self) -> tuple[int, int, dict[str, Any]]:
+        # wait for all workers to get their close task, so that each gets exactly one
+        self.closing.wait()
+        self.clean_text_cache.close()
+        return self.clean_text_cache.hits, self.clean_text_cache.misses, self.metrics.finish()
+
+
+_worker: Optional[_Worker] = None
+
+
+def _init_worker(*args) -> None:
+    global _worker
+    _worker = _Worker(*args)
+
+
+def _process_unit(unit: tuple[int, list[InputFile]]) -> dict[str, dict[str, int]]:
+    return _worker.process_unit(unit)
+
+
+def _close_worker(_) -> tuple[int, int, dict[str, Any]]:
+    return _worker.close()
+
+
+def process_files(process_file: ProcessFile, units: Iterable[list[InputFile]],
+                  new_chunk_writer: NewChunkWriter, cache: Optional[str], processes: int,
+                  stage: str = 'prepare') -> tuple[list[tuple[int, int, dict[str, Any]]], dict[str, dict[str, int]]]:
+    """Process units of input files on a pool of processes, handing them out as workers become
+    free. Each unit is written by the worker that gets it into its own chunks, prefixed with the
+    number of the unit, so that the chunks do not depend on the number of processes or on which
+    worker was free first. Returns the clean text cache hits and misses and the metrics of each
+    worker, and the chunk sizes."""
+    closing = multiprocessing.Barrier(processes)
+    chunks = {}
+    with multiprocessing.Pool(processes, _init_worker, (process_file, new_chunk_writer, cache, stage,
+                                                        closing)) as pool:
+        for unit_chunks in _imap_bounded(pool, _process_unit, enumerate(units), 2 * processes):
+            chunks.update(unit_chunks)
+        results = pool.map(_close_worker, range(processes), chunksize=1)
+    return results, chunks
+
+
+def _process_group(process_file: ProcessFile, new_chunk_writer: NewChunkWriter, cache: Optional[str],
+                   stage: str, group: tuple[int, list[InputFile]]) -> tuple[int, int, int, dict[str, dict[str, int]], dict[str, Any]]:
+    prefix, input_files = group
+    metrics = Metrics(stage, f'{worker_name()}/{prefix}')
+    output = new_chunk_writer(prefix, incremental=True)
+    clean_text_cache = CleanTextCache(cache)
+    try:
+        for input_file in input_files:
+            process_file(input_file, output, clean_text_cache.clean_text)
+            metrics.bytes_in += input_file.size
+    finally:
+        output.close()
+        clean_text_cache.close()
+    metrics.count_chunks(output.chunks)
+    return prefix, clean_text_cache.hits, clean_text_cache.misses, output.chunks, metrics.finish()
+
+
+def process_groups(process_file: ProcessFile, groups: Iterable[tuple[int, list[InputFile]]],
+                   new_chunk_writer: NewChunkWriter, cache: Optional[str], processes: int,
+                   stage: str = 'prepare') -> list[tuple[int, int, int, dict[str, dict[str, int]], dict[str, Any]]]:
+    """Process numbered groups of input files (see ChunkManifest) on a pool of processes, each
+    group into its own chunks prefixed with the group number. Returns the group, clean text
+    cache hits and misses, chunk sizes and metrics of each group, in order of completion."""
+    with multiprocessing.Pool(processes) as pool:
+        return list(_imap_bounded(pool, functools.partial(
+            _process_group, process_file, new_chunk_writer, cache, stage), groups, 2 * processes))
+
+
+class _Reader:
+    """State of a pipeline reader: its stream number, and the queue it sends batches of articles
+    to, each taking one of the pipeline slots."""
+
+    def __init__(self, read_articles: ReadArticles, batches, slots, reader_numbers):
+        with reader_numbers.get_lock():
+            self.number = reader_numbers.value
+            reader_numbers.value += 1
+        self.read_articles = read_articles
+        self.batches = batches
+        self.slots = slots
+        self.sequence = 0
+
+    def read_unit(self, unit: tuple[Optional[int], list[InputFile]]) -> tuple[int, int]:
+        """Send the articles of a unit of files on the stream of the reader, or of a group on its
+        own stream, closed once all its articles are sent. Returns the number of batches sent and
+        the bytes read."""
+        group, files = unit
+        stream, sequence = (self.number, self.sequence) if group is None else (group, 0)
+        first_sequence = sequence
+        batch = []
+        for input_file in files:
+            for article in self.read_articles(input_file):
+                batch.append(article)
+                if len(batch) >= PIPELINE_BATCH_ARTICLES:
+                    self.send(stream, sequence, batch)
+                    sequence += 1
+                    batch = []
+        if batch:
+            self.send(stream, sequence, batch)
+            sequence += 1
+        if group is None:
+            self.sequence = sequence
+        else:
+            self.send(stream, sequence, None)
+            sequence += 1
+        return sequence - first_sequence, sum(input_file.size for input_file in files)
+
+    def send(self, stream: int, sequence: int, batch: Optional[list[Any]]) -> None:
+        # wait for a slot, so that a fast reader cannot fill the memory with articles
+        self.slots.acquire()
+        self.batches.put((stream, sequence, batch))
+
+
+_reader: Optional[_Reader] = None
+
+
+def _init_reader(*args) -> None:
+    global _reader
+    _reader = _Reader(*args)
+
+
+def _read_unit(unit: tuple[Optional[int], list[InputFile]]) -> tuple[int, int]:
+    return _reader.read_unit(unit)
+
+
+_cleaner: Optional[tuple] = None
+
+
+def _init_cleaner(*args) -> None:
+    global _cleaner
+    _cleaner = args
+
+
+def _clean_batches() -> tuple[int, int, dict[str, Any]]:
+    """Clean batches of articles until a None item, returning the clean text cache hits and
+    misses and the metrics of the worker. The end of a stream (a None batch) is passed on as is."""
+    clean_article, batches, results, cache, stage = _cleaner
+    clean_text_cache = CleanTextCache(cache)
+    metrics = Metrics(stage)
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            stream, sequence, batch = item
+            if batch is not None:
+                batch = [clean_article(article, clean_text_cache.clean_text) for article in batch]
+                metrics.articles += len(batch)
+            results.put((stream, sequence, batch))
+    finally:
+        clean_text_cache.close()
+    return clean_text_cache.hits, clean_text_cache.misses, metrics.finish()
+
+
+def pipeline(read_articles: ReadArticles, clean_article: CleanArticle,
+             units: Iterable[tuple[Optional[int], list[InputFile]]], new_chunk_writer: NewChunkWriter,
+             cache: Optional[str], readers: int, processes: int, incremental: bool = False,
+             stage: str = 'prepare') -> tuple[list[tuple[int, int, dict[str, Any]]], dict[int, dict[str, dict[str, int]]], int]:
+    """Process units of input files in a pipeline, so that the articles of a single large file
+    are cleaned on all processes: readers read articles from the files, processes workers clean
+    them and this process writes them, in the order they were read.
+
+    A unit is either (None, files), written to the stream of chunks of the reader, or (group,
+    files) for a numbered group written to chunks of its own. At most PIPELINE_BATCHES_PER_PROCESS
+    batches per worker are read ahead of writing. Returns the clean text cache hits and misses and
+    the metrics of each worker, the chunk sizes of each stream and the bytes read."""
+    batches = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    slots = multiprocessing.Semaphore(PIPELINE_BATCHES_PER_PROCESS * processes)
+    # batches sent and bytes read by the readers, known once they are all done, and failures of
+    # the readers
+    sent = []
+    bytes_read = []
+    failures = []
+    with multiprocessing.Pool(readers, _init_reader, (read_articles, batches, slots,
+                                                      multiprocessing.Value('i', 0))) as reader_pool, \
+            multiprocessing.Pool(processes, _init_cleaner, (clean_article, batches, results, cache,
+                                                            stage)) as cleaner_pool:
+        cleaning = [cleaner_pool.apply_async(_clean_batches) for _ in range(processes)]
+
+        def read() -> None:
+            try:
+                read_units = list(_imap_bounded(reader_pool, _read_unit, units, 2 * readers))
+                bytes_read.append(sum(unit_bytes for _, unit_bytes in read_units))
+                sent.append(sum(unit_batches for unit_batches, _ in read_units))
+            except BaseException as exception:
+                failures.append(exception)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        writers = {}
+        pending = {}
+        next_sequence = {}
+        chunks = {}
+        received = 0
+        # a queue put returns before the item is sent, so batches are counted in rather than
+        # followed by an end marker, which could overtake them
+        while not sent or received < sent[0]:
+            try:
+                stream, sequence, batch = results.get(timeout=1)
+            except queue.Empty:
+                if failures:
+                    raise failures[0]
+                for result in cleaning:
+                    if result.ready() and not result.successful():
+                        result.get()
+                continue
+            received += 1
+            pending.setdefault(stream, {})[sequence] = batch
+            while next_sequence.get(stream, 0) in pending[stream]:
+                batch = pending[stream].pop(next_sequence.get(stream, 0))
+                next_sequence[stream] = next_sequence.get(stream, 0) + 1
+                if stream not in writers:
+                    writers[stream] = new_chunk_writer(stream, incremental=incremental)
+                if batch is None:
+                    writers[stream].close()
+                    chunks[stream] = writers.pop(stream).chunks
+                else:
+                    for sections in batch:
+                        writers[stream].write_article(sections)
+                slots.release()
+        for stream, writer in writers.items():
+            writer.close()
+            chunks[stream] = writer.chunks
+        for _ in range(processes):
+            batches.put(None)
+        return [result.get() for result in cleaning], chunks, bytes_read[0]
+
+
+def _read_groups(groups: list[tuple[int, list[InputFile]]], tar_archives: list[str],
+                 extension: str) -> Iterator[tuple[int, list[InputFile]]]:
+    """Yield the groups to rebuild, largest first, except for groups with tar members, which are
+    yielded once the content of all their members has been read from the archives."""
+    pending = {}
+    members = {}
+    for group, files in groups:
+        for index, file in enumerate(files):
+            if file.archive is not None and is_tar(file.archive):
+                members[file.name] = (group, index)
+                pending[group] = pending.get(group, 0) + 1
+    files_of = dict(groups)
+    yield from sorted(((group, files) for group, files in groups if group not in pending),
+                      key=lambda group: sum(file.size for file in group[1]), reverse=True)
+    for archive in tar_archives:
+        for member in read_tar_members(archive, extension, members.keys()):
+            group, index = members[member.name]
+            if files_of[group][index].data is not None:
+                continue  # a later copy of the same member
+            files_of[group][index] = member
+            pending[group] -= 1
+            if pending[group] == 0:
+                yield group, files_of[group]
+
+
+def prepare(process_file: ProcessFile, inputs: list[str], extension: str, args: argparse.Namespace,
+            script: str, group_size: int, read_articles: Optional[ReadArticles] = None,
+            clean_article: Optional[CleanArticle] = None) -> None:
+    """Run a prepare script on the files with the given extension in its input directories and
+    archives, with the common command line arguments. In incremental mode, groups of group_size
+    files are kept in a ChunkManifest. Scripts that can read and clean articles separately run
+    them through pipeline() with args.pipeline. Input directories are listed through an
+    InputManifest in the output directory, rescanned in full with args.rescan, with the files
+    stat'ed one by one in incremental mode to find those rewritten in place. With args.metrics,
+    the metrics of the run and of each worker are recorded in that run report."""
+    stage = os.path.splitext(os.path.basename(script))[0]
+    metrics = Metrics(stage)
+    pipelined = read_articles is not None and args.pipeline
+    new_chunk_writer = functools.partial(ChunkWriter, args.output_directory, split=args.split,
+                                         max_bytes=args.max_bytes, max_tokens=args.max_tokens,
+                                         compression=args.compression)
+    input_manifest = InputManifest(args.output_directory, extension, args.rescan, stat_files=args.incremental)
+    chunks = {}
+    if args.incremental:
+        files, tar_archives = list_input_files(inputs, extension, input_manifest)
+        manifest = ChunkManifest(args.output_directory, script, args.split, group_size, args.hash,
+                                 args.max_bytes, args.max_tokens, args.compression)
+        # finding out what changed in a tar archive takes a pass over it
+        listed = files + [member for archive in tar_archives
+                          for member in read_tar_members(archive, extension, read=False,
+                                                          hash=args.hash)]
+        groups = _read_groups(manifest.plan(listed), tar_archives, extension)
+        if pipelined:
+            results, group_chunks, metrics.bytes_in = pipeline(
+                read_articles, clean_article, groups, new_chunk_writer, args.cache, args.readers,
+                args.processes, incremental=True, stage=stage)
+            counts = [(hits, misses) for hits, misses, _ in results]
+            workers = [worker for _, _, worker in results]
+        else:
+            results = process_groups(process_file, groups, new_chunk_writer, args.cache,
+                                     args.processes, stage)
+            counts = [(hits, misses) for _, hits, misses, _, _ in results]
+            group_chunks = {group: chunks_of_group for group, _, _, chunks_of_group, _ in results}
+            workers = [worker for _, _, _, _, worker in results]
+        finish_run(args.cache, args.cache_size, counts)
+        for group, chunks_of_group in group_chunks.items():
+            manifest.record(group, list(chunks_of_group))
+            chunks.update(chunks_of_group)
+        manifest.remove_stale_chunks()
+        manifest.save()
+    else:
+        # files are handed out as the walk finds them, largest first within a window of them, the
+        # records of packs in their order, which pack-inputs.py sorted the same way, and tar
+        # members in archive order, as they stream past. Each unit is written to chunks of its
+        # own, prefixed with its number, whichever worker gets it
+        units = itertools.chain(work_units(discover_input_files(
+            [input_path for input_path in inputs if not is_pack(input_path)], extension, input_manifest),
+            largest_first_window=LARGEST_FIRST_WINDOW), work_units(discover_input_files(
+                [input_path for input_path in inputs if is_pack(input_path)], extension), largest_first=False), *(
+            work_units(read_tar_members(archive, extension), largest_first=False)
+            for archive in tar_inputs(inputs)))
+        if pipelined:
+            results, stream_chunks, metrics.bytes_in = pipeline(
+                read_articles, clean_article, enumerate(units), new_chunk_writer,
+                args.cache, args.readers, args.processes, stage=stage)
+            counts = [(hits, misses) for hits, misses, _ in results]
+            worker_chunks = list(stream_chunks.values())
+            workers = [worker for _, _, worker in results]
+        else:
+            results, written_chunks = process_files(process_file, units, new_chunk_writer, args.cache,
+                                                    args.processes, stage)
+            counts = [(hits, misses) for hits, misses, _ in results]
+            worker_chunks = [written_chunks]
+            workers = [worker for _, _, worker in results]
+        finish_run(args.cache, args.cache_size, counts)
+        for chunks_of_worker in worker_chunks:
+            chunks.update(chunks_of_worker)
+    input_manifest.save()
+    save_chunk_sizes(args.output_directory, chunks, update=args.incremental)
+    metrics.count_chunks(chunks)
+    finish_stage(metrics, args.metrics, f'{stage}:{args.output_directory}', workers)
@@ -3,58 +3,503 @@
 """
 
 import glob
+import heapq
+import json
 import logging
+import os
 import re
 import shutil
+import tempfile
+import time
+from typing import Optional
 
 import luigi
 from luigi_support.forceable_task import ForceableTask
+from luigi_support.formats import compression_format
 from plumbum import FG, local
+from utils.chunk_manifest import CHUNK_SIZES_FILE, estimate_tokens, file_digest, load_chunk_sizes
+from utils.compression import SUFFIXES, compressed_name, compression_of, open_file
+from utils.dedup import SUMMARY_FILE, fan_out, read_duplicates
+from utils.metrics import REPORT_VARIABLE, render
+from utils.parse_cache import ParseCache, evict
+from utils.parser_pool import ParserPool
+from utils.section_index import INDEX_SUFFIX, index_file
 
 logging.basicConfig(level=logging.INFO)
 
+# what a parser container takes by default: the TurkuNLP models and their working memory, and
+# the cores its torch threads keep busy
+PARSER_CPUS = 2
+PARSER_MEMORY_MB = 4096
+
+PARSER_IMAGE = 'hsci/turku-neural-parser-openshift:latest'
+
+# streaming (de)compressors of the intermediate files piped through the parser containers
+DECOMPRESS_COMMANDS = {'gzip': ['gzip', '-dc'], 'zstd': ['zstd', '-dcq']}
+COMPRESS_COMMANDS = {'gzip': ['gzip', '-cn'], 'zstd': ['zstd', '-cq']}
+
 
 def log_and_execute(cmd):
     logging.info("Executing %s.", cmd)
     cmd & FG
 
 
+def up_to_date(output_path: str, input_paths: list[str]) -> bool:
+    """make-style check that output_path exists and is not older than any of input_paths."""
+    if not os.path.exists(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(input_path) <= output_mtime
+               for input_path in input_paths if os.path.exists(input_path))
+
+
+def node_resources() -> dict[str, int]:
+    """The cores and memory of this node, as Luigi resources."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    memory_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024 // 1024
+    return {'cpus': cpus, 'memory_mb': memory_mb}
+
+
+def configure_resources() -> None:
+    """Default the Luigi resources and the number of workers to what this node has room for,
+    unless they are set in the Luigi configuration or on the command line. With a central
+    scheduler, its own configuration applies instead."""
+    config = luigi.configuration.get_config()
+    resources = node_resources()
+    for resource, amount in resources.items():
+        if not config.has_option('resources', resource):
+            if not config.has_section('resources'):
+                config.add_section('resources')
+            config.set('resources', resource, str(amount))
+    if not config.has_option('core', 'workers'):
+        if not config.has_section('core'):
+            config.add_section('core')
+        config.set('core', 'workers', str(max(1, min(
+            config.getint('resources', 'cpus') // PARSER_CPUS,
+            config.getint('resources', 'memory_mb') // PARSER_MEMORY_MB))))
+
+
+def configure_metrics() -> None:
+    """Have the tasks of this run, and the scripts they run, record their metrics in a run report
+    in data/metrics, with the Prometheus textfile data/metrics/flopo.prom next to it, unless
+    FLOPO_METRICS_REPORT names another run report. The entries are appended to the entry log of
+    the report as the tasks finish, and the report is rendered from it at the end of the run."""
+    os.environ.setdefault(REPORT_VARIABLE, f'data/metrics/run-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.json')
+
+
+def dedup_group(datasets: list[str]) -> str:
+    """The name of the deduplication group of datasets, its directory under data/processed/dedup."""
+    return '+'.join(datasets)
+
+
+def chunks_directory(dataset: str, dedup: Optional[str] = None) -> str:
+    """The directory of the chunks of a dataset, deduplicated in the deduplication group dedup
+    if given."""
+    if dedup is not None:
+        return f'data/processed/dedup/{dedup}/for-turkunlp/{dataset}'
+    return f'data/processed/for-turkunlp/{dataset}'
+
+
+def chunk_sizes(dataset: str, compression: Optional[str] = None,
+                dedup: Optional[str] = None) -> dict[str, dict[str, int]]:
+    """The sizes of the chunks of a dataset from its chunk sizes file, or measured from the
+    chunk files if it has none."""
+    directory = chunks_directory(dataset, dedup)
+    if os.path.exists(os.path.join(directory, CHUNK_SIZES_FILE)):
+        return load_chunk_sizes(directory)
+    sizes = {}
+    for source in glob.glob(compressed_name(f'{directory}/chunk-*.txt', compression)):
+        with open_file(source) as chunk_file:
+            tokens = estimate_tokens(chunk_file.read())
+        sizes[os.path.basename(source)] = {'bytes': os.path.getsize(source), 'tokens': tokens}
+    return sizes
+
+
+def plan_schedule(durations: dict[str, float], slots: int) -> tuple[list[list[tuple[float, str]]], float]:
+    """Assign tasks largest first to the slot that frees up first, as the scheduler will,
+    returning the (start time, task) pairs of each slot and the makespan."""
+    schedule = [[] for _ in range(slots)]
+    free = [(0.0, slot) for slot in range(slots)]
+    for task, duration in sorted(durations.items(), key=lambda item: item[1], reverse=True):
+        start, slot = heapq.heappop(free)
+        schedule[slot].append((start, task))
+        heapq.heappush(free, (start + duration, slot))
+    return schedule, max(end for end, _ in free)
+
+
+def remove_stale_outputs(dataset: str, compression: Optional[str] = None) -> None:
+    """Remove the parses, chunk CSVs and chunk Parquet files of chunks that no longer exist, and
+    the parses and chunk CSVs compressed otherwise than with compression."""
+    suffixes = '|'.join(re.escape(suffix) for suffix in SUFFIXES.values())
+    for output in [*glob.glob(f'data/processed/conll/{dataset}/chunk-*.conll*'),
+                   *glob.glob(f'data/processed/conll-csv/{dataset}/chunks/chunk-*.csv*'),
+                   *glob.glob(f'data/processed/conll-parquet/{dataset}/chunk-*.parquet')]:
+        match = re.fullmatch(rf".*chunk-(.+)\.(conll|csv|parquet)({suffixes})?", output)
+        if match is None:
+            continue
+        # Parquet files are compressed internally, whatever the compression of the other files
+        if (match.group(2) != 'parquet' and compression_of(output) != compression) or \
+                not os.path.exists(compressed_name(
+                    f'data/processed/for-turkunlp/{dataset}/chunk-{match.group(1)}.txt', compression)):
+            logging.info("Removing stale %s.", output)
+            os.remove(output)
+    for index in glob.glob(f'data/processed/conll/{dataset}/chunk-*.conll*{INDEX_SUFFIX}'):
+        if not os.path.exists(index[:-len(INDEX_SUFFIX)]):
+            os.remove(index)
+
+
+def concatenate_csv(inputs: list[luigi.LocalTarget], output: str) -> None:
+    """Concatenate CSV files with the same header into output, keeping the header once."""
+    header = None
+    with open(output + '.tmp', 'wb') as output_file:
+        for input_target in inputs:
+            with input_target.open('r') as input_file:
+                first_line = input_file.readline()
+                if header is None:
+                    header = first_line
+                    output_file.write(first_line)
+                elif first_line != header:
+                    output_file.write(first_line)
+                shutil.copyfileobj(input_file, output_file, 1024 * 1024)
+    os.replace(output + '.tmp', output)
+
+
+def parser_command(container_system: str) -> list[str]:
+    """Command running the TurkuNLP parser on its standard input. The 'fake' container system
+    runs a stand-in for trying out the workflow without the parser."""
+    if container_system == 'singularity':
+        return ['singularity', 'run', f'docker://{PARSER_IMAGE}']
+    if container_system == 'fake':
+        return ['./code/fake-turkunlp-parser.py']
+    return ['docker', 'run', '-i', PARSER_IMAGE]
+
+
+def parser_version(container_system: str) -> Optional[str]:
+    """The version of the parser that the parse cache is keyed by: the digest of its image, or of
+    the stand-in script. None for singularity, which pulls the image only to run it."""
+    if container_system == 'fake':
+        return file_digest('./code/fake-turkunlp-parser.py')
+    if container_system == 'docker':
+        return local['docker']['image', 'inspect', '--format', '{{.Id}}', PARSER_IMAGE]().strip()
+    return None
+
+
 class PrepareForTurkuNLP(ForceableTask):
     dataset = luigi.Parameter()
+    inputs = luigi.ListParameter(
+        default=[], description='Input directories or tar/zip archives, by default data/input/{dataset}')
     split = luigi.IntParameter()
+    max_chunk_bytes = luigi.OptionalIntParameter(default=None)
+    max_chunk_tokens = luigi.OptionalIntParameter(default=None)
+    clean_text_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Clean text cache file (on a local disk) to reuse cleaned fields across runs')
+    incremental = luigi.BoolParameter(
+        default=False, significant=False, description='Only rebuild the chunks whose input files changed')
+    compression = luigi.OptionalParameter(default=None, description='Compress the chunks with gzip or zstd')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.done = False
+
+    def complete(self):
+        # in incremental mode, the inputs need to be checked for changes on every run
+        if self.incremental:
+            return self.done
+        return super().complete()
 
     def output(self):
         return luigi.LocalTarget(f'data/processed/for-turkunlp/{self.dataset}')
 
+    def metrics_inputs(self):
+        return self.inputs or [f'data/input/{self.dataset}']
+
+    def metrics_articles(self):
+        return sum(size['articles'] for size in chunk_sizes(self.dataset, self.compression).values())
+
+    def run_internal(self):
+        inputs = self.inputs or [f'data/input/{self.dataset}']
+        command = local[f"./code/prepare-{self.dataset}-for-turkunlp.py"]['-i', *inputs, '-o', self.output().path, '-s', self.split]
+        if self.max_chunk_bytes is not None:
+            command = command['--max-bytes', self.max_chunk_bytes]
+        if self.max_chunk_tokens is not None:
+            command = command['--max-tokens', self.max_chunk_tokens]
+        if self.incremental:
+            command = command['--incremental']
+        else:
+            shutil.rmtree(self.output().path, ignore_errors=True)
+        if self.clean_text_cache is not None:
+            command = command['-c', self.clean_text_cache]
+        if self.compression is not None:
+            command = command['--compression', self.compression]
+        if REPORT_VARIABLE in os.environ:
+            command = command['--metrics', os.environ[REPORT_VARIABLE]]
+        log_and_execute(command)
+        self.done = True
+
+
+class Deduplicate(ForceableTask):
+    """Finds the sections of the chunks of the datasets that duplicate, exactly or nearly, a
+    section of a dataset before them or earlier in the same dataset, into
+    data/processed/dedup/{group}, so that only one section of each group of duplicates is
+    parsed."""
+    datasets = luigi.ListParameter(description='Prepared datasets to deduplicate together, in order of preference')
+    compression = luigi.OptionalParameter(default=None)
+    threshold = luigi.FloatParameter(
+        default=0.9, description='Estimated similarity of word shingles over which sections are near duplicates')
+    exact_only = luigi.BoolParameter(default=False, description='Only find exact duplicates')
+
+    def output(self):
+        return luigi.LocalTarget(f'data/processed/dedup/{dedup_group(self.datasets)}/{SUMMARY_FILE}')
+
+    def chunk_paths(self) -> list[str]:
+        return [path for dataset in self.datasets
+                for path in glob.glob(compressed_name(f'{chunks_directory(dataset)}/chunk-*.txt', self.compression))]
+
+    def complete(self):
+        # found again whenever a chunk or the settings change
+        if not os.path.exists(self.output().path):
+            return False
+        with open(self.output().path) as summary_file:
+            settings = json.load(summary_file)['settings']
+        return settings['datasets'] == list(self.datasets) and settings['threshold'] == self.threshold and \
+            settings['exact_only'] == self.exact_only and settings['compression'] == self.compression and \
+            up_to_date(self.output().path, [*(chunks_directory(dataset) for dataset in self.datasets),
+                                            *self.chunk_paths()])
+
+    def metrics_inputs(self):
+        return [chunks_directory(dataset) for dataset in self.datasets]
+
     def run_internal(self):
-        shutil.rmtree(self.output().path, ignore_errors=True)
-        log_and_execute(
-            local[f"./code/prepare-{self.dataset}-for-turkunlp.py"]['-i', f'data/input/{self.dataset}', '-o', self.output().path, '-s', self.split])
+        command = local['./code/deduplicate-chunks.py'][
+            '-i', [f'{dataset}={chunks_directory(dataset)}' for dataset in self.datasets],
+            '-o', os.path.dirname(self.output().path), '--threshold', self.threshold]
+        if self.exact_only:
+            command = command['--exact-only']
+        if self.compression is not None:
+            command = command['--compression', self.compression]
+        if REPORT_VARIABLE in os.environ:
+            command = command['--metrics', os.environ[REPORT_VARIABLE]]
+        log_and_execute(command)
 
 
 class TurkuNLPChunk(ForceableTask):
     dataset = luigi.Parameter()
     chunk = luigi.Parameter()
     container_system = luigi.Parameter()
+    compression = luigi.OptionalParameter(default=None)
+    dedup = luigi.OptionalParameter(default=None, description='Deduplication group whose deduplicated chunk to parse')
+    tokens = luigi.IntParameter(default=0, significant=False,
+                                description='Estimated number of tokens in the chunk')
+    parser_cpus = luigi.IntParameter(default=PARSER_CPUS, significant=False)
+    parser_memory_mb = luigi.IntParameter(default=PARSER_MEMORY_MB, significant=False)
+    parse_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Parse cache file (on a local disk) to reuse the parses of paragraphs across runs and datasets')
+    parser_version = luigi.OptionalParameter(
+        default=None, significant=False, description='Version of the parser to key the parse cache by, by default the digest of its image')
+
+    @property
+    def priority(self):
+        # the largest chunks first, so that none of them is left to hold up the end
+        return self.tokens
+
+    @property
+    def resources(self):
+        # a container larger than the whole node still gets to run, alone
+        config = luigi.configuration.get_config()
+        return {'cpus': min(self.parser_cpus, config.getint('resources', 'cpus', self.parser_cpus)),
+                'memory_mb': min(self.parser_memory_mb,
+                                 config.getint('resources', 'memory_mb', self.parser_memory_mb))}
+
+    def input_path(self):
+        return compressed_name(f'{chunks_directory(self.dataset, self.dedup)}/chunk-{self.chunk}.txt',
+                               self.compression)
 
     def output(self):
-        return luigi.LocalTarget(f'data/processed/conll/{self.dataset}/chunk-{self.chunk}.conll')
+        directory = f'data/processed/dedup/{self.dedup}/conll' if self.dedup is not None else 'data/processed/conll'
+        return luigi.LocalTarget(compressed_name(f'{directory}/{self.dataset}/chunk-{self.chunk}.conll',
+                                                 self.compression), format=compression_format(self.compression))
+
+    def complete(self):
+        # chunks rewritten by an incremental PrepareForTurkuNLP need to be parsed again
+        return up_to_date(self.output().path, [self.input_path()])
+
+    def metrics_inputs(self):
+        return [self.input_path()]
+
+    def cache_version(self) -> Optional[str]:
+        """The parser version to key the parse cache by, or None to parse without it."""
+        if self.parse_cache is None:
+            return None
+        version = self.parser_version or parser_version(self.container_system)
+        if version is None:
+            logging.warning("No parser version to key the parse cache by with %s, parsing chunk-%s without it. "
+                            "Set parser_version to use it.", self.container_system, self.chunk)
+        return version
+
+    def misses_paths(self) -> tuple[str, str]:
+        """The paragraphs of the chunk missing from the parse cache, and their parse. They are
+        kept apart from the parses, as remove_stale_outputs may go through those meanwhile."""
+        directory = os.path.join(os.path.dirname(self.output().path), '.parse-cache')
+        name = os.path.join(directory, os.path.basename(self.output().path))
+        return name + '.misses.txt', name + '.misses.conll'
+
+    def write_misses(self, cache: ParseCache) -> bool:
+        """Write the paragraphs missing from the parse cache, returning whether to parse them."""
+        os.makedirs(os.path.dirname(self.misses_paths()[0]), exist_ok=True)
+        return cache.write_misses(self.input_path(), self.misses_paths()[0])
+
+    def assemble(self, cache: ParseCache, parsed: bool) -> None:
+        """Add the parse of the missing paragraphs, if parsed, to the parse cache, and put the
+        parse of the chunk together from it."""
+        misses_path, misses_parse_path = self.misses_paths()
+        if parsed:
+            cache.store(misses_path, misses_parse_path)
+            os.remove(misses_parse_path)
+        os.remove(misses_path)
+        with self.output().temporary_path() as output_path:
+            cache.assemble(self.input_path(), output_path, self.compression)
 
     def run_internal(self):
         self.output().makedirs()
-        if self.container_system == 'singularity':
-            container_command = local['singularity']['run',
-                                                     'docker://hsci/turku-neural-parser-openshift:latest']
-        else:
-            container_command = local['docker']['run', '-i',
-                                                'hsci/turku-neural-parser-openshift:latest']
-        log_and_execute(
-            (container_command < f'data/processed/for-turkunlp/{self.dataset}/chunk-{self.chunk}.txt') > self.output().path)
+        command = parser_command(self.container_system)
+        parser = local[command[0]][command[1:]]
+        version = self.cache_version()
+        if version is not None:
+            # only the paragraphs missing from the cache go to the parser
+            cache = ParseCache(self.parse_cache, version)
+            try:
+                parse = self.write_misses(cache)
+                if parse:
+                    misses_path, misses_parse_path = self.misses_paths()
+                    log_and_execute((parser < misses_path) > misses_parse_path)
+                self.assemble(cache, parse)
+                logging.info("Parse cache %s: %d of %d paragraphs of chunk-%s found.", self.parse_cache,
+                             cache.hits, cache.hits + cache.misses, self.chunk)
+            finally:
+                cache.close()
+            index_file(self.output().path)
+            return
+        # the parse only appears once complete, as tasks converting it may check for it meanwhile
+        with self.output().temporary_path() as output_path:
+            if self.compression is None:
+                log_and_execute((parser < self.input_path()) > output_path)
+            else:
+                # the chunk is decompressed and the parse compressed on the fly around the container
+                decompress = DECOMPRESS_COMMANDS[self.compression]
+                compress = COMPRESS_COMMANDS[self.compression]
+                log_and_execute((local[decompress[0]][decompress[1:]][self.input_path()] | parser |
+                                 local[compress[0]][compress[1:]]) > output_path)
+        index_file(self.output().path)
+
+
+class FanOutChunk(ForceableTask):
+    """Puts together the parse of a chunk of a dataset deduplicated in a deduplication group
+    from the parse of its deduplicated chunk and the parses of the representatives of its
+    duplicates, each under the ###C: line of the duplicate."""
+    dataset = luigi.Parameter()
+    chunk = luigi.Parameter()
+    container_system = luigi.Parameter()
+    compression = luigi.OptionalParameter(default=None)
+    dedup = luigi.Parameter()
+    tokens = luigi.IntParameter(default=0, significant=False,
+                                description='Estimated number of tokens in the chunk')
+    parse_cache = luigi.OptionalParameter(default=None, significant=False)
+
+    @property
+    def priority(self):
+        return self.tokens
+
+    def chunk_path(self):
+        return compressed_name(f'{chunks_directory(self.dataset)}/chunk-{self.chunk}.txt', self.compression)
+
+    def duplicates_path(self):
+        return f'data/processed/dedup/{self.dedup}/duplicates/{self.dataset}/chunk-{self.chunk}.tsv'
+
+    def parse_task(self, dataset: str, chunk: str) -> TurkuNLPChunk:
+        sizes = chunk_sizes(dataset, self.compression, self.dedup)
+        return TurkuNLPChunk(dataset=dataset, chunk=chunk, container_system=self.container_system,
+                             compression=self.compression, dedup=self.dedup, parse_cache=self.parse_cache,
+                             tokens=sizes.get(compressed_name(f'chunk-{chunk}.txt', self.compression), {}).get('tokens', 0))
+
+    def requires(self):
+        # the chunk itself has no parse if it only has duplicates
+        chunks = set()
+        if os.path.exists(self.duplicates_path()):
+            chunks = {(duplicate.dataset, duplicate.chunk) for duplicate in read_duplicates(self.duplicates_path())}
+        if os.path.exists(self.parse_task(self.dataset, self.chunk).input_path()):
+            chunks.add((self.dataset, self.chunk))
+        return [self.parse_task(dataset, chunk) for dataset, chunk in sorted(chunks)]
+
+    def output(self):
+        return luigi.LocalTarget(compressed_name(f'data/processed/conll/{self.dataset}/chunk-{self.chunk}.conll',
+                                                 self.compression), format=compression_format(self.compression))
+
+    def complete(self):
+        tasks = self.requires()
+        return all(task.complete() for task in tasks) and up_to_date(
+            self.output().path, [self.chunk_path(), self.duplicates_path(), *(task.output().path for task in tasks)])
+
+    def metrics_inputs(self):
+        return [self.chunk_path()]
+
+    def run_internal(self):
+        self.output().makedirs()
+        own = self.parse_task(self.dataset, self.chunk)
+        with self.output().temporary_path() as output_path:
+            fan_out(self.chunk_path(), read_duplicates(self.duplicates_path()),
+                    own.output().path if os.path.exists(own.input_path()) else None,
+                    {(task.dataset, task.chunk): task.output().path for task in self.requires()},
+                    output_path, self.compression)
+        index_file(self.output().path)
+
+
+def fan_out_chunks(dataset: str, container_system: str, dedup: str, compression: Optional[str] = None,
+                   parse_cache: Optional[str] = None) -> list[FanOutChunk]:
+    """The fan-out tasks of the chunks of a dataset deduplicated in a deduplication group,
+    largest first."""
+    return [FanOutChunk(dataset=dataset, chunk=task.chunk, container_system=container_system,
+                        compression=compression, dedup=dedup, tokens=task.tokens, parse_cache=parse_cache)
+            for task in turkunlp_chunks(dataset, container_system, compression)]
+
+
+def turkunlp_chunks(dataset: str, container_system: str, compression: Optional[str] = None,
+                    parser_cpus: int = PARSER_CPUS, parser_memory_mb: int = PARSER_MEMORY_MB,
+                    parse_cache: Optional[str] = None) -> list[TurkuNLPChunk]:
+    """The parse tasks of the chunks of a dataset, largest first."""
+    sizes = chunk_sizes(dataset, compression)
+    suffix = re.escape(compressed_name('.txt', compression))
+    tasks = []
+    for source in glob.glob(compressed_name(f'data/processed/for-turkunlp/{dataset}/chunk-*.txt', compression)):
+        chunk = re.fullmatch(rf".*chunk-(.+){suffix}", source).group(1)
+        tasks.append(TurkuNLPChunk(dataset=dataset, container_system=container_system,
+                                   compression=compression, chunk=chunk,
+                                   tokens=sizes.get(os.path.basename(source), {}).get('tokens', 0),
+                                   parser_cpus=parser_cpus, parser_memory_mb=parser_memory_mb,
+                                   parse_cache=parse_cache))
+    tasks.sort(key=lambda task: task.tokens, reverse=True)
+    return tasks
 
 
 class TurkuNLP(ForceableTask):
     dataset = luigi.Parameter()
     container_system = luigi.Parameter()
+    compression = luigi.OptionalParameter(default=None, description='Compression of the chunks and parses, gzip or zstd')
+    parser_workers = luigi.IntParameter(
+        default=0, significant=False, description='Parse on this many long-lived parser containers instead of one container per chunk')
+    parser_cpus = luigi.IntParameter(
+        default=PARSER_CPUS, significant=False, description='Cores each parser container takes, of the cpus resource')
+    parser_memory_mb = luigi.IntParameter(
+        default=PARSER_MEMORY_MB, significant=False, description='Memory each parser container takes, of the memory_mb resource')
+    parser_tokens_per_second = luigi.FloatParameter(
+        default=500, significant=False, description='Parsing speed of a container, for dry_run')
+    parser_startup_seconds = luigi.FloatParameter(
+        default=60, significant=False, description='Start-up time of a container, for dry_run')
+    dry_run = luigi.BoolParameter(
+        default=False, significant=False, description='Only print the planned order of the chunks to parse and the estimated makespan')
+    dedup = luigi.OptionalParameter(
+        default=None, description='Deduplication group (see Deduplicate) whose deduplicated chunks to parse, fanning the parses out to the duplicates')
+    parse_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Parse cache file (on a local disk) to reuse the parses of paragraphs across runs and datasets')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -63,44 +508,298 @@ class TurkuNLP(ForceableTask):
     def complete(self):
         return self.done
 
+    def parse_tasks(self) -> list[TurkuNLPChunk]:
+        """The parse tasks of the chunks of the dataset or, deduplicated, of the deduplicated
+        chunks their parses are put together from, largest first."""
+        if self.dedup is None:
+            return turkunlp_chunks(self.dataset, self.container_system, self.compression,
+                                   self.parser_cpus, self.parser_memory_mb, self.parse_cache)
+        tasks = {}
+        for fan_out_task in fan_out_chunks(self.dataset, self.container_system, self.dedup, self.compression,
+                                           self.parse_cache):
+            for task in fan_out_task.requires():
+                tasks.setdefault((task.dataset, task.chunk), task)
+        return sorted(tasks.values(), key=lambda task: task.tokens, reverse=True)
+
     def run_internal(self):
-        tasks = []
-        for source in glob.glob(f'data/processed/for-turkunlp/{self.dataset}/chunk-*.txt'):
-            chunk = re.match(r".*chunk-(.+)\.txt", source).group(1)
-            tasks.append(TurkuNLPChunk(dataset=self.dataset,
-                         container_system=self.container_system, chunk=chunk))
-        yield tasks
+        if self.dry_run:
+            # nothing is removed or evicted, and the stale outputs are of no parse task anyway
+            self.print_schedule([task for task in self.parse_tasks() if not task.complete()])
+            self.done = True
+            return
+        remove_stale_outputs(self.dataset, self.compression)
+        tasks = self.parse_tasks()
+        if self.parser_workers > 0:
+            tasks = [task for task in tasks if not task.complete()]
+            for task in tasks:
+                task.output().makedirs()
+            pool = ParserPool(parser_command(self.container_system), self.parser_workers)
+            version = tasks[0].cache_version() if tasks else None
+            if version is not None:
+                cache = ParseCache(self.parse_cache, version)
+                try:
+                    parsed = [task for task in tasks if task.write_misses(cache)]
+                    pool.parse(task.misses_paths() for task in parsed)
+                    for task in tasks:
+                        task.assemble(cache, task in parsed)
+                    logging.info("Parse cache %s: %d of %d paragraphs found.", self.parse_cache,
+                                 cache.hits, cache.hits + cache.misses)
+                finally:
+                    cache.close()
+            else:
+                pool.parse((task.input_path(), task.output().path) for task in tasks)
+            for task in tasks:
+                index_file(task.output().path)
+            if self.dedup is not None:
+                yield fan_out_chunks(self.dataset, self.container_system, self.dedup, self.compression,
+                                     self.parse_cache)
+        elif self.dedup is not None:
+            yield fan_out_chunks(self.dataset, self.container_system, self.dedup, self.compression,
+                                 self.parse_cache)
+        else:
+            yield tasks
+        if self.parse_cache is not None:
+            evict(self.parse_cache)
         self.done = True
 
+    def print_schedule(self, tasks: list[TurkuNLPChunk]) -> None:
+        speed = self.parser_tokens_per_second
+        if self.parser_workers > 0:
+            # the containers are started once, before the first chunk
+            slots = self.parser_workers
+            durations = {f'{task.dataset}/chunk-{task.chunk}': task.tokens / speed for task in tasks}
+            offset = self.parser_startup_seconds
+        else:
+            config = luigi.configuration.get_config()
+            slots = max(1, min(config.getint('core', 'workers', 1),
+                               config.getint('resources', 'cpus', 1) // self.parser_cpus,
+                               config.getint('resources', 'memory_mb', 1) // self.parser_memory_mb))
+            durations = {f'{task.dataset}/chunk-{task.chunk}': self.parser_startup_seconds + task.tokens / speed
+                         for task in tasks}
+            offset = 0
+        schedule, makespan = plan_schedule(durations, slots)
+        for slot, slot_tasks in enumerate(schedule):
+            print(f"Parser {slot}:")
+            for start, chunk in slot_tasks:
+                print(f"  {offset + start:10.0f} s  {chunk} ({durations[chunk]:.0f} s)")
+        print(f"{len(tasks)} chunks to parse on {slots} parsers in parallel, estimated makespan "
+              f"{(offset + makespan) / 3600:.2f} hours")
+
+
+class CONLLChunkToCSV(ForceableTask):
+    dataset = luigi.Parameter()
+    chunk = luigi.Parameter()
+    container_system = luigi.Parameter()
+    compression = luigi.OptionalParameter(default=None)
+    dedup = luigi.OptionalParameter(default=None)
+    tokens = luigi.IntParameter(default=0, significant=False,
+                                description='Estimated number of tokens in the chunk')
+    parse_cache = luigi.OptionalParameter(default=None, significant=False)
+    resources = {'cpus': 1}
+
+    @property
+    def priority(self):
+        return self.tokens
+
+    def requires(self):
+        if self.dedup is not None:
+            return FanOutChunk(dataset=self.dataset, chunk=self.chunk, container_system=self.container_system,
+                               compression=self.compression, dedup=self.dedup, tokens=self.tokens,
+                               parse_cache=self.parse_cache)
+        return TurkuNLPChunk(dataset=self.dataset, chunk=self.chunk, container_system=self.container_system,
+                             compression=self.compression, tokens=self.tokens, parse_cache=self.parse_cache)
+
+    def output(self):
+        return luigi.LocalTarget(compressed_name(f'data/processed/conll-csv/{self.dataset}/chunks/chunk-{self.chunk}.csv',
+                                                 self.compression), format=compression_format(self.compression))
+
+    def complete(self):
+        return up_to_date(self.output().path, [self.requires().output().path])
+
+    def run_internal(self):
+        self.output().makedirs()
+        if self.compression is None:
+            with self.output().temporary_path() as output_path:
+                log_and_execute(local['flopo-convert']['-f', 'conll', '-t', 'csv',
+                                                       '-i', self.requires().output().path, '-o', output_path])
+            return
+        # flopo-convert reads and writes plain files, so it gets decompressed copies
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(self.output().path)) as directory:
+            conll_path = os.path.join(directory, f'chunk-{self.chunk}.conll')
+            csv_path = os.path.join(directory, f'chunk-{self.chunk}.csv')
+            with self.requires().output().open('r') as input_file, open(conll_path, 'wb') as output_file:
+                shutil.copyfileobj(input_file, output_file, 1024 * 1024)
+            log_and_execute(local['flopo-convert']['-f', 'conll', '-t', 'csv', '-i', conll_path, '-o', csv_path])
+            with open(csv_path, 'rb') as input_file, self.output().open('w') as output_file:
+                shutil.copyfileobj(input_file, output_file, 1024 * 1024)
+
 
 class CONLLToCSV(ForceableTask):
+    """Converts the parse of each chunk to CSV as soon as it is done, and merges the chunk CSVs
+    into the single CSV the Octavo indexer reads."""
     dataset = luigi.Parameter()
+    container_system = luigi.Parameter(default='docker')
+    compression = luigi.OptionalParameter(
+        default=None, description='Compression of the chunks, parses and chunk CSVs, gzip or zstd')
+    dedup = luigi.OptionalParameter(default=None, description='Deduplication group the dataset was parsed in')
+    parse_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Parse cache file (on a local disk) to reuse the parses of paragraphs across runs and datasets')
 
     def output(self):
         return luigi.LocalTarget(f'data/processed/conll-csv/{self.dataset}/{self.dataset}-conll.csv')
 
+    def chunk_tasks(self) -> list[CONLLChunkToCSV]:
+        return [CONLLChunkToCSV(dataset=self.dataset, chunk=task.chunk, container_system=self.container_system,
+                                compression=self.compression, dedup=self.dedup, tokens=task.tokens,
+                                parse_cache=self.parse_cache)
+                for task in turkunlp_chunks(self.dataset, self.container_system, self.compression)]
+
+    def complete(self):
+        # every chunk is parsed and converted, and no chunk CSV is left over from removed chunks
+        tasks = self.chunk_tasks()
+        chunk_directory = f'data/processed/conll-csv/{self.dataset}/chunks'
+        csvs = glob.glob(compressed_name(f'{chunk_directory}/chunk-*.csv', self.compression))
+        # the directory mtime changes when chunk CSVs are removed
+        return all(task.complete() and task.requires().complete() for task in tasks) and \
+            len(csvs) == len(tasks) and up_to_date(self.output().path, [chunk_directory, *csvs])
+
     def run_internal(self):
+        remove_stale_outputs(self.dataset, self.compression)
+        tasks = self.chunk_tasks()
+        yield tasks
         self.output().makedirs()
-        log_and_execute(local['flopo-convert']['-f', 'conll', '-t', 'csv', '-r',
-                                               '-i', f'data/processed/conll/{self.dataset}', '-o', self.output().path])
+        # the merged CSV stays uncompressed for the indexer
+        concatenate_csv([task.output() for task in sorted(tasks, key=lambda task: task.output().path)],
+                        self.output().path)
+
+
+class CONLLChunkToParquet(ForceableTask):
+    dataset = luigi.Parameter()
+    chunk = luigi.Parameter()
+    container_system = luigi.Parameter()
+    compression = luigi.OptionalParameter(default=None)
+    dedup = luigi.OptionalParameter(default=None)
+    tokens = luigi.IntParameter(default=0, significant=False,
+                                description='Estimated number of tokens in the chunk')
+    parse_cache = luigi.OptionalParameter(default=None, significant=False)
+    resources = {'cpus': 1}
+
+    @property
+    def priority(self):
+        return self.tokens
+
+    def requires(self):
+        return CONLLChunkToCSV(dataset=self.dataset, chunk=self.chunk, container_system=self.container_system,
+                               compression=self.compression, dedup=self.dedup, tokens=self.tokens,
+                               parse_cache=self.parse_cache)
+
+    def output(self):
+        return luigi.LocalTarget(f'data/processed/conll-parquet/{self.dataset}/chunk-{self.chunk}.parquet')
+
+    def complete(self):
+        return up_to_date(self.output().path, [self.requires().output().path])
+
+    def run_internal(self):
+        self.output().makedirs()
+        log_and_execute(local['./code/conll-csv-to-parquet.py']['-i', self.requires().output().path,
+                                                                 '-o', self.output().path])
+
+
+class CONLLToParquet(ForceableTask):
+    """Converts the CSV of each chunk to Parquet for analytics, partitioned by chunk into
+    data/processed/conll-parquet/{dataset}, which e.g. pyarrow.dataset and pandas.read_parquet
+    read as a single table. The Octavo indexer keeps reading the CSV."""
+    dataset = luigi.Parameter()
+    container_system = luigi.Parameter(default='docker')
+    compression = luigi.OptionalParameter(
+        default=None, description='Compression of the chunks, parses and chunk CSVs, gzip or zstd')
+    dedup = luigi.OptionalParameter(default=None, description='Deduplication group the dataset was parsed in')
+    parse_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Parse cache file (on a local disk) to reuse the parses of paragraphs across runs and datasets')
+
+    def output(self):
+        return luigi.LocalTarget(f'data/processed/conll-parquet/{self.dataset}')
+
+    def chunk_tasks(self) -> list[CONLLChunkToParquet]:
+        return [CONLLChunkToParquet(dataset=self.dataset, chunk=task.chunk, container_system=self.container_system,
+                                    compression=self.compression, dedup=self.dedup, tokens=task.tokens,
+                                    parse_cache=self.parse_cache)
+                for task in turkunlp_chunks(self.dataset, self.container_system, self.compression)]
+
+    def complete(self):
+        # every chunk is converted, and no Parquet file is left over from removed chunks
+        tasks = self.chunk_tasks()
+        parquets = glob.glob(f'{self.output().path}/chunk-*.parquet')
+        return all(task.complete() and task.requires().complete() and task.requires().requires().complete()
+                   for task in tasks) and len(parquets) == len(tasks)
+
+    def run_internal(self):
+        remove_stale_outputs(self.dataset, self.compression)
+        yield self.chunk_tasks()
 
 
 class Pipeline(ForceableTask):
     dataset = luigi.Parameter(description='Dataset to process')
+    inputs = luigi.ListParameter(
+        default=[], description='Input directories or tar/zip archives (e.g. iltalehti_articles_2006_2019.tar.gz) to read instead of data/input/{dataset}')
     split = luigi.IntParameter(
-        default=200000, description='Number of articles to put in a single file')
-    container_system = luigi.Parameter(default='docker', description='Container system to use')
+        default=200000, description='Maximum number of articles to put in a single file')
+    max_chunk_bytes = luigi.OptionalIntParameter(
+        default=None, description='Maximum size of a single file in bytes, so that parse jobs take roughly equal time')
+    max_chunk_tokens = luigi.OptionalIntParameter(
+        default=None, description='Maximum estimated number of tokens in a single file')
+    container_system = luigi.Parameter(default='docker', description='Container system to use (docker, singularity, or fake for a stand-in parser)')
+    parser_workers = luigi.IntParameter(
+        default=0, significant=False, description='Parse on this many long-lived parser containers instead of one container per chunk')
+    incremental = luigi.BoolParameter(
+        default=False, description='Only prepare and parse again the chunks whose inputs changed')
+    compression = luigi.OptionalParameter(
+        default=None, description='Compress the intermediate chunks, parses and chunk CSVs with gzip or zstd')
+    parquet = luigi.BoolParameter(
+        default=False, description='Also write the parsed corpus as Parquet, into data/processed/conll-parquet/{dataset}')
+    dedup = luigi.ListParameter(
+        default=[], description='Datasets, in order of preference and already prepared but for this one, to find duplicate sections across, so that only one of each is parsed')
+    dedup_threshold = luigi.FloatParameter(
+        default=0.9, description='Estimated similarity of word shingles over which sections are near duplicates')
+    clean_text_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Clean text cache file (on a local disk) to reuse cleaned fields across runs')
+    parse_cache = luigi.OptionalParameter(
+        default=None, significant=False, description='Parse cache file (on a local disk) to reuse the parses of paragraphs across runs and datasets')
     done = False
 
     def complete(self):
         return self.done
 
     def run_internal(self):
-        yield PrepareForTurkuNLP(dataset=self.dataset, split=self.split)
-        yield TurkuNLP(dataset=self.dataset, container_system=self.container_system)
-        yield CONLLToCSV(dataset=self.dataset)
+        yield PrepareForTurkuNLP(dataset=self.dataset, inputs=self.inputs, split=self.split,
+                                 max_chunk_bytes=self.max_chunk_bytes, max_chunk_tokens=self.max_chunk_tokens,
+                                 clean_text_cache=self.clean_text_cache, incremental=self.incremental,
+                                 compression=self.compression)
+        group = None
+        if self.dedup:
+            datasets = [*self.dedup, *([self.dataset] if self.dataset not in self.dedup else [])]
+            group = dedup_group(datasets)
+            yield Deduplicate(datasets=datasets, compression=self.compression, threshold=self.dedup_threshold)
+        if self.parser_workers > 0:
+            yield TurkuNLP(dataset=self.dataset, container_system=self.container_system,
+                           compression=self.compression, parser_workers=self.parser_workers, dedup=group,
+                           parse_cache=self.parse_cache)
+        # chunks are converted to CSV as soon as they are parsed
+        outputs = [CONLLToCSV(dataset=self.dataset, container_system=self.container_system,
+                              compression=self.compression, dedup=group, parse_cache=self.parse_cache)]
+        if self.parquet:
+            outputs.append(CONLLToParquet(dataset=self.dataset, container_system=self.container_system,
+                                          compression=self.compression, dedup=group, parse_cache=self.parse_cache))
+        yield outputs
+        if self.parse_cache is not None:
+            evict(self.parse_cache)
         self.done = True
 
 
 if __name__ == '__main__':
-    luigi.run()
+    configure_resources()
+    configure_metrics()
+    try:
+        luigi.run()
+    finally:
+        render(os.environ[REPORT_VARIABLE])